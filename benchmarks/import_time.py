@@ -0,0 +1,81 @@
+# This file is part of RiakKit.
+#
+# RiakKit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RiakKit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures how long it takes to import a module defining a lot of Document
+classes, and how many buckets the client is asked for while doing it.
+
+Usage: python benchmarks/import_time.py [number of classes]
+
+Doesn't need a Riak server. Nothing is sent to Riak.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import riak
+
+class CountingClient(riak.RiakClient):
+  buckets = 0
+
+  def bucket(self, name):
+    CountingClient.buckets += 1
+    return riak.RiakClient.bucket(self, name)
+
+MODEL = '''
+class Model%(i)d(Document):
+  bucket_name = "benchmark_import_%(i)d"
+  client = client
+
+  name = StringProperty(required=True)
+  email = StringProperty(unique=True)
+  handle = StringProperty(unique=True)
+  count = IntegerProperty(default=0)
+  created = DateTimeProperty()
+  tags = ListProperty()
+'''
+
+def writeModule(directory, n):
+  source = ["from riakkit import *",
+            "from __main__ import CountingClient",
+            "client = CountingClient()"]
+  source.extend(MODEL % {"i" : i} for i in xrange(n))
+  with open(os.path.join(directory, "benchmark_models.py"), "w") as f:
+    f.write("\n".join(source))
+
+def main(n):
+  import riakkit # Not what's being measured.
+
+  directory = tempfile.mkdtemp()
+  try:
+    writeModule(directory, n)
+    sys.path.insert(0, directory)
+    start = time.time()
+    import benchmark_models
+    elapsed = time.time() - start
+  finally:
+    shutil.rmtree(directory)
+
+  print "%d classes imported in %.1f ms" % (n, elapsed * 1000)
+  print "buckets created while importing: %d" % CountingClient.buckets
+
+  for i in xrange(n):
+    getattr(benchmark_models, "Model%d" % i).bucket
+  print "buckets created once every class has been used: %d" % CountingClient.buckets
+
+if __name__ == "__main__":
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else 80)
@@ -0,0 +1,63 @@
+# This file is part of RiakKit.
+#
+# RiakKit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RiakKit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the key generators of riakkit.commons.keygen against uuid1Key and
+the old rndstr, which called os.urandom for every character.
+
+Usage: python benchmarks/keygen.py [number of keys]
+
+Doesn't need a Riak server.
+"""
+
+import os
+import sys
+import time
+
+from riakkit.commons import uuid1Key, rndstr
+from riakkit.commons.keygen import base62Key, sortableKey
+
+_p = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+def bytewiseRndstr(n):
+  t = ""
+  while n > 0:
+    i = ord(os.urandom(1))
+    while i >= 248:
+      i = ord(os.urandom(1))
+    i %= 62
+    t += _p[i]
+    n -= 1
+  return t
+
+def rate(f, n):
+  start = time.time()
+  for i in xrange(n):
+    f()
+  return n / (time.time() - start)
+
+def main(n):
+  generators = [
+    ("uuid1Key", lambda: uuid1Key({})),
+    ("old rndstr(22)", lambda: bytewiseRndstr(22)),
+    ("rndstr(22)", lambda: rndstr(22)),
+    ("base62Key", lambda: base62Key({})),
+    ("sortableKey", lambda: sortableKey({})),
+  ]
+
+  print "%-16s %12s %8s" % ("", "keys/s", "length")
+  for name, f in generators:
+    print "%-16s %12.0f %8d" % (name, rate(f, n), len(f()))
+
+if __name__ == "__main__":
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,95 @@
+# This file is part of RiakKit.
+#
+# RiakKit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RiakKit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the compiled serialize/deserialize of a class against the generic
+path that goes through _meta for every field.
+
+Usage: python benchmarks/serialization.py [number of documents]
+
+Doesn't need a Riak server.
+"""
+
+import sys
+import time
+
+from riakkit import *
+from riakkit.simple.basedocument import DEFAULT_CONVERTER
+
+class BenchmarkEmDocument(EmDocument):
+  name = StringProperty()
+  value = IntegerProperty()
+
+class BenchmarkModel(EmDocument):
+  s1 = StringProperty(required=True)
+  s2 = StringProperty()
+  i1 = IntegerProperty()
+  i2 = IntegerProperty(default=5)
+  f = FloatProperty()
+  b = BooleanProperty()
+  l = ListProperty()
+  d = DictProperty()
+  dt = DateTimeProperty()
+  e = EnumProperty(["a", "b", "c"])
+  em = EmDocumentProperty(BenchmarkEmDocument)
+
+def genericSerialize(doc):
+  d = {}
+  for name, value in doc._data.iteritems():
+    doc._processOneValue(d, name, value)
+  return d
+
+def genericDeserialize(doc, data):
+  doc.clear()
+  keys = set(doc._meta.keys())
+  for name, value in data.iteritems():
+    prop = doc._meta.get(name, None)
+    if prop is not None:
+      converter = prop.convertFromDb
+    else:
+      converter = DEFAULT_CONVERTER
+
+    doc._data[name] = converter(value)
+    keys.discard(name)
+
+  for name in keys:
+    doc._data[name] = doc._meta[name].defaultValue()
+
+  return doc
+
+def rate(f, n):
+  start = time.time()
+  for i in xrange(n):
+    f()
+  return n / (time.time() - start)
+
+def main(n):
+  doc = BenchmarkModel(s1="hello", s2="world", i1=1, f=1.5, b=True,
+                       l=[1, 2, 3], d={"a" : 1}, e="b",
+                       em={"name" : "x", "value" : 1})
+  doc.dynamic = "not in the schema"
+  data = doc.serialize()
+  other = BenchmarkModel(s1="other")
+
+  results = [
+    ("serialize", rate(lambda: genericSerialize(doc), n), rate(doc.serialize, n)),
+    ("deserialize", rate(lambda: genericDeserialize(other, data), n), rate(lambda: other.deserialize(data), n)),
+  ]
+
+  print "%-12s %15s %15s %8s" % ("", "generic doc/s", "compiled doc/s", "speedup")
+  for name, generic, compiled in results:
+    print "%-12s %15.0f %15.0f %7.2fx" % (name, generic, compiled, compiled / generic)
+
+if __name__ == "__main__":
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
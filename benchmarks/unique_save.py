@@ -0,0 +1,65 @@
+# This file is part of RiakKit.
+#
+# RiakKit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RiakKit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the latency of saving new documents, saving them again with every
+unique value changed, and deleting them, against the number of unique
+properties of the document.
+
+Usage: python benchmarks/unique_save.py [number of documents]
+
+Needs a Riak server, like the tests. The buckets used are named
+benchmark_unique_*.
+"""
+
+import sys
+import time
+
+import riak
+from riakkit import *
+from riakkit.commons.keygen import base62Key
+
+client = riak.RiakClient()
+
+def modelWithUniques(n):
+  attrs = {"bucket_name" : "benchmark_unique_%d" % n, "client" : client}
+  for i in xrange(n):
+    attrs["u%d" % i] = StringProperty(unique=True)
+  return type(Document)("UniqueModel%d" % n, (Document, ), attrs)
+
+def timed(f, items):
+  start = time.time()
+  for item in items:
+    f(item)
+  return (time.time() - start) * 1000 / len(items)
+
+def main(n):
+  print "%8s %12s %12s %12s" % ("uniques", "new ms", "changed ms", "delete ms")
+  for uniques in xrange(5):
+    cls = modelWithUniques(uniques)
+    docs = [cls(**dict(("u%d" % i, base62Key({})) for i in xrange(uniques)))
+            for j in xrange(n)]
+
+    def change(doc):
+      for i in xrange(uniques):
+        setattr(doc, "u%d" % i, base62Key({}))
+      doc.save()
+
+    new = timed(lambda doc: doc.save(), docs)
+    changed = timed(change, docs)
+    deleted = timed(lambda doc: doc.delete(), docs)
+    print "%8d %12.2f %12.2f %12.2f" % (uniques, new, changed, deleted)
+
+if __name__ == "__main__":
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -14,7 +14,7 @@
 # along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
 
 from uuid import uuid1
-import os
+from riakkit.commons.keygen import randomString
 
 
 uuid1Key = lambda kwargs: uuid1().hex
@@ -29,21 +29,14 @@ def rndstr(n):
   """Generates a random string from a-zA-Z0-9 using os.urandom.
 
   Could be a way to generate the keys. May collide more, not certain though.
+  See riakkit.commons.keygen for key generators.
 
   Args:
     n: The length of the string.
   Returns:
     a n-length string of random characters
 """
-  t = ""
-  while n > 0:
-    i = ord(os.urandom(1))
-    while i >= 248:
-      i = ord(os.urandom(1))
-    i %= 62
-    t += _p[i]
-    n -= 1
-  return t
+  return randomString(n, _p)
 
 
 def getUniqueListGivenBucketName(bucketName, propertyName):
@@ -73,23 +66,41 @@ def walkParents(parents, bases=("Document", "type", "object")):
     although each levels are not separated
   """
   frontier = parents
-  next = []
   all_parents = []
-  found = False
-  while not found:
-    found = True
+  seen = set()
+  while frontier:
+    next = []
     for cls in frontier:
-      if cls.__name__ not in bases:
-        found = False
-        if cls not in all_parents: # Inefficient
-          all_parents.append(cls)
-          next.extend(cls.__bases__)
+      if cls.__name__ not in bases and cls not in seen:
+        seen.add(cls)
+        all_parents.append(cls)
+        next.extend(cls.__bases__)
 
     frontier = next
-    next = []
 
   return all_parents
 
+def getInherited(parents, name, default=None):
+  """Gets an attribute a class that's about to be created would inherit, from
+  the class dictionaries along the MRO of each of its parents. Metaclass
+  __getattr__ are not involved.
+
+  Args:
+    parents: The class objects that's the parent of this class from __new__.
+    name: The name of the attribute.
+    default: What to return if none of the parents have it.
+
+  Returns:
+    The first value that's not None, or default.
+  """
+  for parent in parents:
+    for cls in parent.__mro__:
+      value = cls.__dict__.get(name, None)
+      if value is not None:
+        return value
+
+  return default
+
 def getProperty(name, attrs, parents):
   """Used in __new__ while getting attributes of class objects that's about to
   be created.
@@ -103,20 +114,32 @@ def getProperty(name, attrs, parents):
 
   Returns:
     None if the attributes is not found from the attrs nor the parents.
-    Otherwise the first one that's found, from attrs to BFS'ed parents.
+    Otherwise the first one that's found, from attrs to the parents (each
+    through its MRO).
   """
-  parents = walkParents(parents)
   value = attrs.get(name, None)
-  i = 0
-  length = len(parents)
-  while value is None:
-    if i == length:
-      return None
-    value = getattr(parents[i], name, None)
-    i += 1
-
+  if value is None:
+    value = getInherited(parents, name)
   return value
 
+def mergeParentSchemas(parents):
+  """Merges the _meta of the parents of a class that's about to be created.
+
+  The _meta of a class already has everything from its own parents, so only
+  the direct parents are merged, in reverse, so that the first parent wins like
+  in the MRO. Nothing is copied.
+
+  Args:
+    parents: The class objects that's the parent of this class from __new__.
+
+  Returns:
+    A new dictionary, {name : property}.
+  """
+  meta = {}
+  for parent in reversed(parents):
+    meta.update(getInherited((parent, ), "_meta", {}))
+  return meta
+
 def getKeys(*args, **kwargs):
   """Gets the keys of all of the dictionaries and returns it in a list.
 
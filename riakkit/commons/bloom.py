@@ -0,0 +1,133 @@
+# This file is part of RiakKit.
+#
+# RiakKit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RiakKit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A Bloom filter, used to answer "this key doesn't exist" without going to
+Riak. See Document.buildFilters.
+"""
+
+import hashlib
+import math
+import struct
+import threading
+
+DEFAULT_ERROR_RATE = 0.01
+MIN_CAPACITY = 1024
+
+class BloomFilter(object):
+  """A set of strings that can only say if a string is definitely not in it,
+  or probably is.
+
+  Strings can't be removed. A removed string stays a false positive.
+
+  Attributes:
+    capacity: The number of strings this was sized for.
+    error_rate: The false positive rate at capacity.
+    bits: The number of bits.
+    hashes: The number of bits set for each string.
+    count: The number of strings added.
+  """
+  def __init__(self, capacity, error_rate=DEFAULT_ERROR_RATE):
+    """Initializes an empty filter.
+
+    Args:
+      capacity: The number of strings expected.
+      error_rate: The false positive rate wanted once there are capacity
+                  strings. Default: DEFAULT_ERROR_RATE
+    """
+    self.capacity = capacity
+    self.error_rate = error_rate
+    self.bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+    self.hashes = max(1, int(round(float(self.bits) / capacity * math.log(2))))
+    self.count = 0
+    self._array = bytearray((self.bits + 7) // 8)
+    self._lock = threading.Lock()
+
+  def _positions(self, value):
+    if isinstance(value, unicode):
+      value = value.encode("utf-8")
+    elif not isinstance(value, str):
+      value = str(value)
+
+    # Double hashing: the k positions are h1 + i * h2.
+    h1, h2 = struct.unpack("<QQ", hashlib.md5(value).digest())
+    return [(h1 + i * h2) % self.bits for i in xrange(self.hashes)]
+
+  def add(self, value):
+    """Adds a string.
+
+    Args:
+      value: A string, or anything that will be converted to one.
+    """
+    positions = self._positions(value)
+    with self._lock:
+      for p in positions:
+        self._array[p >> 3] |= 1 << (p & 7)
+      self.count += 1
+
+  def update(self, values):
+    """Adds many strings."""
+    for value in values:
+      self.add(value)
+
+  def __contains__(self, value):
+    array = self._array
+    for p in self._positions(value):
+      if not array[p >> 3] & (1 << (p & 7)):
+        return False
+    return True
+
+  def __len__(self):
+    return self.count
+
+  def estimatedErrorRate(self):
+    """Estimates the current false positive rate from the number of strings
+    added.
+
+    Returns:
+      A float between 0 and 1.
+    """
+    return (1 - math.exp(-float(self.hashes) * self.count / self.bits)) ** self.hashes
+
+  def stats(self):
+    """Gets the size and the error rates of this filter.
+
+    Returns:
+      A dictionary with capacity, count, error_rate, estimated_error_rate,
+      bits, hashes and memory (in bytes).
+    """
+    return {"capacity" : self.capacity, "count" : self.count,
+            "error_rate" : self.error_rate,
+            "estimated_error_rate" : self.estimatedErrorRate(),
+            "bits" : self.bits, "hashes" : self.hashes,
+            "memory" : len(self._array)}
+
+def newFilter(keys, capacity=None, error_rate=DEFAULT_ERROR_RATE):
+  """Creates a filter with some keys already in it.
+
+  Args:
+    keys: A list of keys, from a key listing for example.
+    capacity: The capacity of the filter. Defaults to twice the number of keys,
+              and at least MIN_CAPACITY.
+    error_rate: See BloomFilter.
+
+  Returns:
+    A BloomFilter.
+  """
+  if capacity is None:
+    capacity = max(2 * len(keys), MIN_CAPACITY)
+
+  f = BloomFilter(capacity, error_rate)
+  f.update(keys)
+  return f
@@ -0,0 +1,254 @@
+# This file is part of RiakKit.
+#
+# RiakKit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RiakKit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The caches that can be used for Document.instances.
+
+Which one a Document class gets is decided by its cache_size and cache_ttl
+class variables. See newCache.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+import weakref
+
+
+class Cache(object):
+  """Base class of the caches. Keeps the hit, miss and eviction counters.
+
+  Only lookups with [] and get() are counted as hits or misses. The in operator
+  is not counted.
+
+  Attributes:
+    hits: The number of lookups that found a document.
+    misses: The number of lookups that didn't.
+    evictions: The number of documents removed by the cache itself (not by
+               pop()).
+  """
+  def __init__(self):
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._lock = threading.RLock()
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def stats(self):
+    """Gets the counters of this cache.
+
+    Returns:
+      A dictionary with hits, misses, evictions and size.
+    """
+    return {"hits" : self.hits, "misses" : self.misses,
+            "evictions" : self.evictions, "size" : len(self)}
+
+
+class WeakCache(Cache):
+  """Keeps a document for as long as something else has a reference to it.
+
+  This is the default, and how Document.instances always worked.
+  """
+  def __init__(self):
+    Cache.__init__(self)
+    self._refs = {}
+
+  def _removed(self, key):
+    def callback(ref):
+      with self._lock:
+        if self._refs.get(key) is ref:
+          del self._refs[key]
+          self.evictions += 1
+    return callback
+
+  def __getitem__(self, key):
+    with self._lock:
+      ref = self._refs.get(key)
+      value = None if ref is None else ref()
+      if value is None:
+        self.misses += 1
+        raise KeyError(key)
+      self.hits += 1
+      return value
+
+  def __setitem__(self, key, value):
+    with self._lock:
+      self._refs[key] = weakref.ref(value, self._removed(key))
+
+  def __contains__(self, key):
+    ref = self._refs.get(key)
+    return ref is not None and ref() is not None
+
+  def __len__(self):
+    return len(self._refs)
+
+  def pop(self, key, *default):
+    with self._lock:
+      ref = self._refs.pop(key, None)
+      value = None if ref is None else ref()
+      if value is None:
+        if default:
+          return default[0]
+        raise KeyError(key)
+      return value
+
+  def clear(self):
+    with self._lock:
+      self._refs.clear()
+
+
+class LRUCache(Cache):
+  """Keeps the most recently used documents, up to a maximum number.
+
+  Documents are kept even if nothing else references them. Optionally, they
+  expire after ttl seconds since they were put in the cache.
+  """
+  def __init__(self, size, ttl=None):
+    """Initializes the cache.
+
+    Args:
+      size: The maximum number of documents. None for no maximum.
+      ttl: The number of seconds a document is kept. None for forever.
+    """
+    Cache.__init__(self)
+    self.size = size
+    self.ttl = ttl
+    self._items = OrderedDict()
+
+  def _purge(self):
+    """Evicts the expired documents at the front. Every document gets the
+    same ttl when it's put in the cache, so those are the first to expire."""
+    now = time.time()
+    while self._items:
+      key, (value, expires) = next(self._items.iteritems())
+      if expires > now:
+        return
+      del self._items[key]
+      self.evictions += 1
+
+  def _expired(self, key):
+    if self.ttl is None:
+      return False
+
+    value, expires = self._items[key]
+    if expires > time.time():
+      return False
+
+    del self._items[key]
+    self.evictions += 1
+    return True
+
+  def __getitem__(self, key):
+    with self._lock:
+      if key not in self._items or self._expired(key):
+        self.misses += 1
+        raise KeyError(key)
+
+      self.hits += 1
+      item = self._items.pop(key)
+      self._items[key] = item
+      return item[0]
+
+  def __setitem__(self, key, value):
+    with self._lock:
+      self._items.pop(key, None)
+      expires = None
+      if self.ttl is not None:
+        self._purge()
+        expires = time.time() + self.ttl
+      self._items[key] = (value, expires)
+      while self.size is not None and len(self._items) > self.size:
+        self._items.popitem(last=False)
+        self.evictions += 1
+
+  def __contains__(self, key):
+    with self._lock:
+      return key in self._items and not self._expired(key)
+
+  def __len__(self):
+    with self._lock:
+      if self.ttl is None:
+        return len(self._items)
+
+      self._purge()
+      now = time.time()
+      return sum(1 for value, expires in self._items.itervalues() if expires > now)
+
+  def pop(self, key, *default):
+    with self._lock:
+      if key in self._items:
+        return self._items.pop(key)[0]
+      if default:
+        return default[0]
+      raise KeyError(key)
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+
+
+class StrongCache(Cache):
+  """Keeps every document until it's cleared. Used as the identity map of a
+  session, which only lives for as long as the session.
+  """
+  def __init__(self):
+    Cache.__init__(self)
+    self._items = {}
+
+  def __getitem__(self, key):
+    with self._lock:
+      if key not in self._items:
+        self.misses += 1
+        raise KeyError(key)
+
+      self.hits += 1
+      return self._items[key]
+
+  def __setitem__(self, key, value):
+    with self._lock:
+      self._items[key] = value
+
+  def __contains__(self, key):
+    return key in self._items
+
+  def __len__(self):
+    return len(self._items)
+
+  def pop(self, key, *default):
+    with self._lock:
+      return self._items.pop(key, *default)
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+
+
+def newCache(size=None, ttl=None):
+  """Creates the cache for a Document class.
+
+  Args:
+    size: None for a WeakCache, otherwise the size of an LRUCache.
+    ttl: The ttl of the LRUCache. If it's set without size, the LRUCache has
+         no maximum size, and documents are only evicted as they expire.
+
+  Returns:
+    A Cache object.
+  """
+  if size is None and ttl is None:
+    return WeakCache()
+  return LRUCache(size, ttl)
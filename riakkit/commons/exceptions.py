@@ -37,3 +37,7 @@ class IntegrityError(RiakkitError):
   def __init__(self, field, message):
     super(IntegrityError, self).__init__(message)
     self.field = field
+
+
+class TimeoutError(RiakkitError):
+  pass
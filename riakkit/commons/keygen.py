@@ -0,0 +1,126 @@
+# This file is part of RiakKit.
+#
+# RiakKit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RiakKit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Key generators that can be used instead of uuid1Key.
+
+Like uuid1Key, they take the kwargs given to the document, which are ignored:
+
+  from riakkit.commons.keygen import sortableKey
+
+  post = BlogPost(key=sortableKey, title="Hello")
+
+The random bytes are drawn from os.urandom in bulk and handed out from a
+buffer, instead of with a call to os.urandom every time.
+"""
+
+import os
+import threading
+import time
+
+# In ASCII order, so that the encoded numbers sort the same way as the numbers.
+BASE62 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+KEY_LENGTH = 22 # About 131 random bits, more than the 122 of an UUID.
+TIMESTAMP_LENGTH = 8 # Milliseconds, good until about the year 8900.
+
+class EntropyPool(object):
+  """A buffer of random bytes from os.urandom, refilled size bytes at a time.
+
+  The buffer is thrown away in a forked process, so a child never gives out
+  the same bytes as its parent.
+  """
+  def __init__(self, size=4096):
+    self.size = size
+    self._buffer = ""
+    self._position = 0
+    self._pid = None
+    self._lock = threading.Lock()
+
+  def read(self, n):
+    """Gets n random bytes.
+
+    Args:
+      n: The number of bytes.
+
+    Returns:
+      A string of n bytes.
+    """
+    with self._lock:
+      if self._position + n > len(self._buffer) or self._pid != os.getpid():
+        self._buffer = os.urandom(max(self.size, n))
+        self._position = 0
+        self._pid = os.getpid()
+
+      data = self._buffer[self._position:self._position + n]
+      self._position += n
+      return data
+
+_pool = EntropyPool()
+
+def randomString(n, alphabet=BASE62):
+  """Generates a random string of characters from a 62 character alphabet.
+
+  Bytes of 248 and over are skipped so that every character is as likely.
+
+  Args:
+    n: The length of the string.
+    alphabet: The characters to use. Default: BASE62
+
+  Returns:
+    a n-length string of random characters
+  """
+  chars = []
+  while len(chars) < n:
+    needed = n - len(chars)
+    for c in _pool.read(needed + needed / 16 + 1):
+      i = ord(c)
+      if i < 248:
+        chars.append(alphabet[i % 62])
+        if len(chars) == n:
+          break
+
+  return "".join(chars)
+
+def encodeBase62(number, length):
+  """Encodes a positive integer in base62, padded to a length.
+
+  Args:
+    number: The integer.
+    length: The minimum length of the result.
+
+  Returns:
+    A string that sorts the same way as the number, among strings of the same
+    length.
+  """
+  chars = []
+  while number:
+    number, i = divmod(number, 62)
+    chars.append(BASE62[i])
+
+  return "".join(reversed(chars)).rjust(length, "0")
+
+def base62Key(kwargs):
+  """Generates a random key of KEY_LENGTH base62 characters."""
+  return randomString(KEY_LENGTH)
+
+def sortableKey(kwargs):
+  """Generates a key that starts with the current time in milliseconds, so keys
+  sort in the order they were generated (within the same millisecond, they
+  don't). The key is KEY_LENGTH characters long, with the rest being random.
+
+  This makes the keys of recent documents a range, e.g. for the $key index.
+  """
+  now = int(time.time() * 1000)
+  return encodeBase62(now, TIMESTAMP_LENGTH) + randomString(KEY_LENGTH - TIMESTAMP_LENGTH)
@@ -0,0 +1,241 @@
+# This file is part of RiakKit.
+#
+# RiakKit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RiakKit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A small bounded worker pool used to issue requests to Riak concurrently.
+
+Only the requests themselves should be done in the workers. Anything that
+touches the documents (deserializing, the instances cache) should be done by
+the caller once parallelMap returns.
+
+The Executor is different: it runs whole operations (like Document.get) in the
+background for the a* methods of Document, and hands back a Future. Those can
+run at the same time as the caller and each other, so Document creates and
+looks up documents in the instances cache under a lock.
+"""
+
+import os
+import sys
+import threading
+from Queue import Queue, Empty
+
+from riakkit.commons.exceptions import TimeoutError
+
+DEFAULT_CONCURRENCY = 10
+
+def parallelMap(f, items, concurrency=DEFAULT_CONCURRENCY):
+  """Calls f on every item with at most concurrency threads at once.
+
+  If there is only 1 item or concurrency is 1 or less, this is done in the
+  calling thread.
+
+  Args:
+    f: A callable that takes 1 argument.
+    items: An iterable of arguments for f.
+    concurrency: The maximum number of threads. Default: DEFAULT_CONCURRENCY
+
+  Returns:
+    A list of the return values, in the same order as items.
+
+  Raises:
+    The exception raised by the first item (in the order of items) that failed.
+    This is only raised after every item has been processed.
+  """
+  items = list(items)
+  if concurrency <= 1 or len(items) <= 1:
+    return map(f, items)
+
+  results = [None] * len(items)
+  errors = []
+  queue = Queue()
+  for i, item in enumerate(items):
+    queue.put((i, item))
+
+  def worker():
+    while True:
+      try:
+        i, item = queue.get_nowait()
+      except Empty:
+        return
+
+      try:
+        results[i] = f(item)
+      except Exception:
+        errors.append((i, sys.exc_info()))
+
+  threads = [threading.Thread(target=worker) for i in xrange(min(concurrency, len(items)))]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+
+  for thread in threads:
+    thread.join()
+
+  if errors:
+    errors.sort(key=lambda e: e[0])
+    t, v, tb = errors[0][1]
+    raise t, v, tb
+
+  return results
+
+
+class Future(object):
+  """The result of a call made by an Executor, available once it's done."""
+  def __init__(self):
+    self._event = threading.Event()
+    self._lock = threading.Lock()
+    self._result = None
+    self._excInfo = None
+    self._callbacks = []
+
+  def done(self):
+    """Checks if the call is done.
+
+    Returns:
+      True if it returned or raised.
+    """
+    return self._event.is_set()
+
+  def _wait(self, timeout):
+    if not self._event.wait(timeout):
+      raise TimeoutError("The call is not done after %s seconds." % timeout)
+
+  def result(self, timeout=None):
+    """Waits for the call to be done and gets what it returned.
+
+    Args:
+      timeout: The maximum number of seconds to wait. None for forever.
+
+    Returns:
+      The return value of the call.
+
+    Raises:
+      The exception raised by the call, if it raised.
+      TimeoutError if it's not done after timeout seconds.
+    """
+    self._wait(timeout)
+    if self._excInfo is not None:
+      t, v, tb = self._excInfo
+      raise t, v, tb
+    return self._result
+
+  def exception(self, timeout=None):
+    """Waits for the call to be done and gets what it raised.
+
+    Args:
+      timeout: The maximum number of seconds to wait. None for forever.
+
+    Returns:
+      The exception, or None if the call returned.
+
+    Raises:
+      TimeoutError if it's not done after timeout seconds.
+    """
+    self._wait(timeout)
+    return None if self._excInfo is None else self._excInfo[1]
+
+  def addDoneCallback(self, f):
+    """Calls f with this future once the call is done, in the thread that made
+    the call. If it's already done, f is called right away.
+
+    Args:
+      f: A callable that takes 1 argument.
+    """
+    with self._lock:
+      if not self._event.is_set():
+        self._callbacks.append(f)
+        return
+    f(self)
+
+  def _set(self, result, excInfo=None):
+    with self._lock:
+      self._result = result
+      self._excInfo = excInfo
+      self._event.set()
+      callbacks, self._callbacks = self._callbacks, []
+
+    for f in callbacks:
+      try:
+        f(self)
+      except Exception:
+        pass
+
+
+class Executor(object):
+  """Runs calls in up to max_workers background threads, which are started as
+  they're needed and then kept.
+
+  A call shouldn't wait for the future of another call made through the same
+  executor, as every worker could end up waiting.
+
+  Attributes:
+    max_workers: The maximum number of threads.
+  """
+  def __init__(self, max_workers=DEFAULT_CONCURRENCY):
+    self.max_workers = max_workers
+    self._lock = threading.Lock()
+    self._reset()
+
+  def _reset(self):
+    self._queue = Queue()
+    self._threads = []
+    self._idle = 0
+    self._pid = os.getpid()
+
+  def submit(self, f, *args, **kwargs):
+    """Calls f(*args, **kwargs) in the background.
+
+    Returns:
+      A Future of what f returns.
+    """
+    future = Future()
+    with self._lock:
+      if self._pid != os.getpid(): # The threads don't survive a fork.
+        self._reset()
+
+      self._queue.put((future, f, args, kwargs))
+      if self._queue.qsize() > self._idle and len(self._threads) < self.max_workers:
+        thread = threading.Thread(target=self._worker, args=(self._queue, ))
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+    return future
+
+  def _worker(self, queue):
+    while True:
+      with self._lock:
+        self._idle += 1
+      item = queue.get()
+      with self._lock:
+        self._idle -= 1
+
+      future, f, args, kwargs = item
+      del item
+      try:
+        result = f(*args, **kwargs)
+      except Exception:
+        future._set(None, sys.exc_info())
+      else:
+        future._set(result)
+      del future, f, args, kwargs
+
+_executor = Executor()
+
+def submit(f, *args, **kwargs):
+  """Calls f(*args, **kwargs) in the background, with the shared Executor.
+
+  Returns:
+    A Future of what f returns.
+  """
+  return _executor.submit(f, *args, **kwargs)
@@ -14,14 +14,56 @@
 # along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import struct
 import time
+from riakkit.commons.bloom import newFilter, DEFAULT_ERROR_RATE
 from riakkit.commons.exceptions import RiakkitError
 from riakkit.helpers import generateSalt, hashPassword, checkPassword
 from uuid import uuid1
 
 NONE_TYPE = type(None)
+DEFAULT_PAGE_SIZE = 50
 _valueOrList = lambda value: [] if value is None else value
 
+def sortableNumber(value):
+  """Encodes a number as a string, so that the strings sort the same way as the
+  numbers. Used for numbers in _bin indexes, where they're compared as strings.
+
+  The number is converted to a float first, so integers larger than 2 ** 53
+  lose precision.
+
+  Args:
+    value: An int, long or float.
+
+  Returns:
+    A string of 16 hexadecimal digits.
+  """
+  bits = struct.unpack(">Q", struct.pack(">d", float(value) or 0.0))[0] # No -0.0
+  if bits >> 63: # Negative: the larger the bits, the smaller the number.
+    bits ^= 0xffffffffffffffff
+  else:
+    bits |= 1 << 63
+  return "%016x" % bits
+
+def _binIndexValue(value):
+  if isinstance(value, basestring):
+    return value
+  if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+    return sortableNumber(value)
+  return unicode(value)
+
+def referenceKeys(values):
+  """Gets the keys out of a list of references without loading anything.
+
+  Args:
+    values: A list of documents and/or keys, such as the value of a
+            MultiReferenceProperty.
+
+  Returns:
+    A list of keys. None stays as None.
+  """
+  return [getattr(v, "key", v) for v in list.__iter__(_valueOrList(values))]
+
 class BaseProperty(object):
   """Base property type
 
@@ -33,10 +75,18 @@ class BaseProperty(object):
     validators: A list of callables or 1 callable that validates any value
                 given. The function should be callback(value), returning
                 a boolean.
+    index: Keep a secondary index on this property. True, False, or the name
+           of the index.
+    index_suffix: The suffix of the index name when index is True. _bin, or
+                  _int for properties that are stored as numbers.
+    filter: A BloomFilter of the values taken if this is unique, or None. See
+            buildFilter.
   """
+  index_suffix = "_bin"
+
   def __init__(self, required=False, unique=False, default=None,
                validators=None, forwardprocessors=None, backwardprocessors=None,
-               standardprocessors=None):
+               standardprocessors=None, index=False):
     """Initializes the property field
 
     Args:
@@ -54,6 +104,10 @@ class BaseProperty(object):
       standardprocessors: A list of callables or 1 callable that processes the
                           data when the data is being fed into the Document
                           object.
+      index: If True, the value of this property is kept in the secondary
+             index named after the property with index_suffix, every time the
+             document is saved. If a string, that's the name of the index.
+             Default: False
 
     """
     self.required = required
@@ -63,7 +117,37 @@ class BaseProperty(object):
     self.forwardprocessors = _valueOrList(forwardprocessors)
     self.backwardprocessors = _valueOrList(backwardprocessors)
     self.standardprocessors = _valueOrList(standardprocessors)
+    self.index = index
     self.name = None
+    self._uniqueOwner = None
+    self._uniqueBucket = None
+    self.filter = None
+
+  def bindUniqueBucket(self, owner, bucketName):
+    """Sets up unique_bucket. The bucket itself is only created when it's
+    first used.
+
+    Args:
+      owner: The Document class this property belongs to. Its client is used.
+      bucketName: The name of the bucket that keeps the unique values.
+    """
+    self._uniqueOwner = owner
+    self.unique_bucket_name = bucketName
+    self._uniqueBucket = None
+
+  @property
+  def unique_bucket(self):
+    """The RiakBucket that keeps the values of this property if it's unique.
+
+    Created with the client of the class on first use, and created again if
+    that client is replaced."""
+    if self._uniqueOwner is None:
+      raise AttributeError("'%s' is not unique." % self.name)
+
+    client = self._uniqueOwner.client
+    if self._uniqueBucket is None or self._uniqueBucket[0] is not client:
+      self._uniqueBucket = (client, client.bucket(self.unique_bucket_name))
+    return self._uniqueBucket[1]
 
   def _processValue(self, value, processors):
     if callable(processors):
@@ -83,9 +167,89 @@ class BaseProperty(object):
       True/False if it exist or not. None if the unique flag is not on.
     """
     if self.unique:
+      if self.filter is not None and value not in self.filter:
+        return False
       return self.unique_bucket.get(value).exists()
     return None
 
+  def buildFilter(self, capacity=None, error_rate=DEFAULT_ERROR_RATE):
+    """Builds a Bloom filter of the values taken from a key listing of
+    unique_bucket. After that, hasValue (and so the unique checks done while
+    saving) only goes to the database if the filter says the value might be
+    taken.
+
+    The filter is kept up to date with the values claimed by this process only.
+    Values claimed by other processes after the filter is built will be seen
+    as not taken, so only use this if that's fine, or rebuild it regularly.
+
+    Args:
+      capacity: The number of values expected. See riakkit.commons.bloom.newFilter.
+      error_rate: The false positive rate at capacity.
+
+    Returns:
+      The BloomFilter.
+    """
+    self.filter = newFilter(self.unique_bucket.get_keys(), capacity, error_rate)
+    return self.filter
+
+  def indexName(self, name):
+    """Gets the name of the secondary index of this property.
+
+    Args:
+      name: The name of this property in the document.
+
+    Returns:
+      The name of the index, or None if this property is not indexed.
+    """
+    if not self.index:
+      return None
+    if isinstance(self.index, basestring):
+      return self.index
+    return name + self.index_suffix
+
+  def indexValues(self, value):
+    """Gets the values of the index entries for a value of this property.
+
+    Lists and dictionaries get an entry for each of their values. Numbers in
+    _bin indexes are encoded with sortableNumber, so ranges of them work.
+
+    Args:
+      value: The value in the form it's stored in the database (what
+             convertToDb returns).
+
+    Returns:
+      A list of integers for _int indexes, or strings for _bin indexes.
+    """
+    if value is None:
+      return []
+
+    if isinstance(value, dict):
+      value = value.values()
+    elif not isinstance(value, (list, tuple)):
+      value = [value]
+
+    name = self.index if isinstance(self.index, basestring) else self.index_suffix
+    if name.endswith("_int"):
+      return [int(v) for v in value if v is not None]
+    return [_binIndexValue(v) for v in value if v is not None]
+
+  def indexValue(self, value):
+    """Converts a value given by the user to the value to look up in the index.
+
+    Args:
+      value: A value in the form it's given to the document.
+
+    Returns:
+      An integer or a string.
+
+    Raises:
+      ValueError if value can't be looked up, like None.
+    """
+    values = self.indexValues(self.convertToDb(self.standardize(value)))
+    if not values:
+      raise ValueError("%r can't be looked up in an index." % (value, ))
+    return values[0]
+
   def convertToDb(self, value):
     """Converts the value from the access form a DB valid form
 
@@ -217,6 +381,9 @@ class DictProperty(BaseProperty):
 
 class ListProperty(BaseProperty):
   """List property, []"""
+  def indexValue(self, value):
+    return BaseProperty.indexValue(self, [value])
+
   def defaultValue(self):
     """Default value for list
 
@@ -227,6 +394,9 @@ class ListProperty(BaseProperty):
 
 class SetProperty(BaseProperty):
   """A set, using python's built-in set."""
+  def indexValue(self, value):
+    return BaseProperty.indexValue(self, [value])
+
   def standardize(self, value):
     value = BaseProperty.standardize(self, value)
     if value is None: return None
@@ -266,6 +436,8 @@ class StringProperty(BaseProperty):
 
 class IntegerProperty(BaseProperty):
   """Integer property."""
+  index_suffix = "_int"
+
   def standardize(self, value):
     value = BaseProperty.standardize(self, value)
     if value is None: return None
@@ -306,6 +478,8 @@ class FloatProperty(BaseProperty):
 
 class BooleanProperty(BaseProperty):
   """Boolean property. Pretty self explanatory."""
+  index_suffix = "_int"
+
   def standardize(self, value):
     value = BaseProperty.standardize(self, value)
     if value is None: return None
@@ -318,9 +492,11 @@ class EnumProperty(BaseProperty):
   The values you supply it initially will be the ones you get back (references
   will be kept if they are objects, so try to use basic types).
   """
+  index_suffix = "_int"
 
   def __init__(self, possible_values, required=False, unique=False, default=None,
-               validators=None, forwardprocessors=None, backwardprocessors=None):
+               validators=None, forwardprocessors=None, backwardprocessors=None,
+               index=False):
     """Initialize the Enum Property.
 
     Args:
@@ -332,7 +508,8 @@ class EnumProperty(BaseProperty):
     BaseProperty.__init__(self, required=required, unique=unique,
                                 default=default, validators=validators,
                                 forwardprocessors=forwardprocessors,
-                                backwardprocessors=backwardprocessors)
+                                backwardprocessors=backwardprocessors,
+                                index=index)
     self._map_forward = {}
     self._map_backward = {}
     for i, v in enumerate(possible_values):
@@ -373,6 +550,7 @@ class DateTimeProperty(BaseProperty):
 
   TODO: utc only feature later.
   """
+  index_suffix = "_int"
 
   def validate(self, value):
     check = False
@@ -426,7 +604,8 @@ class DynamicProperty(BaseProperty):
   """
 
 class ReferenceBaseProperty(BaseProperty):
-  def __init__(self, reference_class, collection_name=None, required=False, strict=True):
+  def __init__(self, reference_class, collection_name=None, required=False,
+               strict=True, index=False):
     """Initializes a Reference Property
 
     You can set it up so that riakkit automatically link back from
@@ -442,8 +621,10 @@ class ReferenceBaseProperty(BaseProperty):
                        ReferenceProperty. See the README file at the repository
                        for detailed tutorial.
       strict: If true, the remote object must exist. Otherwise it doesn't have to.
+      index: Keep the keys of the referenced documents in a secondary index.
+             See BaseProperty.
     """
-    BaseProperty.__init__(self, required=required)
+    BaseProperty.__init__(self, required=required, index=index)
     if not reference_class._clsType:
       raise TypeError("Reference property cannot be constructed with class '%s'" % reference_class.__name__)
 
@@ -453,11 +634,17 @@ class ReferenceBaseProperty(BaseProperty):
     self.is_reference_back = False
     self.strict = strict
 
+  def indexValue(self, value):
+    key = getattr(value, "key", value)
+    if key is None:
+      raise ValueError("None can't be looked up in an index.")
+    return self.indexValues(key)[0]
+
   def _checkForReferenceClass(self, l):
     rc = self.reference_class
 
     if isinstance(l, list):
-      for v in l:
+      for v in list.__iter__(l): # Don't load a LazyReferenceList
         if not isinstance(v, (basestring, rc)):
           return False
       return True
@@ -503,29 +690,181 @@ class ReferenceProperty(ReferenceBaseProperty):
       return False
 
     doc._data[self.name] = None
+    doc._dirty.add(self.name)
     return True
 
 class MultiReferenceProperty(ReferenceBaseProperty):
+  class LazyReferenceList(list):
+    """A list of referenced Documents that are only loaded when accessed.
+
+    Until then, the list holds their keys. len(), keys() and the membership
+    tests never touch the database. Getting items, slicing or iterating loads
+    the documents a page at a time, with the documents of a page fetched
+    concurrently. Loaded documents replace their keys in the list.
+
+    Everything that modifies the list works like a normal list, and keys as well
+    as documents can be added to it. It's equal to any list with the same keys,
+    whether that list has keys or documents.
+    """
+    def __init__(self, prop, iterable=None):
+      """Initializes the list.
+
+      Args:
+        prop: The MultiReferenceProperty this list is for.
+        iterable: The keys and/or the documents.
+      """
+      list.__init__(self, _valueOrList(iterable))
+      self.prop = prop
+
+    def keys(self):
+      """Gets the keys of all the documents without loading them."""
+      return referenceKeys(self)
+
+    def _load(self, start, stop):
+      indexes = []
+      keys = []
+      for i in xrange(start, stop):
+        value = list.__getitem__(self, i)
+        if isinstance(value, basestring):
+          indexes.append(i)
+          keys.append(value)
+
+      if keys:
+        for i, doc in zip(indexes, self.prop.loadMany(keys)):
+          list.__setitem__(self, i, doc)
+
+    def _loadPages(self, indexes):
+      """Loads the pages that have any of the given indexes."""
+      pageSize = self.prop.page_size
+      for pageStart in sorted(set(i - i % pageSize for i in indexes)):
+        self._load(pageStart, min(pageStart + pageSize, len(self)))
+
+    def _loadAll(self):
+      self._loadPages(xrange(0, len(self), self.prop.page_size))
+
+    def __getitem__(self, i):
+      if isinstance(i, slice):
+        self._loadPages(xrange(*i.indices(len(self))))
+      else:
+        if i < 0:
+          i += len(self)
+        if 0 <= i < len(self):
+          self._loadPages((i, ))
+      return list.__getitem__(self, i)
+
+    def __getslice__(self, i, j):
+      return self.__getitem__(slice(i, j))
+
+    def __iter__(self):
+      pageSize = self.prop.page_size
+      i = 0
+      while i < len(self):
+        if i % pageSize == 0:
+          self._load(i, min(i + pageSize, len(self)))
+        yield list.__getitem__(self, i)
+        i += 1
+
+    def __reversed__(self):
+      self._loadAll()
+      return list.__reversed__(self)
+
+    def __eq__(self, other):
+      if not isinstance(other, list):
+        return NotImplemented
+      return self.keys() == referenceKeys(other)
+
+    def __ne__(self, other):
+      equal = self.__eq__(other)
+      return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+      self._loadAll()
+      return list.__repr__(self)
+
+    def __contains__(self, value):
+      return getattr(value, "key", value) in self.keys()
+
+    def count(self, value):
+      return self.keys().count(getattr(value, "key", value))
+
+    def index(self, value, *args):
+      return self.keys().index(getattr(value, "key", value), *args)
+
+    def remove(self, value):
+      list.__delitem__(self, self.index(value))
+
+    def pop(self, i=-1):
+      self.__getitem__(i)
+      return list.pop(self, i)
+
+    def sort(self, *args, **kwargs):
+      self._loadAll()
+      list.sort(self, *args, **kwargs)
+
+  def __init__(self, reference_class, collection_name=None, required=False,
+               strict=True, page_size=DEFAULT_PAGE_SIZE, index=False):
+    """Initializes a MultiReferenceProperty
+
+    Args:
+      page_size: The number of documents loaded at a time when the list is
+                 accessed. Default: DEFAULT_PAGE_SIZE
+
+    Everything else is inheritted from ReferenceBaseProperty.
+    """
+    ReferenceBaseProperty.__init__(self, reference_class,
+                                   collection_name=collection_name,
+                                   required=required, strict=strict,
+                                   index=index)
+    self.page_size = page_size
+
   def convertToDb(self, value):
     value = BaseProperty.convertToDb(self, value)
-    return [] if value is None else [self.attemptToDb(v) for v in value]
+    return [] if value is None else [self.attemptToDb(v) for v in list.__iter__(value)]
+
+  def attemptLoad(self, value): # This is called when we do things like len(obj.multiprop).
+    if value is None:
+      return []
+
+    if self.clstype == 1: # SimpleDocument
+      return [ReferenceBaseProperty.attemptLoad(self, v) for v in value]
+
+    if isinstance(value, MultiReferenceProperty.LazyReferenceList) and value.prop is self:
+      return value
+
+    return MultiReferenceProperty.LazyReferenceList(self, value)
+
+  def loadMany(self, keys):
+    """Loads the documents with the given keys, concurrently.
+
+    Args:
+      keys: A list of keys.
+
+    Returns:
+      A list of documents, in the same order as keys. If not strict, keys that
+      are not found gets a new document.
+
+    Raises:
+      NotFoundError if strict and a key is not found.
+    """
+    found = {}
+    for doc in self.reference_class.getMany(keys, silent=not self.strict):
+      found[doc.key] = doc
 
-  def attemptLoad(self, value): # This is called when we do things like len(obj.multiprop). Should somehow erradicate the need for that.
-    return [] if value is None else [ReferenceBaseProperty.attemptLoad(self, v) for v in value]
+    for key in keys:
+      if key not in found:
+        found[key] = self.reference_class(key=key)
+
+    return [found[key] for key in keys]
 
   def defaultValue(self):
     return []
 
   def deleteReference(self, doc, ref):
     currentList = doc._data.get(self.name)
-    for i, r in enumerate(currentList): # TODO: Need a better search & destroy algorithm
-      if isinstance(r, self.reference_class):
-        key = r.key
-      else:
-        key = r
-
+    for i, key in enumerate(referenceKeys(currentList)): # TODO: Need a better search & destroy algorithm
       if key == ref.key:
-        currentList.pop(i) # This is a reference, which should modify the original list.
+        list.pop(currentList, i) # This is a reference, which should modify the original list.
+        doc._dirty.add(self.name)
         return True
 
     return False
@@ -573,6 +912,7 @@ class DictReferenceProperty(ReferenceBaseProperty):
     for k, r in current.iteritems():
       if r.key == ref.key:
         current.pop(k)
+        doc._dirty.add(self.name)
         return True
     return False
 
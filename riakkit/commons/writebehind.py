@@ -0,0 +1,267 @@
+# This file is part of RiakKit.
+#
+# RiakKit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RiakKit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The queue of the Document classes that have write_behind set. Their save()
+puts the serialized document in the queue, and a background thread stores what
+is in the queue.
+"""
+
+import atexit
+from collections import OrderedDict
+import os
+import sys
+import threading
+import time
+import weakref
+
+from riakkit.commons.pool import parallelMap, DEFAULT_CONCURRENCY
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_INTERVAL = 0.05
+
+_queues = weakref.WeakSet()
+
+class WriteBehindQueue(object):
+  """A bounded queue of RiakObjects to be stored, keyed by bucket and key.
+
+  Putting an object whose key is already waiting replaces the waiting one
+  (without changing its place in the queue), so a document saved many times
+  before being stored is only stored once, with its latest data.
+
+  When the queue is full, put blocks until the flusher has taken a batch out of
+  it. The flusher takes up to batch_size objects at a time and stores them
+  concurrently. Objects that fail to be stored are dropped: they are counted in
+  the stats and the last exception is kept.
+
+  Attributes:
+    max_size: The maximum number of objects waiting.
+    batch_size: The maximum number of objects stored at a time.
+    interval: How long the flusher waits for more saves to coalesce before
+              taking a batch that's not full, in seconds.
+    concurrency: The maximum number of requests at the same time.
+    last_error: The last exception raised while storing, or None.
+  """
+  def __init__(self, max_size=DEFAULT_MAX_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+               interval=DEFAULT_INTERVAL, concurrency=DEFAULT_CONCURRENCY):
+    self.max_size = max_size
+    self.batch_size = batch_size
+    self.interval = interval
+    self.concurrency = concurrency
+    self.last_error = None
+
+    self._cond = threading.Condition()
+    self._pending = OrderedDict()
+    self._inflight = set()
+    self._thread = None
+    self._pid = None
+    self._generation = 0 # Flushers of an older generation stop.
+    self._counters = {"enqueued" : 0, "coalesced" : 0, "blocked" : 0,
+                      "stored" : 0, "failed" : 0, "batches" : 0,
+                      "max_depth" : 0}
+    _queues.add(self)
+
+  def _start(self):
+    if self._thread is None or self._pid != os.getpid():
+      self._pid = os.getpid()
+      self._generation += 1
+      self._inflight = set() # Whatever was being stored is in the parent.
+      self._thread = threading.Thread(target=self._run, args=(self._generation, ))
+      self._thread.daemon = True
+      self._thread.start()
+
+  def put(self, bucket, key, data, links, indexes, w=None, dw=None, callback=None):
+    """Queues an object to be stored. Blocks while the queue is full.
+
+    Args:
+      bucket: The RiakBucket.
+      key: The key.
+      data: The data, already serialized.
+      links: A list of RiakLinks.
+      indexes: A list of (index name, value).
+      w: W value
+      dw: DW value
+      callback: Called once the object is stored (or replaced by a later put
+                and that one is stored, or discarded), with None, or with the
+                exception if the store failed. It's called in the flusher.
+    """
+    entryKey = (bucket.get_name(), key)
+    callbacks = [] if callback is None else [callback]
+    with self._cond:
+      self._start()
+      counters = self._counters
+      counters["enqueued"] += 1
+      if entryKey in self._pending:
+        callbacks = self._pending[entryKey][-1] + callbacks
+        self._pending[entryKey] = (bucket, key, data, links, indexes, w, dw, callbacks)
+        counters["coalesced"] += 1
+        return
+
+      if len(self._pending) >= self.max_size:
+        counters["blocked"] += 1
+        while len(self._pending) >= self.max_size:
+          self._cond.wait()
+
+      self._pending[entryKey] = (bucket, key, data, links, indexes, w, dw, callbacks)
+      counters["max_depth"] = max(counters["max_depth"], len(self._pending))
+      self._cond.notify_all()
+
+  def discard(self, bucketName, key):
+    """Removes an object from the queue. If it's being stored, waits until
+    it is, so that it can be deleted afterwards.
+
+    Args:
+      bucketName: The name of the bucket.
+      key: The key.
+    """
+    entryKey = (bucketName, key)
+    with self._cond:
+      entry = self._pending.pop(entryKey, None)
+      while entryKey in self._inflight:
+        self._cond.wait()
+      self._cond.notify_all()
+
+    if entry is not None:
+      _callback(entry[-1], None)
+
+  def flush(self, timeout=None):
+    """Waits until everything that's been queued so far is stored.
+
+    Args:
+      timeout: The maximum number of seconds to wait. None for forever.
+
+    Returns:
+      True if the queue is empty, False if timeout was reached first.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    with self._cond:
+      if self._pending:
+        self._start()
+
+      while self._pending or self._inflight:
+        if deadline is None:
+          self._cond.wait()
+        else:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            return False
+          self._cond.wait(remaining)
+    return True
+
+  def close(self, timeout=None):
+    """Flushes the queue and stops the flusher. It's started again by the next
+    put.
+
+    Args:
+      timeout: The maximum number of seconds to wait for the flush.
+    """
+    self.flush(timeout)
+    with self._cond:
+      thread = self._thread
+      if thread is None or self._pid != os.getpid():
+        return
+      self._generation += 1
+      self._thread = None
+      self._cond.notify_all()
+    thread.join(timeout)
+
+  def __len__(self):
+    return len(self._pending)
+
+  def stats(self):
+    """Gets the counters of this queue.
+
+    Returns:
+      A dictionary with depth (objects waiting), inflight (objects being
+      stored), max_depth, enqueued (calls to put), coalesced (puts that
+      replaced a waiting object), blocked (puts that waited for room), stored,
+      failed and batches.
+    """
+    with self._cond:
+      stats = dict(self._counters)
+      stats["depth"] = len(self._pending)
+      stats["inflight"] = len(self._inflight)
+    return stats
+
+  def _store(self, entry):
+    bucket, key, data, links, indexes, w, dw, callbacks = entry
+    try:
+      robj = bucket.new(key, data)
+      robj.set_links(links, True)
+      robj.set_indexes(indexes)
+      robj.store(w=w, dw=dw)
+    except Exception:
+      error = sys.exc_info()[1]
+    else:
+      error = None
+
+    _callback(callbacks, error)
+    return error
+
+  def _run(self, generation):
+    while True:
+      with self._cond:
+        while not self._pending or generation != self._generation:
+          if generation != self._generation:
+            return
+          self._cond.wait()
+        full = len(self._pending) >= self.batch_size
+
+      if not full and self.interval:
+        time.sleep(self.interval)
+
+      with self._cond:
+        batch = []
+        while self._pending and len(batch) < self.batch_size:
+          batch.append(self._pending.popitem(last=False))
+        self._inflight.update(entryKey for entryKey, entry in batch)
+        self._cond.notify_all()
+
+      if not batch: # Discarded while waiting.
+        continue
+
+      errors = parallelMap(self._store, [entry for entryKey, entry in batch], self.concurrency)
+
+      with self._cond:
+        failed = [e for e in errors if e is not None]
+        self._counters["batches"] += 1
+        self._counters["stored"] += len(batch) - len(failed)
+        self._counters["failed"] += len(failed)
+        if failed:
+          self.last_error = failed[-1]
+        self._inflight.difference_update(entryKey for entryKey, entry in batch)
+        self._cond.notify_all()
+
+def _callback(callbacks, error):
+  for f in callbacks:
+    try:
+      f(error)
+    except Exception:
+      pass
+
+def flushAll(timeout=None):
+  """Waits until every write behind queue is empty.
+
+  Args:
+    timeout: The maximum number of seconds to wait for each queue.
+  """
+  for queue in list(_queues):
+    queue.flush(timeout)
+
+def _closeAll():
+  for queue in list(_queues):
+    queue.close()
+
+atexit.register(_closeAll)
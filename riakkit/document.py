@@ -13,12 +13,19 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import OrderedDict
 from copy import copy
-from weakref import WeakValueDictionary
-
-from riakkit.simple.basedocument import BaseDocumentMetaclass, BaseDocument, SimpleDocument
-from riakkit.commons.properties import BaseProperty, MultiReferenceProperty, ReferenceProperty
-from riakkit.commons import uuid1Key, getUniqueListGivenBucketName, getProperty, walkParents
+import datetime
+import threading
+
+from riakkit.simple.basedocument import BaseDocumentMetaclass, BaseDocument, SimpleDocument, DEFAULT_CONVERTER, compileSchema
+from riakkit.commons.properties import BaseProperty, MultiReferenceProperty, ReferenceProperty, NONE_TYPE, referenceKeys
+from riakkit.commons import uuid1Key, getUniqueListGivenBucketName, getProperty, mergeParentSchemas, mediocreCopy
+from riakkit.commons.pool import parallelMap, submit, DEFAULT_CONCURRENCY
+from riakkit.commons.cache import newCache, StrongCache
+from riakkit.commons.bloom import newFilter, DEFAULT_ERROR_RATE
+from riakkit.commons.writebehind import WriteBehindQueue
+from riakkit.journal import storeOp, deleteOp, UNKNOWN_VCLOCK
 from riakkit.queries import *
 from riakkit.commons.exceptions import *
 
@@ -26,6 +33,15 @@ from riak import RiakObject
 from riak.mapreduce import RiakLink
 
 _document_classes = {}
+_local = threading.local()
+# Held while a document is looked up in instances and, if it's not there,
+# created and put in it, as the background calls can load the same key at the
+# same time. Reentrant, as populating a document can load others.
+_buildLock = threading.RLock()
+
+# Values of these types can only be changed by setting the attribute, which is
+# tracked by BaseDocument. Anything else could have been modified in place.
+_IMMUTABLE_TYPES = (basestring, int, long, float, bool, datetime.datetime, NONE_TYPE)
 
 def getClassGivenBucketName(bucket_name):
   """Gets the class associated with a bucket name.
@@ -42,6 +58,221 @@ def getClassGivenBucketName(bucket_name):
   return _document_classes[bucket_name]
 
 
+class BucketsDescriptor(object):
+  """Gets the RiakBuckets of a Document class, {bucket name : RiakBucket}.
+
+  Nothing is done with the client when the class is defined. The buckets are
+  created on first use and cached on the class. They're created again if the
+  client of the class is replaced.
+  """
+  def __get__(self, doc, cls):
+    cache = cls.__dict__.get("_bucketsCache", None)
+    client = cls.client
+    if cache is None or cache[0] is not client:
+      names = cls.__dict__.get("_bucketNames", [])
+      cache = (client, dict((bn, client.bucket(bn)) for bn in names))
+      cls._bucketsCache = cache
+    return cache[1]
+
+class BucketDescriptor(object):
+  """Gets the default RiakBucket of a Document class, the one of the first
+  bucket name. A class without a bucket_name uses the one of its parent."""
+  def __get__(self, doc, cls):
+    for c in cls.__mro__:
+      names = c.__dict__.get("_bucketNames", None)
+      if names:
+        return c.buckets[names[0]]
+    raise AttributeError("'%s' has no bucket_name." % cls.__name__)
+
+class InstancesDescriptor(object):
+  """Gets the cache of the documents of a Document class.
+
+  Inside a session, this is the identity map of the session for the class
+  instead. See Session.
+  """
+  def __get__(self, doc, cls):
+    cache = cls._instances
+    s = currentSession()
+    if s is None:
+      return cache
+    return s.identityMap(cache)
+
+def currentSession():
+  """Gets the session active in this thread.
+
+  Returns:
+    A Session, or None.
+  """
+  return getattr(_local, "session", None)
+
+def session(concurrency=DEFAULT_CONCURRENCY):
+  """Starts a session, to be used with the with statement:
+
+    with riakkit.session():
+      user = User.get(key)
+      user.name = "foo"
+      user.save()
+      comment = Comment(author=user).save()
+
+  If a session is already active in this thread, that session is used instead
+  and it's only flushed when it ends.
+
+  Args:
+    concurrency: The maximum number of requests at the same time when the
+                 session is flushed.
+
+  Returns:
+    A Session.
+  """
+  s = currentSession()
+  if s is None:
+    s = Session(concurrency)
+  return s
+
+class Session(object):
+  """A unit of work, usually a request. See session().
+
+  While a session is active in a thread:
+
+    - instances of every Document class is an identity map that belongs to the
+      session. Documents loaded in the session are shared within it, and are
+      forgotten when it ends instead of staying in the cache of the class.
+    - save() and delete() don't do anything right away. They're done when the
+      session ends, all at once: a document is saved once no matter how many
+      times save() was called on it, and the documents modified through
+      collection_name are saved once, with the rest. The unique checks and the
+      stores are done concurrently. A document that is deleted is not saved.
+
+  If the with block raises, nothing is saved or deleted.
+
+  The background calls (the a* methods of Document) made in the session are
+  run in it too. When the session ends, it waits for them to be done before
+  saving and deleting.
+
+  Since nothing is sent to the database until the session ends, that's also
+  when ValidationError and IntegrityError are raised.
+
+  Attributes:
+    concurrency: The maximum number of requests at the same time.
+  """
+  def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+    self.concurrency = concurrency
+    self.flushing = False
+    self._depth = 0
+    self._maps = {}
+    self._saves = OrderedDict()
+    self._deletes = OrderedDict()
+    self._lock = threading.Lock()
+    self._futures = set()
+
+  def identityMap(self, cache):
+    """Gets the identity map that replaces a cache of a Document class.
+
+    Args:
+      cache: The cache of the class.
+
+    Returns:
+      A StrongCache.
+    """
+    try:
+      return self._maps[cache]
+    except KeyError:
+      return self._maps.setdefault(cache, StrongCache())
+
+  def addSave(self, doc, w=None, dw=None, endpoint=False, bucket=None):
+    """Schedules a document to be saved. See Document.save"""
+    with self._lock: # The background calls of the session add to it too.
+      self._deletes.pop(id(doc), None)
+      self._saves[id(doc)] = (doc, w, dw, endpoint, bucket)
+
+  def addDelete(self, doc, rw=None):
+    """Schedules a document to be deleted. See Document.delete"""
+    with self._lock:
+      self._saves.pop(id(doc), None)
+      self._deletes[id(doc)] = (doc, rw)
+
+  def track(self, future):
+    """Makes the session wait for a background call before it ends.
+
+    Args:
+      future: The Future of the call.
+    """
+    with self._lock:
+      self._futures.add(future)
+    future.addDoneCallback(self._untrack)
+
+  def _untrack(self, future):
+    with self._lock:
+      self._futures.discard(future)
+
+  def wait(self):
+    """Waits until the background calls made in the session are done, including
+    the ones they make. What they raise is left to their futures."""
+    while True:
+      with self._lock:
+        futures = list(self._futures)
+      if not futures:
+        return
+
+      for future in futures:
+        future.exception()
+
+  def flush(self):
+    """Does the saves and the deletes scheduled so far.
+
+    Raises:
+      ValidationError or IntegrityError, see Document.saveMany.
+    """
+    with self._lock:
+      saves = self._saves.values()
+      deletes = self._deletes.values()
+      self._saves = OrderedDict()
+      self._deletes = OrderedDict()
+
+    self.flushing = True
+    try:
+      batches = OrderedDict()
+      for doc, w, dw, endpoint, bucket in saves:
+        batches.setdefault((w, dw, bucket), []).append((doc, endpoint))
+
+      for (w, dw, bucket), batch in batches.iteritems():
+        Document._saveBatch(batch, w, dw, bucket, self.concurrency)
+
+      byRw = OrderedDict()
+      for doc, rw in deletes:
+        byRw.setdefault(rw, []).append(doc)
+
+      for rw, docs in byRw.iteritems():
+        Document.deleteMany(docs, rw, self.concurrency)
+    finally:
+      self.flushing = False
+
+  def close(self):
+    """Forgets the identity maps and anything that hasn't been flushed."""
+    with self._lock:
+      self._maps = {}
+      self._saves = OrderedDict()
+      self._deletes = OrderedDict()
+
+  def __enter__(self):
+    if self._depth == 0:
+      _local.session = self
+    self._depth += 1
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self._depth -= 1
+    if self._depth > 0:
+      return
+
+    try:
+      self.wait()
+      if type is None:
+        self.flush()
+    finally:
+      self.close()
+      _local.session = None
+
 class DocumentMetaclass(BaseDocumentMetaclass):
   """Meta class that the Document class is made from.
 
@@ -56,8 +287,8 @@ class DocumentMetaclass(BaseDocumentMetaclass):
     if client is None:
       return type.__new__(cls, clsname, parents, attrs)
 
-    meta = {}
-    uniques = []
+    meta = mergeParentSchemas(parents)
+    ownUniques = []
     references_col_classes = []
     references = []
 
@@ -76,16 +307,12 @@ class DocumentMetaclass(BaseDocumentMetaclass):
           references_col_classes.append((colname, prop.reference_class, name))
           references.append(name)
         elif prop.unique: # Unique is not allowed with anything that has backref
-          prop.unique_bucket = client.bucket(getUniqueListGivenBucketName(attrs["bucket_name"], name))
-          uniques.append(name)
-
-    all_parents = reversed(walkParents(parents))
-    for p_cls in all_parents:
-      meta.update(p_cls._meta)
-      uniques.extend(p_cls._uniques)
+          ownUniques.append(name)
 
     attrs["_meta"] = meta
-    attrs["_uniques"] = uniques
+    # Unique is not allowed with anything that has backref
+    attrs["_uniques"] = [n for n, p in meta.iteritems()
+                         if p.unique and not getattr(p, "collection_name", False)]
 
     # I know why you're here. It took you 1938402 years to finally get here and
     # you want to know what .instances does. Before you vencture onto the next
@@ -99,14 +326,36 @@ class DocumentMetaclass(BaseDocumentMetaclass):
     # written. You may not trust me anymore after the next line... in fact, I
     # don't even trust myself... but riakkit-ng is probably going to be better.
 
-    attrs["instances"] = WeakValueDictionary()
+    attrs["_instances"] = newCache(getProperty("cache_size", attrs, parents),
+                                  getProperty("cache_ttl", attrs, parents))
     attrs["_references"] = references
 
     new_class = type.__new__(cls, clsname, parents, attrs)
+    compileSchema(new_class)
+
+    for name in ownUniques:
+      meta[name].bindUniqueBucket(new_class, getUniqueListGivenBucketName(attrs["bucket_name"], name))
 
     bucket_name = attrs.get("bucket_name", None)
 
-    new_class.buckets = {}
+    # The RiakBuckets are created when they're first used. See BucketsDescriptor.
+    new_class._bucketNames = []
+    new_class._bucketsCache = None
+    new_class._keyFilters = {}
+
+    new_class._writeBehind = None
+    if getProperty("write_behind", attrs, parents):
+      if new_class._uniques:
+        raise RiakkitError("%s can't have unique properties with write_behind." % clsname)
+
+      options = {}
+      for option, argument in (("write_behind_size", "max_size"),
+                               ("write_behind_batch_size", "batch_size"),
+                               ("write_behind_interval", "interval")):
+        value = getProperty(option, attrs, parents)
+        if value is not None:
+          options[argument] = value
+      new_class._writeBehind = WriteBehindQueue(**options)
 
     if bucket_name is not None:
       if isinstance(bucket_name, basestring):
@@ -119,18 +368,14 @@ class DocumentMetaclass(BaseDocumentMetaclass):
         else:
           _document_classes[bn] = new_class
 
-        new_class.buckets[bn] = client.bucket(bn)
-
-      if len(new_class.buckets) == 1:
-        new_class.bucket = new_class.buckets.values()[0]
-      else:
-        new_class.bucket = new_class.buckets[bucket_name[0]]
+      new_class._bucketNames = list(bucket_name)
 
     for colname, rcls, back_name in references_col_classes:
       rcls._meta[colname] = MultiReferenceProperty(reference_class=new_class)
       rcls._meta[colname].name = colname
       rcls._meta[colname].is_reference_back = back_name
       rcls._references.append(colname)
+      compileSchema(rcls)
 
     return new_class
 
@@ -149,11 +394,42 @@ class Document(SimpleDocument):
 
   Class variables that's an instance of the BaseType will be the schema of the
   document.
+
+  instances is the cache of the documents of a class, used by get and getMany.
+  By default, a document is only kept in there for as long as something else
+  references it. Set cache_size to keep up to that many recently used documents
+  instead, and cache_ttl to expire them after that many seconds (cache_ttl
+  alone keeps every document until it expires). Note that
+  creating a new document with a key that's still cached raises a KeyError.
+  instances.stats() gives the hit, miss and eviction counters. Inside a
+  session, instances is the identity map of the session instead. See Session.
+
+  Set write_behind to True for documents that are saved often and can afford
+  to be lost, like activity records. save() then only queues the document and
+  returns. A background thread stores the queue in batches, with a document
+  saved many times while it's waiting only stored once. See
+  riakkit.commons.writebehind.WriteBehindQueue. write_behind_size (the
+  maximum number of documents waiting, save() blocks when it's reached),
+  write_behind_batch_size and write_behind_interval configure the queue. The
+  queue is flushed at exit, or with flushWriteBehind(). Until a document is
+  stored, getting it from the database won't find it or find an older version,
+  and store errors are only counted in writeBehindStats(). Unique properties
+  can't be used with write_behind.
+
+  Set journal to a riakkit.journal.Journal to have every save write its plan
+  there before writing anything to the database, so that a save that fails or
+  is interrupted half way through can be finished with replayJournal(). With
+  write_behind, the journal also keeps what's in the queue.
   """
 
   __metaclass__ = DocumentMetaclass
   _clsType = 2
 
+  buckets = BucketsDescriptor()
+  bucket = BucketDescriptor()
+  instances = InstancesDescriptor()
+  journal = None
+
   def __init__(self, key=uuid1Key, saved=False, **kwargs):
     """Creates a new document from a bunch of keyword arguments.
 
@@ -178,6 +454,9 @@ class Document(SimpleDocument):
     self.__dict__["key"] = key
 
     self._obj = self.bucket.get(self.key) if saved else None
+    self._savedData = mediocreCopy(self._obj.get_data()) if saved else None
+    self._vclock = None
+    self._hydrated = False
     self._links = set()
     self._indexes = {}
 
@@ -204,36 +483,308 @@ class Document(SimpleDocument):
                 that's modified while modifying this one. Default: False
       bucket: Save to a specific bucket. Default is the default bucket. Only
               has an effect if the document is new.
+
+    If nothing has changed since the document was last loaded or saved,
+    nothing is done.
+
+    Inside a session, the document is only saved when the session ends. See
+    Session.
     """
+    s = currentSession()
+    if s is not None and not s.flushing:
+      s.addSave(self, w, dw, endpoint, bucket)
+      return self
+
+    self._fetchHydrated()
+    changed = self._changedFields()
+    if self._unchanged(changed):
+      return self
+
     dataToBeSaved = self.serialize()
-    uniquesToBeDeleted = []
-    othersToBeSaved = []
+    uniquesToBeDeleted = self._checkUniques(dataToBeSaved, changed)
+    othersToBeSaved = self._processReferences(changed)
+    planId = self._store(dataToBeSaved, uniquesToBeDeleted, w, dw, bucket,
+                         changed, others=[] if endpoint else othersToBeSaved)
+
+    try:
+      if not endpoint: # CODE-REVIEW: Total hackjob. This gotta be redone
+        for doc, end in othersToBeSaved:
+          doc.save(w, dw, end)
+    except Exception:
+      self._releasePlan(planId)
+      raise
+
+    self._finishPlan(planId)
+    return self
+
+  @staticmethod
+  def saveMany(docs, w=None, dw=None, bucket=None, concurrency=DEFAULT_CONCURRENCY):
+    """Saves many documents at once.
+
+    This does the same thing as calling save() on every document, but the
+    unique checks and the stores of all the documents are done concurrently.
+    The documents modified while saving these documents (through
+    collection_name) are saved along with them, once each, no matter how many
+    of the documents modified them, even if they're in docs too.
+
+    Args:
+      docs: A list of Documents. They don't have to be of the same class.
+      w: W value
+      dw: DW value
+      bucket: Same as save(). Only applies to docs, not to the documents saved
+              through collection_name.
+      concurrency: The maximum number of requests at the same time.
+
+    Returns:
+      docs
+
+    Raises:
+      ValidationError if any of the documents does not validate.
+      IntegrityError if any of the documents breaks uniqueness, including
+      two of them having the same unique value.
+      In both cases, none of docs will be saved.
+    """
+    Document._saveBatch([(doc, False) for doc in docs], w, dw, bucket, concurrency)
+    return docs
 
-    # Process uniques
+  @staticmethod
+  def _saveBatch(batch, w=None, dw=None, bucket=None, concurrency=DEFAULT_CONCURRENCY):
+    """Does saveMany.
+
+    Args:
+      batch: A list of (document, endpoint), see save().
+      Everything else: Same as saveMany.
+    """
+    plans = []
+    try:
+      Document._saveDocs(batch, w, dw, bucket, concurrency, plans)
+    except Exception:
+      for doc, planId in plans:
+        doc._releasePlan(planId)
+      raise
+
+    for doc, planId in plans:
+      doc._finishPlan(planId)
+
+  @staticmethod
+  def _saveDocs(batch, w, dw, bucket, concurrency, plans):
+    """Does _saveBatch, adding (document, plan id) to plans for the documents
+    with a journal."""
+    hydrated = [doc for doc, end in batch if doc._hydrated]
+    parallelMap(lambda doc: doc._obj.reload(), hydrated, concurrency)
+    for doc in hydrated:
+      doc._fetchHydrated(True)
+
+    current = []
+    changes = []
+    saving = set() # id(document), for those in current
+    endpoints = {} # id(document) : endpoint
+    others = {} # id(document) : the return value of its _processReferences
+    modified = set() # id(document), for those modified by _processReferences
+
+    def add(doc, end):
+      known = id(doc) in endpoints
+      wasEndpoint = endpoints.get(id(doc), True)
+      endpoints[id(doc)] = wasEndpoint and end if known else end
+      if id(doc) in saving:
+        if wasEndpoint and not end: # The documents it modified are saved now.
+          for other, otherEnd in others.get(id(doc), ()):
+            modified.add(id(other))
+            add(other, otherEnd)
+        return
+
+      doc._fetchHydrated()
+      changed = doc._changedFields()
+      if not doc._unchanged(changed):
+        saving.add(id(doc))
+        current.append(doc)
+        changes.append(changed)
+
+    for doc, end in batch:
+      add(doc, end)
+
+    claims = {} # (unique bucket name, value) : document
+    def checkUniques(start, datas):
+      for i in xrange(start, len(current)):
+        doc = current[i]
+        for name in doc._uniqueChanges(changes[i])[0]:
+          claim = (doc._meta[name].unique_bucket.get_name(), doc._data[name])
+          if claims.setdefault(claim, doc) is not doc:
+            raise IntegrityError(
+              field=name,
+              message="'%s' is given to more than one document for '%s'!" % (doc._data[name], name)
+            )
+
+      return parallelMap(lambda i: current[i]._checkUniques(datas[i], changes[i]),
+                         range(start, len(current)), concurrency)
+
+    # Nothing is modified until the documents given are known to be valid.
+    initial = len(current)
+    datas = [doc.serialize() for doc in current]
+    uniquesToBeDeleted = checkUniques(0, datas)
+
+    # The documents modified through collection_name are saved along with the
+    # others, once each, with all of their modifications.
+    i = 0
+    while i < len(current):
+      doc = current[i]
+      others[id(doc)] = doc._processReferences(changes[i])
+      if not endpoints[id(doc)]:
+        for other, end in others[id(doc)]:
+          modified.add(id(other))
+          add(other, end)
+      i += 1
+
+    for i in xrange(initial):
+      if id(current[i]) in modified:
+        datas[i] = current[i].serialize()
+    datas.extend(doc.serialize() for doc in current[initial:])
+    uniquesToBeDeleted.extend(checkUniques(initial, datas))
+
+    def store(i):
+      doc = current[i]
+      planId = doc._store(datas[i], uniquesToBeDeleted[i], w, dw,
+                          bucket if i < initial else None, changes[i],
+                          others=[] if endpoints[id(doc)] else others[id(doc)])
+      if planId is not None:
+        plans.append((doc, planId))
+
+    parallelMap(store, range(len(current)), concurrency)
+
+  def _changedFields(self):
+    """Finds the fields that changed since the document was last loaded or
+    saved.
+
+    Fields that are set are tracked as they are set. Fields holding mutable
+    values could have been modified in place, so those are compared against
+    a copy of the data that was last loaded or saved.
+
+    Returns:
+      None if the document has never been saved. Otherwise the set of names of
+      the changed fields.
+    """
+    if self._obj is None or self._savedData is None:
+      return None
+
+    originalData = self._savedData
+    changed = set(self._dirty)
+    for name, value in self._data.iteritems():
+      if name in changed or isinstance(value, _IMMUTABLE_TYPES):
+        continue
+
+      prop = self._meta.get(name, None)
+      converter = DEFAULT_CONVERTER if prop is None else prop.convertToDb
+      if converter(value) != originalData.get(name, None):
+        changed.add(name)
+
+    return changed
+
+  def _unchanged(self, changed):
+    """Checks if there's nothing to save.
+
+    Args:
+      changed: The return value of _changedFields
+
+    Returns:
+      True if no fields, links or indexes have changed since the document was
+      last loaded or saved.
+    """
+    if changed is None or changed:
+      return False
+
+    # riak-python-client keeps index values as strings, addIndex doesn't.
+    strings = lambda indexes: dict((field, set(str(v) for v in values)) for field, values in indexes.iteritems())
+    if strings(self._getIndexesFromRiakObj(self._obj)) != strings(self._indexes):
+      return False
+
+    links = set((d.key, t) for d, t in self._links)
+    links.update((k, t) for b, k, t in self._unresolvedLinks)
+    return links == set((l.get_key(), l.get_tag()) for l in self._obj.get_links())
+
+  def _checkUniques(self, dataToBeSaved, changed=None, concurrency=DEFAULT_CONCURRENCY):
+    """Checks the unique properties of this document against the database.
+
+    The values are checked concurrently. If more than one is taken, the error
+    is about the first one in _uniques.
+
+    Args:
+      dataToBeSaved: The serialized data of this document.
+      changed: The return value of _changedFields. Unique properties that
+               haven't changed are not checked.
+      concurrency: The maximum number of requests at the same time.
+
+    Returns:
+      A list of (unique_bucket, value) that needs to be released after the
+      document is stored.
+
+    Raises:
+      IntegrityError if a unique value is taken.
+    """
+    toBeChecked, uniquesToBeDeleted = self._uniqueChanges(changed)
+    taken = parallelMap(lambda name: self._meta[name].hasValue(dataToBeSaved[name]),
+                        toBeChecked, concurrency)
+    for name, exists in zip(toBeChecked, taken):
+      if exists:
+        raise IntegrityError(
+          field=name,
+          message="'%s' already exists for '%s'!" % (self._data[name], name)
+        )
+
+    return uniquesToBeDeleted
+
+  def _uniqueChanges(self, changed=None):
+    """Finds the unique values this document claims and releases when saved.
+
+    Args:
+      changed: The return value of _changedFields.
+
+    Returns:
+      (the names of the unique properties whose values need to be checked,
+       a list of (unique_bucket, value) that needs to be released)
+    """
+    uniquesToBeDeleted = []
+    toBeChecked = []
+    originalData = self._obj.get_data() if self._obj else None
     for name in self._uniques:
+      if changed is not None and name not in changed:
+        continue
+
       if self._data.get(name, None) is None:
         if self._obj: # TODO: could be somehow refactored, as this condition is always true?
-          originalValue = self._obj.get_data().get(name, None)
+          originalValue = originalData.get(name, None)
           if originalValue is not None:
             uniquesToBeDeleted.append((self._meta[name].unique_bucket, originalValue))
       else:
-        changed = False
+        valueChanged = False
         if self._obj:
-          originalValue = self._obj.get_data().get(name, None)
+          originalValue = originalData.get(name, None)
           if self._data[name] != originalValue and originalValue is not None:
             uniquesToBeDeleted.append((self._meta[name].unique_bucket, originalValue))
-            changed = True
+            valueChanged = True
         else:
-          changed = True
+          valueChanged = True
 
-        if changed and self._meta[name].unique_bucket.get(dataToBeSaved[name]).exists():
-          raise IntegrityError(
-            field=name,
-            message="'%s' already exists for '%s'!" % (self._data[name], name)
-          )
+        if valueChanged:
+          toBeChecked.append(name)
 
-    # Process references
+    return toBeChecked, uniquesToBeDeleted
+
+  def _processReferences(self, changed=None):
+    """Updates the collections of the documents this document references.
+
+    Args:
+      changed: The return value of _changedFields. References that haven't
+               changed are skipped.
+
+    Returns:
+      A list of (document, endpoint) that has been modified and needs to be
+      saved.
+    """
+    othersToBeSaved = []
     for name in self._references:
+      if changed is not None and name not in changed:
+        continue
+
       currentDocsKeys = None
       strict = self._meta[name].strict
       colname = self._meta[name].collection_name
@@ -252,14 +803,10 @@ class Document(SimpleDocument):
           currentDocsKeys.add(doc.key)
 
           currentList = getattr(doc, colname, [])
-          found = False # Linear search algorithm. Maybe binary search??
-          for d in currentList:
-            if d.key == self.key:
-              found = True
-              break
-          if not found:
+          if self.key not in referenceKeys(currentList):
             currentList.append(self)
             doc._data[colname] = currentList
+            doc._dirty.add(colname)
             othersToBeSaved.append((doc, False))
 
 
@@ -274,12 +821,8 @@ class Document(SimpleDocument):
           originalValues = []
 
         if currentDocsKeys is None:
-          currentDocsKeys = set()
-          for d in self._data[name]:
-            if d is None:
-              continue
-            else:
-              currentDocsKeys.add(getattr(d, "key", d))
+          currentDocsKeys = set(referenceKeys(self._data[name]))
+          currentDocsKeys.discard(None)
 
         for dockey in originalValues:
           if dockey is None:
@@ -295,34 +838,134 @@ class Document(SimpleDocument):
             if doc._meta[colname].deleteReference(doc, self):
               othersToBeSaved.append((doc, True)) # CODE-REVIEW: For some reason i feel this won't work for some cases.
 
+    return othersToBeSaved
+
+  def _store(self, dataToBeSaved, uniquesToBeDeleted, w=None, dw=None, bucket=None,
+             changed=None, concurrency=DEFAULT_CONCURRENCY, others=()):
+    """Stores the document, claims its unique values and releases the old ones.
 
+    Once the document is stored, the unique values are claimed and released
+    concurrently.
+
+    If the class has a journal, the plan of all of that, and of the stores of
+    others, is written to it first.
+
+    Args:
+      dataToBeSaved: The serialized data of this document.
+      uniquesToBeDeleted: The return value of _checkUniques
+      w: W value
+      dw: DW value
+      bucket: Same as save()
+      changed: The return value of _changedFields. Only the unique values that
+               changed are claimed.
+      concurrency: The maximum number of requests at the same time.
+      others: The return value of _processReferences, if the caller is going
+              to save them.
+
+    Returns:
+      The id of the plan in the journal, to be given to _finishPlan once
+      others are saved, or None if there's no journal.
+    """
     if self._obj:
       self._obj.set_data(dataToBeSaved)
     else:
       bucket = self.buckets.get(bucket, self.bucket)
       self._obj = bucket.new(self.key, dataToBeSaved)
 
-    self._obj.set_links(self.links(True), True)
-    self._obj.set_indexes(self.indexes())
+    links = self.links(True)
+    indexes = self._indexesToBeSaved(dataToBeSaved)
+    self._obj.set_links(links, True)
+    self._obj.set_indexes(indexes)
     self.key = self._obj.get_key()
 
-    self._obj.store(w=w, dw=dw)
+    claimed = []
     for name in self._uniques:
-      if self._data[name] and not self._meta[name].unique_bucket.get(self._data[name]).exists():
-        obj = self._meta[name].unique_bucket.new(self._data[name], {"key" : self.key})
-        obj.store(w=w, dw=dw)
+      if changed is not None and name not in changed:
+        continue
+
+      if self._data[name]:
+        claimed.append(name)
+
+    planId = None
+    if self.journal is not None:
+      ops = [storeOp(self._obj.get_bucket().get_name(), self.key, dataToBeSaved, links, indexes,
+                     self._journalVclock())]
+      ops.extend(storeOp(self._meta[name].unique_bucket.get_name(), self._data[name], {"key" : self.key})
+                 for name in claimed)
+      ops.extend(deleteOp(b.get_name(), key) for b, key in uniquesToBeDeleted)
+      ops.extend(doc._storeOp() for doc, end in others)
+      # With write_behind, the flusher does the other part.
+      planId = self.journal.begin(ops, 1 if self._writeBehind is None else 2)
 
-    for bucket, key in uniquesToBeDeleted:
-      bucket.get(key).delete()
+    try:
+      self._write(dataToBeSaved, links, indexes, claimed, uniquesToBeDeleted,
+                  w, dw, concurrency, planId)
+    except Exception:
+      self._releasePlan(planId)
+      raise
 
     self.saved = True
     self.deleted = False
+    self._savedData = mediocreCopy(dataToBeSaved)
+    self._vclock = self._obj.vclock()
+    self._dirty = set()
+    return planId
+
+  def _write(self, dataToBeSaved, links, indexes, claimed, uniquesToBeDeleted,
+             w, dw, concurrency, planId):
+    """Does the requests of _store."""
+    if self._writeBehind is None:
+      self._obj.store(w=w, dw=dw)
+    else:
+      callback = None
+      if planId is not None:
+        def callback(error):
+          if error is None:
+            self._finishPlan(planId)
+          else:
+            self._releasePlan(planId)
+
+      self._writeBehind.put(self._obj.get_bucket(), self.key, dataToBeSaved,
+                            links, indexes, w, dw, callback)
+    keyFilter = self._keyFilters.get(self._obj.get_bucket().get_name(), None)
+    if keyFilter is not None:
+      keyFilter.add(self.key)
+
+    def claim(name):
+      prop = self._meta[name]
+      if not prop.hasValue(self._data[name]):
+        prop.unique_bucket.new(self._data[name], {"key" : self.key}).store(w=w, dw=dw)
+      if prop.filter is not None:
+        prop.filter.add(self._data[name])
+
+    def release(unique):
+      bucket, key = unique
+      bucket.get(key).delete()
 
-    if not endpoint: # CODE-REVIEW: Total hackjob. This gotta be redone
-      for doc, end in othersToBeSaved:
-        doc.save(w, dw, end)
+    tasks = [(claim, name) for name in claimed]
+    tasks.extend((release, unique) for unique in uniquesToBeDeleted)
+    parallelMap(lambda task: task[0](task[1]), tasks, concurrency)
 
-    return self
+  def _storeOp(self):
+    """The journal operation that stores this document as it is now."""
+    data = self.serialize()
+    bucket = self._obj.get_bucket() if self._obj else self.bucket
+    return storeOp(bucket.get_name(), self.key, data, self.links(True),
+                   self._indexesToBeSaved(data), self._journalVclock())
+
+  def _journalVclock(self):
+    """The vclock of the object the next store replaces, for the journal."""
+    if self._writeBehind is not None: # The flusher stores other RiakObjects.
+      return UNKNOWN_VCLOCK
+    return self._obj.vclock() if self._obj else None
+
+  def _finishPlan(self, planId):
+    if planId is not None:
+      self.journal.done(planId)
+
+  def _releasePlan(self, planId):
+    if planId is not None:
+      self.journal.release(planId)
 
   def reload(self, r=None, vtag=None):
     """Reloads the object from the database.
@@ -333,6 +976,10 @@ class Document(SimpleDocument):
 
     This only works if the object has been saved at least once before.
 
+    If the object in the database has the same vclock as when this document
+    was last loaded or saved, and the document hasn't been modified since, the
+    document is left as is instead of being deserialized again.
+
     Returns:
       self for OOP.
 
@@ -344,14 +991,73 @@ class Document(SimpleDocument):
       if not self._obj.exists():
         self._deleted()
       else:
-        self.saved = True
-        self.deleted = False
-        self.deserialize(self._obj.get_data())
-        self.setIndexes(self._getIndexesFromRiakObj(self._obj))
-        self.setLinks(self._getLinksFromRiakObj(self._obj))
+        self._populate(self._obj)
     else:
       raise NotFoundError("Object not saved!")
 
+  def _populate(self, robj):
+    """Fills this document from a RiakObject that's already been fetched.
+
+    No requests are made to the database for this document itself. If the
+    RiakObject has the vclock this document was last populated or saved with,
+    its data is what was last loaded or saved (a save keeps the data as it was
+    before the JSON round trip, e.g. with int dict keys) and the document
+    hasn't been modified, nothing needs to be done.
+
+    Args:
+      robj: A RiakObject that exists in the database.
+
+    Returns:
+      self for OOP.
+    """
+    self._hydrated = False
+    vclock = robj.vclock()
+    if (vclock is not None and vclock == self._vclock and robj.get_data() == self._savedData and
+        self._unchanged(self._changedFields())):
+      self._obj = robj
+      return self
+
+    self._vclock = vclock
+    self._obj = robj
+    self.saved = True
+    self.deleted = False
+    self.deserialize(robj.get_data())
+    self._savedData = mediocreCopy(robj.get_data())
+    self._dirty = set()
+    self.setIndexes(self._getIndexesFromRiakObj(robj))
+    self.setLinks(set())
+    self._unresolvedLinks = self._getLinksFromRiakObj(robj)
+    return self
+
+  def _fetchHydrated(self, fetched=False):
+    """Fetches what a document built from search results doesn't have.
+
+    Those documents only have their data. Their RiakObject (with the vclock,
+    links and indexes) is fetched the first time it's needed: before saving and
+    before the links or the indexes are read or modified. The data of the
+    document is kept as is.
+
+    Args:
+      fetched: True if self._obj has already been reloaded.
+    """
+    if not self._hydrated:
+      return
+
+    self._hydrated = False
+    if not fetched:
+      self._obj.reload()
+
+    if not self._obj.exists():
+      self._obj = None
+      self._savedData = None
+      return
+
+    self._vclock = self._obj.vclock()
+    self._savedData = mediocreCopy(self._obj.get_data())
+    self._indexes = self._getIndexesFromRiakObj(self._obj)
+    self._links = set()
+    self._unresolvedLinks = self._getLinksFromRiakObj(self._obj)
+
   def _deleteBackRef(self, col_name, docs):
     docs_to_be_saved = []
     for doc in docs:
@@ -365,52 +1071,191 @@ class Document(SimpleDocument):
 
     However, this object can still be resaved. Not sure what you would do
     with it, though.
+
+    Inside a session, the document is only deleted when the session ends. See
+    Session.
+    """
+    s = currentSession()
+    if s is not None and not s.flushing:
+      s.addDelete(self, rw)
+      return
+
+    Document.deleteMany([self], rw)
+
+  @staticmethod
+  def deleteMany(docs, rw=None, concurrency=DEFAULT_CONCURRENCY):
+    """Deletes many documents at once.
+
+    This does the same thing as calling delete() on every document, but the
+    objects are deleted concurrently, then their unique values are released
+    concurrently, and the documents that referenced them are saved with
+    saveMany.
+
+    Args:
+      docs: A list of Documents. They don't have to be of the same class.
+      rw: RW value
+      concurrency: The maximum number of requests at the same time.
     """
+    # By key, as another instance of a document being deleted (e.g. from
+    # another session) may be among the documents that reference it.
+    deleting = set()
+    toBeDeleted = []
+    for doc in docs:
+      if doc._obj is not None and (doc.__class__, doc.key) not in deleting:
+        deleting.add((doc.__class__, doc.key))
+        toBeDeleted.append(doc)
 
-    if self._obj is not None:
-      docs_to_be_saved = []
-      for k in self._meta:
+    docs_to_be_saved = []
+    releases = []
+    for doc in toBeDeleted:
+      for k in doc._meta:
         # is_reference_back is for deleting the document that has the collection_name
         # collection_name is the document that gives out collection_name
-        col_name = getattr(self._meta[k], "is_reference_back", False) or getattr(self._meta[k], "collection_name", False)
+        col_name = getattr(doc._meta[k], "is_reference_back", False) or getattr(doc._meta[k], "collection_name", False)
 
         if col_name:
-          docs = getattr(self, k, [])
-          if docs is not None:
-            if isinstance(docs, Document):
-              docs = [docs]
-            docs_to_be_saved.extend(self._deleteBackRef(col_name, docs))
+          refs = getattr(doc, k, [])
+          if refs is not None:
+            if isinstance(refs, Document):
+              refs = [refs]
+            docs_to_be_saved.extend(doc._deleteBackRef(col_name, refs))
 
-      self.__class__.instances.pop(self.key, False)
+      doc.__class__.instances.pop(doc.key, False)
+      releases.extend((doc._meta[name].unique_bucket, doc._data[name])
+                      for name in doc._uniques if doc._data[name] is not None)
 
-      self._obj.delete(rw=rw)
+    for doc in toBeDeleted:
+      if doc._writeBehind is not None:
+        doc._writeBehind.discard(doc._obj.get_bucket().get_name(), doc.key)
 
-      for name in self._uniques:
-        if self._data[name] is not None:
-          obj = self._meta[name].unique_bucket.get(self._data[name])
-          obj.delete()
+    parallelMap(lambda doc: doc._obj.delete(rw=rw), toBeDeleted, concurrency)
+    parallelMap(lambda unique: unique[0].get(unique[1]).delete(), releases, concurrency)
 
-      self._deleted()
+    for doc in toBeDeleted:
+      doc._deleted()
 
-      for doc in docs_to_be_saved:
-        doc.save()
+    Document.saveMany([doc for doc in docs_to_be_saved if (doc.__class__, doc.key) not in deleting],
+                      concurrency=concurrency)
 
   def _deleted(self):
     self._obj = None
+    self._savedData = None
+    self._vclock = None
     self.saved = False
     self.deleted = True
     self.clear(False)
 
+  def clear(self, setdefault=True):
+    self._unresolvedLinks = set()
+    SimpleDocument.clear(self, setdefault)
+    # The data no longer comes from what was loaded or saved, so every field
+    # has to be compared by _changedFields, not just the mutable ones.
+    savedData = getattr(self, "_savedData", None)
+    if savedData is not None:
+      self._dirty = set(self._meta)
+      self._dirty.update(savedData)
+    return self
+
+  def removeLink(self, document, tag=None):
+    """Removes a link from the document
+
+    Args:
+      document: A Document object or its child.
+      tag: A tag value.
+
+    Returns:
+      self for OOP purposes"""
+    self._fetchHydrated()
+    self._unresolvedLinks = set((b, k, t) for b, k, t in self._unresolvedLinks
+                                if k != document.key or t != tag)
+    return SimpleDocument.removeLink(self, document, tag)
+
+  def setLinks(self, links):
+    """Sets the links. Overwrites the current links collection, including the
+    links that are not resolved yet.
+
+    Args:
+      links: Format should be set((document, tag), (document, tag)).
+             A shallow copy is made here.
+
+    Returns:
+      self for OOP purposes"""
+    self._fetchHydrated()
+    self._unresolvedLinks = set()
+    return SimpleDocument.setLinks(self, links)
+
+  # Documents built from search results need their RiakObject before their
+  # links and indexes mean anything. See _fetchHydrated.
+  def addLink(self, document, tag=None):
+    self._fetchHydrated()
+    return SimpleDocument.addLink(self, document, tag)
+
+  def addIndex(self, field, value):
+    self._fetchHydrated()
+    return SimpleDocument.addIndex(self, field, value)
+
+  def removeIndex(self, field, value=None, silent=False):
+    self._fetchHydrated()
+    return SimpleDocument.removeIndex(self, field, value, silent)
+
+  def setIndexes(self, indexes):
+    self._fetchHydrated()
+    return SimpleDocument.setIndexes(self, indexes)
+
+  def indexes(self, field=None, default=DocumentMetaclass):
+    self._fetchHydrated()
+    if default is DocumentMetaclass:
+      return SimpleDocument.indexes(self, field)
+    return SimpleDocument.indexes(self, field, default)
+
+  index = indexes
+
+  def resolveLinks(self, concurrency=DEFAULT_CONCURRENCY):
+    """Loads the documents of the links that haven't been loaded yet.
+
+    Links loaded from the database are kept as (bucket, key, tag) until they
+    are needed. This loads all of them, with the documents of each bucket
+    fetched concurrently. links() calls this.
+
+    Args:
+      concurrency: The maximum number of requests at the same time.
+
+    Returns:
+      self for OOP purposes
+
+    Raises:
+      NotFoundError if a linked document doesn't exist.
+    """
+    byBucket = {}
+    for bucket, key, tag in self._unresolvedLinks:
+      byBucket.setdefault(bucket, []).append((key, tag))
+
+    for bucket, links in byBucket.iteritems():
+      c = getClassGivenBucketName(bucket)
+      docs = c.getMany([key for key, tag in links], bucket=bucket, concurrency=concurrency)
+      for doc, (key, tag) in zip(docs, links):
+        self._links.add((doc, tag))
+
+    self._unresolvedLinks = set()
+    return self
+
   def links(self, riakLinks=False):
     """Gets all the links.
 
     Args:
-      riakLinks: Defaults to False. If True, it will return a list of RiakLinks
+      riakLinks: Defaults to False. If True, it will return a list of RiakLinks.
+                 This does not load the linked documents.
 
     Returns:
       A set of (document, tag) or [RiakLink, RiakLink]"""
+    self._fetchHydrated()
     if riakLinks:
-      return [RiakLink(self.bucket_name[0], d.key, t) for d, t in self._links]
+      links = [RiakLink(getattr(d, "bucket_name", self.bucket_name)[0], d.key, t) for d, t in self._links]
+      links.extend(RiakLink(b, k, t) for b, k, t in self._unresolvedLinks)
+      return links
+
+    if self._unresolvedLinks:
+      self.resolveLinks()
     return copy(self._links)
 
   def getRawData(self, name, default=DocumentMetaclass):
@@ -451,20 +1296,16 @@ class Document(SimpleDocument):
 
   @staticmethod
   def _getLinksFromRiakObj(robj):
-    objLinks = robj.get_links()
-    links = set()
-    for link in objLinks:
-      tag = link.get_tag()
-      c = getClassGivenBucketName(link.get_bucket())
-      links.add((c.load(link.get(), True), tag))
-    return links
+    return set((l.get_bucket(), l.get_key(), l.get_tag()) for l in robj.get_links())
 
   @classmethod
   def load(cls, robj, cached=False, r=None, bucket=None):
     """Construct a Document based object given a RiakObject.
 
     Args:
-      riak_obj: The RiakObject that the document is suppose to build from.
+      riak_obj: The RiakObject that the document is suppose to build from, or
+                a key. If it is a RiakObject that exists, it will be used as is
+                and not fetched again.
       cached: Reload the object or not if it's found in the pool of objects.
       r: R value
       bucket: The bucket to grab from. Defaults to the default bucket.
@@ -475,34 +1316,73 @@ class Document(SimpleDocument):
 
     if isinstance(robj, RiakObject):
       key = robj.get_key()
+      if not robj.exists():
+        robj = None
     else:
       key = robj
+      robj = None
 
     try:
-      doc = cls.instances[key]
+      with _buildLock: # Not while another thread is still populating it.
+        doc = cls.instances[key]
     except KeyError:
-      bucket = cls.buckets.get(bucket, cls.bucket)
-      robj = bucket.get(key, r)
-      if not robj.exists():
-        raise NotFoundError("%s not found!" % key)
-
-      # This is done before so that deserialize won't recurse
-      # infinitely with collection_name. This wouldn't cause an problem as
-      # deserialize calls for the loading of the referenced document
-      # from cache, which load this document from cache, and it see that it
-      # exists, finish loading the referenced document, then come back and finish
-      # loading this document.
-
-      doc = cls(key, saved=True)
-      doc._obj = robj
-      cls.instances[key] = doc
-      doc.reload()
-    else:
-      if not cached:
-        doc.reload()
+      if robj is None:
+        bucket = cls.buckets.get(bucket, cls.bucket)
+        robj = bucket.get(key, r)
+        if not robj.exists():
+          raise NotFoundError("%s not found!" % key)
+
+      # The document is registered in instances by __init__ before it gets
+      # populated so that deserialize won't recurse infinitely with
+      # collection_name. The referenced document will load this document from
+      # cache, see that it exists, finish loading itself, and then come back
+      # and finish loading this document.
+
+      with _buildLock:
+        if key not in cls.instances:
+          doc = cls(key)
+          doc._populate(robj)
+          return doc
+        doc = cls.instances[key] # Another thread loaded it meanwhile.
+
+    if not cached:
+      if robj is None:
+        doc.reload(r)
+      else:
+        doc._populate(robj)
 
     return doc
 
+  @classmethod
+  def hydrate(cls, key, data, bucket=None):
+    """Constructs a Document from data that didn't come from a RiakObject, such
+    as the stored fields of a search result. Nothing is fetched.
+
+    The RiakObject of the document (and with it, its links and indexes) is only
+    fetched when it's needed, like before the document is saved.
+
+    If the document is in instances, that document is returned as is.
+
+    Args:
+      key: The key of the document.
+      data: The data of the document, in the form it's stored in the database.
+      bucket: The bucket the document is in. Defaults to the default bucket.
+
+    Returns:
+      A Document object (whichever subclass this was called from).
+    """
+    with _buildLock:
+      try:
+        return cls.instances[key]
+      except KeyError:
+        pass
+
+      doc = cls(key)
+      doc.deserialize(data)
+      doc._obj = cls.buckets.get(bucket, cls.bucket).new(key)
+      doc._hydrated = True
+      return doc
+
   @classmethod
   def get(cls, key, cached=True, r=None, bucket=None):
     """Same as load, but the default of the cached is True.
@@ -511,6 +1391,63 @@ class Document(SimpleDocument):
     available."""
     return cls.load(key, cached, r, bucket)
 
+  @classmethod
+  def getMany(cls, keys, r=None, bucket=None, cached=True, silent=False,
+              concurrency=DEFAULT_CONCURRENCY):
+    """Gets many documents at once.
+
+    If cached, the documents that are in instances are used as is. Every other
+    key is fetched concurrently, with at most concurrency requests at a time.
+
+    Args:
+      keys: A list of keys.
+      r: R value
+      bucket: The bucket to grab from. Defaults to the default bucket.
+      cached: Use the documents found in instances or not. Default: True
+      silent: If True, keys that are not found are skipped. Otherwise
+              NotFoundError is raised. Default: False
+      concurrency: The maximum number of requests at the same time.
+
+    Returns:
+      A list of Documents in the same order as keys.
+
+    Raises:
+      NotFoundError if a key is not found and silent is False.
+    """
+    found = {}
+    toBeFetched = []
+    for key in keys:
+      if key in found:
+        continue
+
+      if cached:
+        try:
+          with _buildLock:
+            found[key] = cls.instances[key]
+          continue
+        except KeyError:
+          pass
+
+      found[key] = None
+      toBeFetched.append(key)
+
+    bucket = cls.buckets.get(bucket, cls.bucket)
+    robjs = parallelMap(lambda key: bucket.get(key, r), toBeFetched, concurrency)
+
+    for key, robj in zip(toBeFetched, robjs):
+      if robj.exists():
+        found[key] = cls.load(robj)
+      elif not silent:
+        raise NotFoundError("%s not found!" % key)
+
+    docs = []
+    for key in keys:
+      doc = found[key]
+      if doc is not None:
+        docs.append(doc)
+
+    return docs
+
   @classmethod
   def getOrNew(cls, key, cached=True, r=None, bucket=None, **kwargs):
     """Similar to get, but does not raise error if not found. A new (unsaved)
@@ -539,10 +1476,171 @@ class Document(SimpleDocument):
     Returns:
       True if the key exists, false otherwise.
     """
-    return cls.buckets.get(bucket, cls.bucket).get(key, r).exists()
+    bucket = cls.buckets.get(bucket, cls.bucket)
+    f = cls._keyFilters.get(bucket.get_name(), None)
+    if f is not None and key not in f:
+      return False
+    return bucket.get(key, r).exists()
+
+  @classmethod
+  def replayJournal(cls):
+    """Finishes the saves in the journal that didn't finish, because the
+    process died or a request failed. See riakkit.journal.
+
+    Returns:
+      The number of saves finished.
+    """
+    if cls.journal is None:
+      return 0
+    return cls.journal.replay(cls.client)
+
+  @classmethod
+  def flushWriteBehind(cls, timeout=None):
+    """Waits until the documents queued by save() are stored, if write_behind
+    is set.
+
+    Args:
+      timeout: The maximum number of seconds to wait. None for forever.
+
+    Returns:
+      True if everything is stored, False if timeout was reached first.
+    """
+    if cls._writeBehind is None:
+      return True
+    return cls._writeBehind.flush(timeout)
+
+  @classmethod
+  def writeBehindStats(cls):
+    """Gets the counters of the write behind queue, see
+    WriteBehindQueue.stats.
+
+    Returns:
+      A dictionary, or None if write_behind is not set.
+    """
+    if cls._writeBehind is None:
+      return None
+    return cls._writeBehind.stats()
+
+  # The a* methods do the same thing as the methods they're named after, in a
+  # background thread (see riakkit.commons.pool.Executor), and return a Future
+  # right away. Calling future.result() gives what the method returns, or
+  # raises what it raises. They're run in the session of the calling thread,
+  # which waits for them before it ends.
+
+  @classmethod
+  def _submit(cls, f, *args, **kwargs):
+    s = currentSession()
+    def call():
+      _local.session = s
+      try:
+        return f(*args, **kwargs)
+      finally:
+        _local.session = None
+
+    future = submit(call)
+    if s is not None:
+      s.track(future)
+    return future
+
+  @classmethod
+  def aload(cls, robj, cached=False, r=None, bucket=None):
+    """load() in the background. Returns a Future."""
+    return cls._submit(cls.load, robj, cached, r, bucket)
+
+  @classmethod
+  def aget(cls, key, cached=True, r=None, bucket=None):
+    """get() in the background. Returns a Future."""
+    return cls._submit(cls.get, key, cached, r, bucket)
+
+  @classmethod
+  def agetMany(cls, keys, r=None, bucket=None, cached=True, silent=False,
+               concurrency=DEFAULT_CONCURRENCY):
+    """getMany() in the background. Returns a Future."""
+    return cls._submit(cls.getMany, keys, r, bucket, cached, silent, concurrency)
+
+  @classmethod
+  def aexists(cls, key, r=None, bucket=None):
+    """exists() in the background. Returns a Future."""
+    return cls._submit(cls.exists, key, r, bucket)
+
+  @classmethod
+  def asolrSearch(cls, querytext, bucket=None, hydrate=False, **kwargs):
+    """solrSearch() in the background. Returns a Future of the SolrQuery, which
+    has aall() to load the documents in the background too."""
+    return cls._submit(cls.solrSearch, querytext, bucket, hydrate, **kwargs)
+
+  def asave(self, w=None, dw=None, endpoint=False, bucket=None):
+    """save() in the background. Returns a Future."""
+    return self._submit(self.save, w, dw, endpoint, bucket)
+
+  @staticmethod
+  def asaveMany(docs, w=None, dw=None, bucket=None, concurrency=DEFAULT_CONCURRENCY):
+    """saveMany() in the background. Returns a Future."""
+    return Document._submit(Document.saveMany, docs, w, dw, bucket, concurrency)
+
+  def areload(self, r=None, vtag=None):
+    """reload() in the background. Returns a Future."""
+    return self._submit(self.reload, r, vtag)
+
+  def adelete(self, rw=None):
+    """delete() in the background. Returns a Future."""
+    return self._submit(self.delete, rw)
+
+  @staticmethod
+  def adeleteMany(docs, rw=None, concurrency=DEFAULT_CONCURRENCY):
+    """deleteMany() in the background. Returns a Future."""
+    return Document._submit(Document.deleteMany, docs, rw, concurrency)
+
+  @classmethod
+  def buildFilters(cls, capacity=None, error_rate=DEFAULT_ERROR_RATE):
+    """Builds Bloom filters of the keys of each bucket of this class, and of
+    the values taken for each unique property, from key listings.
+
+    After that, exists() and the unique checks only go to the database when
+    the filter says the key might exist. Keys and values saved through this
+    class are added to the filters. Deleted ones can't be removed from them,
+    they just become false positives.
+
+    Key listings are expensive. Also, the filters don't know about what other
+    processes save after they're built, so only use these if this process is
+    the only writer (or it's fine for exists() and the unique checks to miss
+    those), or rebuild them regularly.
+
+    Args:
+      capacity: The number of keys expected. See riakkit.commons.bloom.newFilter.
+      error_rate: The false positive rate at capacity.
+
+    Returns:
+      filterStats()
+    """
+    cls._keyFilters = {}
+    for name, bucket in cls.buckets.iteritems():
+      cls._keyFilters[name] = newFilter(bucket.get_keys(), capacity, error_rate)
+
+    for name in cls._uniques:
+      cls._meta[name].buildFilter(capacity, error_rate)
+
+    return cls.filterStats()
+
+  @classmethod
+  def filterStats(cls):
+    """Gets the stats of the filters built with buildFilters.
+
+    Returns:
+      {"keys" : {bucket name : stats}, "uniques" : {property name : stats}},
+      with the stats of BloomFilter.stats().
+    """
+    uniques = {}
+    for name in cls._uniques:
+      f = cls._meta[name].filter
+      if f is not None:
+        uniques[name] = f.stats()
+
+    return {"keys" : dict((name, f.stats()) for name, f in cls._keyFilters.iteritems()),
+            "uniques" : uniques}
 
   @classmethod
-  def search(cls, querytext, bucket=None):
+  def search(cls, querytext, bucket=None, bodies=False):
     """Searches through the bucket with some query text.
 
     The bucket must have search installed via search-cmd install BUCKETNAME. The
@@ -551,27 +1649,33 @@ class Document(SimpleDocument):
     Args:
       querytext: The query text as outlined in the python-riak documentations.
       bucket: The bucket to search. Leave default for the default bucket.
+      bodies: Get the objects with the MapReduce job instead of fetching them
+              afterwards. Default: False
 
     Returns:
       A MapReduceQuery object. Similar to the RiakMapReduce object."""
     query_obj = cls.client.search(cls.bucket_name[0] if bucket is None else bucket, querytext)
-    return MapReduceQuery(cls, query_obj)
+    return MapReduceQuery(cls, query_obj, bodies)
 
   @classmethod
-  def solrSearch(cls, querytext, bucket=None, **kwargs):
+  def solrSearch(cls, querytext, bucket=None, hydrate=False, **kwargs):
     """Searches through using the SOLR.
 
     Args:
       querytext: The query text
       kwargs: Any other keyword arguments for SOLR.
       bucket: The bucket to SOLR. Leave default for the default bucket.
+      hydrate: Build the documents from the stored fields of the results when
+               they have all the fields of the schema. See SolrQuery.
+               Default: False
 
     Returns:
       A SolrQuery object. Similart to a MapReduceQuery"""
-    return SolrQuery(cls, cls.client.solr().search(cls.bucket_name[0] if bucket is None else bucket, querytext, **kwargs))
+    bucket = cls.bucket_name[0] if bucket is None else bucket
+    return SolrQuery(cls, cls.client.solr().search(bucket, querytext, **kwargs), hydrate, bucket)
 
   @classmethod
-  def indexLookup(cls, index, startkey, endkey=None, bucket=None):
+  def indexLookup(cls, index, startkey, endkey=None, bucket=None, bodies=False):
     """Short hand for creating a new mapreduce index
 
     Args:
@@ -579,11 +1683,63 @@ class Document(SimpleDocument):
       startkey: The starting key
       endkey: The ending key. If not none, search a range. Default: None
       bucket: The bucket to index. Leave default for the default bucket.
+      bodies: Get the objects with the MapReduce job instead of fetching them
+              afterwards. Default: False
 
     Returns:
       A MapReduceQuery object
     """
-    return MapReduceQuery(cls, cls.client.index(cls.bucket_name[0] if bucket is None else bucket, index, startkey, endkey))
+    return MapReduceQuery(cls, cls.client.index(cls.bucket_name[0] if bucket is None else bucket, index, startkey, endkey), bodies)
+
+  @classmethod
+  def indexQuery(cls, index, startkey, endkey=None, bucket=None,
+                 page_size=DEFAULT_INDEX_PAGE_SIZE, continuation=None,
+                 keys_only=False):
+    """Goes through an index a page at a time, unlike indexLookup which gets
+    every key at once.
+
+    Args:
+      index: The index field
+      startkey: The starting key
+      endkey: The ending key. If not none, search a range. Default: None
+      bucket: The bucket to index. Leave default for the default bucket.
+      page_size: The number of keys fetched at a time.
+      continuation: The continuation of a previous IndexQuery to resume from.
+      keys_only: Only get the keys, not the documents. Default: False
+
+    Returns:
+      An IndexQuery object.
+    """
+    return IndexQuery(cls, index, startkey, endkey, bucket, page_size,
+                      continuation, keys_only)
+
+  @classmethod
+  def filterBy(cls, field, value, bucket=None):
+    """Finds the documents with a value, or a value in a range, for a property
+    that has index set.
+
+    Args:
+      field: The name of the property.
+      value: The value, or (start, end) for a range. Values are given the same
+             way they're given to a document, e.g. datetimes for a
+             DateTimeProperty.
+      bucket: The bucket to index. Leave default for the default bucket.
+
+    Returns:
+      A MapReduceQuery object, same as indexLookup.
+
+    Raises:
+      AttributeError if the property doesn't exist or isn't indexed.
+    """
+    prop = cls._meta.get(field, None)
+    if prop is None or not prop.index:
+      raise AttributeError("'%s' is not an indexed property of '%s'." % (field, cls.__name__))
+
+    if isinstance(value, tuple):
+      startkey, endkey = prop.indexValue(value[0]), prop.indexValue(value[1])
+    else:
+      startkey, endkey = prop.indexValue(value), None
+    return cls.indexLookup(prop.indexName(field), startkey, endkey, bucket)
 
   @classmethod
   def mapreduce(cls, bucket=None): # TODO: Make a better interface
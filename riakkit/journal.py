@@ -0,0 +1,443 @@
+# This file is part of RiakKit.
+#
+# RiakKit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RiakKit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A local journal of the writes a save is about to do, so they can be finished
+if the process dies (or a request fails) half way through.
+
+Give a Document class a journal:
+
+  class User(Document):
+    bucket_name = "users"
+    client = some_client
+    journal = Journal("/var/lib/myapp/journal")
+
+Before save() writes anything, it appends the plan of every object it's going
+to write (the document, its unique values claimed and released, and the
+documents modified through collection_name) to the journal, and waits for it to
+be on disk. Once everything is written, it appends a done marker. At startup,
+or to retry the saves that failed, User.replayJournal() writes the plans that
+aren't done.
+
+The plans record the vclock of the document as it was before it was stored. A
+plan whose document has been written since (it has another vclock, and not
+the data of the plan) is skipped when replaying instead of overwriting it.
+Also, once a plan is done, what the older pending plans would write to the
+same objects is dropped, and so are the older plans of the same document.
+"""
+
+import base64
+import json
+import os
+import threading
+
+from riak.mapreduce import RiakLink
+
+from riakkit.commons.keygen import randomString
+
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+SEGMENT_SUFFIX = ".journal"
+UNKNOWN_VCLOCK = object()
+
+def storeOp(bucketName, key, data, links=(), indexes=(), vclock=UNKNOWN_VCLOCK):
+  """An operation that stores an object.
+
+  Args:
+    bucketName: The name of the bucket.
+    key: The key.
+    data: The data, already serialized.
+    links: A list of RiakLinks.
+    indexes: A list of (index name, value).
+    vclock: The vclock of the object that data replaces, None if there's no
+            object yet. When it's given, replaying skips the plan if the
+            object has been written since. Leave it out if it's not known.
+
+  Returns:
+    An operation, for Journal.begin.
+  """
+  op = ["store", bucketName, key, data,
+        [[l.get_bucket(), l.get_key(), l.get_tag()] for l in links],
+        [list(index) for index in indexes]]
+  if vclock is not UNKNOWN_VCLOCK:
+    op.append(_encodeVclock(vclock))
+  return op
+
+def deleteOp(bucketName, key):
+  """An operation that deletes an object. See storeOp."""
+  return ["delete", bucketName, key]
+
+def applyOp(client, op, robj=None):
+  """Does an operation.
+
+  Args:
+    client: A RiakClient.
+    op: An operation from storeOp or deleteOp.
+    robj: For a store, the RiakObject if it has already been fetched, so it's
+          stored with its vclock.
+  """
+  bucket = client.bucket(op[1])
+  if op[0] == "store":
+    if robj is None:
+      robj = bucket.new(op[2], op[3])
+    else:
+      robj.set_data(op[3])
+    robj.set_links([RiakLink(b, k, t) for b, k, t in op[4]], True)
+    robj.set_indexes([tuple(index) for index in op[5]])
+    robj.store()
+  elif op[0] == "delete":
+    bucket.get(op[2]).delete()
+  else:
+    raise ValueError("Unknown journal operation: %r" % op[0])
+
+def _encodeVclock(vclock):
+  # The protocol buffers transport gives vclocks as raw bytes.
+  return None if vclock is None else base64.b64encode(vclock)
+
+def _opKey(op):
+  return (op[1], op[2])
+
+def _planOrder(planId, segment):
+  # Plans of the same run are numbered in order, and segments are too.
+  runId, n = planId.rsplit("-", 1)
+  return (segment, runId, int(n))
+
+def _fetchUnchanged(client, ops):
+  """Fetches the objects of the store operations that have a vclock.
+
+  Returns:
+    A dictionary of the index of the operation : its RiakObject, or None if
+    one of the objects has been written since the plan was begun.
+  """
+  objects = {}
+  for i, op in enumerate(ops):
+    if op[0] != "store" or len(op) < 7:
+      continue
+
+    robj = client.bucket(op[1]).get(op[2])
+    vclock = _encodeVclock(robj.vclock()) if robj.exists() else None
+    # The plan could have written it before failing.
+    if vclock != op[6] and robj.get_data() != op[3]:
+      return None
+    objects[i] = robj
+  return objects
+
+class Journal(object):
+  """An append-only journal of plans, a list of operations each, in segment
+  files in a directory.
+
+  Each record is a line of JSON. A plan is written with begin(), which returns
+  once it's on disk. When many threads begin plans at the same time, a single
+  fsync covers every plan written before it. done() appends a marker, which
+  is not synced: if it's lost, the plan is just written again.
+
+  Once a segment is larger than segment_size, a new one is started. Segments
+  that aren't being written to anymore are deleted once all their plans, and
+  the plans of the segments before them, are done.
+
+  Attributes:
+    directory: Where the segments are.
+    segment_size: The size of a segment before a new one is started, in bytes.
+  """
+  def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE):
+    """Opens the journal in directory, creating it if needed. The plans that
+    weren't done when it was last used are loaded.
+
+    Args:
+      directory: The directory of the segments.
+      segment_size: See Journal.
+    """
+    self.directory = directory
+    self.segment_size = segment_size
+
+    self._lock = threading.Lock()
+    self._syncLock = threading.Lock()
+    self._runId = randomString(8)
+    self._nextId = 0
+    self._pending = {} # plan id : (segment number, operations)
+    self._active = set() # The plans being carried out in this process.
+    self._parts = {} # plan id : number of parts not done, for active plans
+    self._released = set() # The plans given up on in this process.
+    self._segmentPlans = {} # segment number : set of plan ids not done
+    self._counters = {"plans" : 0, "done" : 0, "fsyncs" : 0, "segments" : 0,
+                      "replayed" : 0, "skipped" : 0, "superseded" : 0}
+    self._written = 0
+    self._synced = 0
+    self._file = None
+    self._segment = 0
+
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    segments = self._segments()
+    for segment in segments:
+      self._load(segment)
+    self._open(max(segments or [0]) + 1)
+    self._collect()
+
+  def _path(self, segment):
+    return os.path.join(self.directory, "%08d%s" % (segment, SEGMENT_SUFFIX))
+
+  def _segments(self):
+    segments = []
+    for name in os.listdir(self.directory):
+      if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit():
+        segments.append(int(name[:-len(SEGMENT_SUFFIX)]))
+    return sorted(segments)
+
+  def _load(self, segment):
+    with open(self._path(segment)) as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except ValueError: # The last record, torn by a crash.
+          continue
+
+        if record[0] == "plan":
+          self._pending[record[1]] = (segment, record[2])
+          self._segmentPlans.setdefault(segment, set()).add(record[1])
+        elif record[0] == "done":
+          if record[1] in self._pending:
+            self._supersede(record[1])
+          self._forget(record[1])
+
+    self._segmentPlans.setdefault(segment, set())
+
+  def _open(self, segment):
+    self._segment = segment
+    self._segmentPlans.setdefault(segment, set())
+    self._file = open(self._path(segment), "a")
+    self._counters["segments"] += 1
+
+  def _forget(self, planId):
+    self._released.discard(planId)
+    plan = self._pending.pop(planId, None)
+    if plan is not None:
+      self._segmentPlans[plan[0]].discard(planId)
+      return plan[0]
+    return None
+
+  def _supersede(self, planId):
+    """Drops what the pending plans begun before a plan that's done would write
+    to the objects it wrote. Must be called with _lock held (or while loading),
+    before the plan is forgotten.
+
+    Returns:
+      The ids of the plans dropped entirely, because their document (their
+      first operation) was written by the plan. They're forgotten.
+    """
+    segment, ops = self._pending[planId]
+    order = _planOrder(planId, segment)
+    keys = set(_opKey(op) for op in ops)
+
+    superseded = []
+    for otherId, (otherSegment, otherOps) in self._pending.items():
+      if otherId in self._active or _planOrder(otherId, otherSegment) >= order:
+        continue
+
+      if not otherOps or _opKey(otherOps[0]) in keys:
+        superseded.append(otherId)
+      else:
+        self._pending[otherId] = (otherSegment, [op for op in otherOps if _opKey(op) not in keys])
+
+    for otherId in superseded:
+      self._forget(otherId)
+    return superseded
+
+  def _collect(self):
+    # Only the oldest segments go, as a segment can have the done markers of
+    # the plans of the ones before it.
+    for segment in sorted(self._segmentPlans):
+      if segment == self._segment or self._segmentPlans[segment]:
+        return
+      del self._segmentPlans[segment]
+      os.remove(self._path(segment))
+
+  def _append(self, record):
+    """Appends a record. Must be called with _lock held.
+
+    Returns:
+      The position of the record, for _sync.
+    """
+    if self._file.tell() >= self.segment_size:
+      self._file.flush()
+      os.fsync(self._file.fileno())
+      self._counters["fsyncs"] += 1
+      self._synced = self._written
+      self._file.close()
+      previous = self._segment
+      self._open(previous + 1)
+      self._collect()
+
+    self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+    self._file.flush()
+    self._written += 1
+    return self._written
+
+  def _sync(self, position):
+    with self._syncLock:
+      if self._synced >= position: # Another thread's fsync covered it.
+        return
+
+      # A duplicate, in case the segment is rotated and closed meanwhile.
+      with self._lock:
+        target = self._written
+        fd = os.dup(self._file.fileno())
+      try:
+        os.fsync(fd)
+      finally:
+        os.close(fd)
+      with self._lock:
+        self._counters["fsyncs"] += 1
+        self._synced = max(self._synced, target)
+
+  def begin(self, ops, parts=1):
+    """Writes a plan, and waits for it to be on disk.
+
+    Args:
+      ops: A list of operations, from storeOp and deleteOp.
+      parts: The number of times done has to be called for the plan to be
+             done, when different threads carry out parts of it.
+
+    Returns:
+      The id of the plan, for done and release.
+    """
+    with self._lock:
+      planId = "%s-%d" % (self._runId, self._nextId)
+      self._nextId += 1
+      position = self._append(["plan", planId, ops])
+      self._pending[planId] = (self._segment, ops)
+      self._segmentPlans[self._segment].add(planId)
+      self._active.add(planId)
+      self._parts[planId] = parts
+      self._counters["plans"] += 1
+    self._sync(position)
+    return planId
+
+  def done(self, planId):
+    """Marks a part of a plan as done. Once every part is, marks the plan as
+    done, and drops what the older pending plans would write to the same
+    objects (see Journal).
+
+    Once a plan has been released, it can only be done by replaying it: the
+    parts done after another part failed are ignored.
+
+    Args:
+      planId: The return value of begin.
+    """
+    with self._lock:
+      if planId in self._released:
+        return
+
+      parts = self._parts.pop(planId, 1) - 1
+      if parts > 0:
+        self._parts[planId] = parts
+        return
+
+      self._finish(planId)
+
+  def _finish(self, planId):
+    """Marks a plan as done. Must be called with _lock held."""
+    self._active.discard(planId)
+    if planId not in self._pending:
+      return
+
+    superseded = self._supersede(planId)
+    self._forget(planId)
+    self._append(["done", planId])
+    for otherId in superseded:
+      self._append(["done", otherId])
+    self._counters["done"] += 1
+    self._counters["superseded"] += len(superseded)
+    self._collect()
+
+  def release(self, planId):
+    """Gives up on carrying out a plan in this process, e.g. because a write
+    failed. The plan is left to be replayed, even if its other parts are done
+    afterwards.
+
+    Args:
+      planId: The return value of begin.
+    """
+    with self._lock:
+      self._active.discard(planId)
+      self._parts.pop(planId, None)
+      if planId in self._pending:
+        self._released.add(planId)
+
+  def pending(self):
+    """Gets the plans that aren't done and aren't being carried out, in the
+    order they were begun.
+
+    Returns:
+      A list of (plan id, operations).
+    """
+    with self._lock:
+      plans = [(planId, plan) for planId, plan in self._pending.iteritems()
+               if planId not in self._active]
+
+    plans.sort(key=lambda item: _planOrder(item[0], item[1][0]))
+    return [(planId, plan[1]) for planId, plan in plans]
+
+  def replay(self, client):
+    """Carries out the pending plans, and marks them as done. The plans whose
+    document has been written since they were begun are skipped.
+
+    Args:
+      client: The RiakClient to write with.
+
+    Returns:
+      The number of plans replayed, not counting the skipped ones.
+
+    Raises:
+      Whatever the client raises. The plan that failed and the ones after it
+      are left pending.
+    """
+    n = 0
+    skipped = 0
+    for planId, ops in self.pending():
+      objects = _fetchUnchanged(client, ops)
+      if objects is None:
+        skipped += 1
+      else:
+        for i, op in enumerate(ops):
+          applyOp(client, op, objects.get(i))
+        n += 1
+      with self._lock:
+        self._finish(planId)
+
+    with self._lock:
+      self._counters["replayed"] += n
+      self._counters["skipped"] += skipped
+    return n
+
+  def stats(self):
+    """Gets the counters of this journal.
+
+    Returns:
+      A dictionary with plans (begun), done, replayed, skipped (when
+      replaying), superseded (plans dropped by newer ones), fsyncs, segments
+      (opened), pending (plans not done) and active (plans being carried out).
+    """
+    with self._lock:
+      stats = dict(self._counters)
+      stats["pending"] = len(self._pending)
+      stats["active"] = len(self._active)
+    return stats
+
+  def close(self):
+    """Syncs and closes the current segment."""
+    with self._lock:
+      self._file.flush()
+      os.fsync(self._file.fileno())
+      self._file.close()
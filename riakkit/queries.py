@@ -14,17 +14,77 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
 
+from copy import copy
+import json
+import urllib
+
+from riakkit.commons.exceptions import RiakkitError
+from riakkit.commons.pool import DEFAULT_CONCURRENCY
+from riakkit.commons.properties import StringProperty
+from riak.mapreduce import RiakLink
+
 class SolrQuery(object):
   """A wrapper around RiakSearch to play nice with Document and Solr
 
+  The documents of the results are fetched concurrently when they're first
+  needed. With hydrate, the results that have every field of the schema in
+  their stored fields are built from those instead, and only the rest are
+  fetched. See Document.hydrate.
+
   Attributes:
     cls: The class for this SolrQuery
     result: The result dictionary.
+    hydrate: Build the documents from the stored fields or not.
+    bucket: The bucket that was searched.
   """
-  def __init__(self, cls, result):
+  def __init__(self, cls, result, hydrate=False, bucket=None):
     self.cls = cls
     self.result = result
-    self.loadDoc = lambda doc : self.cls.load(self.cls.bucket.get(doc[u"id"]))
+    self.hydrate = hydrate
+    self.bucket = bucket
+    self._docs = None
+
+  def _fromSolr(self, prop, value):
+    # Solr gives back everything that's not a string as a string.
+    if isinstance(value, basestring) and not isinstance(prop, StringProperty):
+      try:
+        return json.loads(value)
+      except ValueError:
+        pass
+    return value
+
+  def _hydrate(self, doc):
+    data = {}
+    for name, prop in self.cls._meta.iteritems():
+      if name not in doc:
+        return None
+      data[name] = self._fromSolr(prop, doc[name])
+
+    return self.cls.hydrate(doc[u"id"], data, self.bucket)
+
+  def loadDoc(self, doc):
+    """Gets the Document of a single result.
+
+    Args:
+      doc: A dictionary from the docs of the result.
+
+    Returns:
+      A Document.
+    """
+    if self.hydrate:
+      d = self._hydrate(doc)
+      if d is not None:
+        return d
+    return self.cls.load(doc[u"id"], False, bucket=self.bucket)
+
+  def _load(self):
+    if self._docs is None:
+      docs = self.result[u"docs"]
+      found = [self._hydrate(doc) if self.hydrate else None for doc in docs]
+      keys = [doc[u"id"] for doc, d in zip(docs, found) if d is None]
+      fetched = iter(self.cls.getMany(keys, bucket=self.bucket, cached=False))
+      self._docs = [d if d is not None else fetched.next() for d in found]
+    return self._docs
 
   def length(self):
     """Gets the length of the documents that's searched through.
@@ -34,10 +94,27 @@ class SolrQuery(object):
 
   __len__ = length
 
+  def count(self):
+    """Gets the number of documents that matched, not only the ones in the
+    results. Nothing is fetched.
+
+    Returns:
+      An integer.
+    """
+    return self.result[u"num_found"]
+
+  def keys(self):
+    """Gets the keys of the documents in the results. Nothing is fetched.
+
+    Returns:
+      A list of keys.
+    """
+    return [doc[u"id"] for doc in self.result[u"docs"]]
+
   def run(self):
     """Returns a generator that goes through each document that's searched."""
-    for doc in self.result[u"docs"]:
-      yield self.loadDoc(doc)
+    for doc in self._load():
+      yield doc
 
   def all(self):
     """Returns all the items that's found and return it.
@@ -45,26 +122,236 @@ class SolrQuery(object):
     Return:
       A list of all the Documents.
     """
-    return map(self.loadDoc, self.result[u"docs"])
+    return list(self._load())
+
+  def aall(self):
+    """all() in the background. Returns a Future."""
+    return self.cls._submit(self.all)
+
+
+# A map phase that returns everything needed to build the documents, so they
+# don't have to be fetched one by one after the MapReduce job. If a field is
+# passed as the argument, its stored value is added at the end for sorting.
+BODIES_MAP_FUNCTION = """function(v, keyData, field) {
+  if (v.not_found) return [];
+  var c = v.values[0];
+  if (c.metadata["X-Riak-Deleted"]) return [];
+  var links = c.metadata.Links || [];
+  var index = c.metadata.index || {};
+  var indexes = [];
+  for (var f in index) indexes.push([f, index[f]]);
+  var result = [v.bucket, v.key, v.vclock, c.data, links, indexes];
+  if (field) {
+    var value = JSON.parse(c.data)[field];
+    result.push(value === undefined ? null : value);
+  }
+  return [result];
+}"""
+
+# A map phase that returns the bucket, the key and the stored value of the
+# field passed as the argument.
+ORDER_MAP_FUNCTION = """function(v, keyData, field) {
+  if (v.not_found) return [];
+  var c = v.values[0];
+  if (c.metadata["X-Riak-Deleted"]) return [];
+  var value = JSON.parse(c.data)[field];
+  return [[v.bucket, v.key, value === undefined ? null : value]];
+}"""
 
+# A reduce phase that sorts on the element at arg.index (if not null) and keeps
+# the first arg.limit (if not null). Doing it again on its own output gives the
+# same thing, so it can be re-reduced. Nulls go first.
+SORT_REDUCE_FUNCTION = """function(values, arg) {
+  if (arg.index !== null) {
+    var i = arg.index;
+    values.sort(function(a, b) {
+      var x = a[i], y = b[i], c;
+      if (x === y) c = 0;
+      else if (x === null) c = -1;
+      else if (y === null) c = 1;
+      else c = x < y ? -1 : 1;
+      return arg.descending ? -c : c;
+    });
+  }
+  return arg.limit === null ? values : values.slice(0, arg.limit);
+}"""
+
+DEFAULT_CHUNK_SIZE = 100
+
+# The built in reduce function that counts its inputs. Counting this way only
+# sends the count back, not every key.
+COUNT_REDUCE_FUNCTION = ["riak_kv_mapreduce", "reduce_count_inputs"]
 
 class MapReduceQuery(object):
   """A wrapper around RiakMapReduce to play nice with Document
 
+  The MapReduce job only runs when the results are first needed. Documents are
+  then built a chunk at a time as they are iterated over.
+
+  By default the job returns links and the documents of each chunk are fetched
+  concurrently. With bodies, a map phase is added to the job that returns the
+  objects themselves, and the documents are built from those without fetching
+  anything else.
+
+  orderBy and limit add a reduce phase that sorts on the stored value of a
+  field and only keeps the first documents, so the rest are never sent back.
+  The phases are added to a copy of mr_obj when the query runs.
+
   Attributes:
     cls: The class for this MapReduceQuery.
     mr_obj: The original RiakMapReduce object.
     riak_links: All the links returned from the run operation of RiakMapReduce.
+                With bodies, the results of the map phase instead.
+    bodies: Get the objects through the MapReduce job or not.
+    chunk_size: The number of documents built at a time.
   """
-  def __init__(self, cls, mr_obj):
+  def __init__(self, cls, mr_obj, bodies=False, chunk_size=DEFAULT_CHUNK_SIZE):
     self.cls = cls
     self.mr_obj = mr_obj
-    self.riak_links = mr_obj.run()
+    self.bodies = bodies
+    self.chunk_size = chunk_size
+    self._results = None
+    self._order = None
+    self._limit = None
+
+  def orderBy(self, field, descending=False):
+    """Sorts the documents by a field, on the server.
+
+    The sorting is done on the value stored in the database (what convertToDb
+    returns), e.g. the float stored for a DateTimeProperty. Documents without
+    the field come first.
+
+    Args:
+      field: The name of the field.
+      descending: Sort in descending order or not. Default: False
+
+    Returns:
+      self for OOP.
+    """
+    self._order = (field, descending)
+    self._results = None
+    return self
+
+  def limit(self, n):
+    """Only gets the first n documents. They're cut on the server.
+
+    Args:
+      n: The maximum number of documents. None for no limit.
+
+    Returns:
+      self for OOP.
+    """
+    self._limit = n
+    self._results = None
+    return self
+
+  def _job(self, bodies):
+    mr_obj = copy(self.mr_obj)
+    mr_obj._phases = list(self.mr_obj._phases)
+    field, descending = self._order or (None, False)
+    if bodies:
+      mr_obj.map(BODIES_MAP_FUNCTION, {"arg" : field})
+    elif field is not None:
+      mr_obj.map(ORDER_MAP_FUNCTION, {"arg" : field})
+
+    if field is not None or self._limit is not None:
+      index = None
+      if field is not None:
+        index = 6 if bodies else 2
+      mr_obj.reduce(SORT_REDUCE_FUNCTION, {"arg" : {"index" : index,
+                                                   "descending" : descending,
+                                                   "limit" : self._limit}})
+    return mr_obj
+
+  def _run(self, bodies):
+    results = self._job(bodies).run() or []
+    if not bodies and (self._order is not None or self._limit is not None):
+      results = [RiakLink(result[0], result[1]) for result in results]
+    return results
+
+  @property
+  def riak_links(self):
+    if self._results is None:
+      self._results = self._run(self.bodies)
+    return self._results
+
+  def _key(self, result):
+    if self.bodies:
+      return result[1]
+    return result.get_key()
+
+  def keys(self):
+    """Gets the keys of the objects in this query without building any
+    Document.
+
+    With bodies, if the query hasn't run yet, it's run without the bodies.
+
+    Returns:
+      A list of keys.
+    """
+    if self._results is None and self.bodies:
+      return [link.get_key() for link in self._run(False)]
+    return [self._key(result) for result in self.riak_links]
+
+  def count(self):
+    """Gets the number of objects in this query.
+
+    If the query hasn't run yet, the counting is done by a reduce phase so
+    only the count is sent back. The query itself is not run.
+
+    Returns:
+      An integer.
+    """
+    if self._results is not None:
+      return len(self._results)
+
+    mr_obj = self._job(False)
+    mr_obj.reduce(COUNT_REDUCE_FUNCTION)
+    result = mr_obj.run()
+    return result[0] if result else 0
+
+  def _riakObject(self, result):
+    bucketName, key, vclock, data, links, indexes = result[:6]
+    robj = self.cls.buckets.get(bucketName, self.cls.bucket).new(key)
+    # Older clients (1.5.x) only have it as _populate.
+    populate = getattr(robj, "populate", None) or robj._populate
+    populate((vclock, [({"content-type" : "application/json"}, data)]))
+    robj.set_links([RiakLink(b, k, t) for b, k, t in links], True)
+    robj.set_indexes([(field, value) for field, value in indexes])
+    return robj
+
+  def _documents(self, results):
+    if self.bodies:
+      return [self.cls.load(self._riakObject(result)) for result in results]
+
+    keys = {}
+    for link in results:
+      keys.setdefault(link.get_bucket(), []).append(link.get_key())
+
+    docs = {}
+    for bucketName, bucketKeys in keys.iteritems():
+      for doc in self.cls.getMany(bucketKeys, cached=False, bucket=bucketName):
+        docs[doc.key] = doc
+
+    return [docs[link.get_key()] for link in results]
+
+  def chunks(self):
+    """A generator that goes through the documents a chunk at a time.
+
+    Returns:
+      A generator of lists of Documents.
+    """
+    results = self.riak_links
+    for i in xrange(0, len(results), self.chunk_size):
+      yield self._documents(results[i:i + self.chunk_size])
 
   def run(self):
-    """A generator that goes through riak_link"""
-    for link in self.riak_links:
-      yield self.cls.load(link.get())
+    """A generator that goes through all the documents."""
+    for chunk in self.chunks():
+      for doc in chunk:
+        yield doc
+
+  __iter__ = run
 
   def length(self):
     """The number of objects in this query.
@@ -84,4 +371,125 @@ class MapReduceQuery(object):
     Returns:
       A list containing all the Documents
     """
-    return map(lambda link: self.cls.load(link.get()), self.riak_links)
+    return list(self.run())
+
+  def aall(self):
+    """all() in the background. Returns a Future."""
+    return self.cls._submit(self.all)
+
+
+DEFAULT_INDEX_PAGE_SIZE = 1000
+
+def _encode(value):
+  return value.encode("utf-8") if isinstance(value, unicode) else str(value)
+
+class IndexQuery(object):
+  """Goes through the results of a secondary index query a page at a time.
+
+  Only one page is held at a time, so memory doesn't grow with the number of
+  keys that match. The keys of each page are fetched with a single paginated
+  2i request. This needs Riak 1.4+ and the HTTP transport: bucket.get_index
+  can't paginate in riak-python-client 1.x, so the request is made through the
+  transport directly.
+
+  Attributes:
+    cls: The class for this IndexQuery.
+    bucket: The bucket name. None for the default bucket.
+    index: The index field.
+    startkey: The starting key.
+    endkey: The ending key. None for an exact match.
+    page_size: The number of keys in a page.
+    keys_only: Yield keys instead of Documents.
+    concurrency: The maximum number of requests at the same time when fetching
+                 the documents of a page.
+    continuation: Where the next page starts. After a page has been fetched,
+                  this can be passed to a new IndexQuery to resume after it.
+                  None once there are no more pages.
+  """
+  def __init__(self, cls, index, startkey, endkey=None, bucket=None,
+               page_size=DEFAULT_INDEX_PAGE_SIZE, continuation=None,
+               keys_only=False, concurrency=DEFAULT_CONCURRENCY):
+    self.cls = cls
+    self.bucket = bucket
+    self.index = index
+    self.startkey = startkey
+    self.endkey = endkey
+    self.page_size = page_size
+    self.keys_only = keys_only
+    self.concurrency = concurrency
+    self.continuation = continuation
+    self._done = False
+
+  def _fetchKeys(self):
+    transport = self.cls.client.get_transport()
+    if not hasattr(transport, "get_request"):
+      raise RiakkitError("IndexQuery needs the HTTP transport.")
+
+    bucket = self.cls.buckets.get(self.bucket, self.cls.bucket)
+    segments = ["buckets", bucket.get_name(), "index", self.index, self.startkey]
+    if self.endkey is not None:
+      segments.append(self.endkey)
+    uri = "/".join(urllib.quote(_encode(segment), "") for segment in segments)
+    response = transport.get_request(uri, {"max_results" : self.page_size,
+                                           "continuation" : self.continuation})
+    transport.check_http_code(response, [200])
+
+    result = json.loads(response[1])
+    self.continuation = result.get("continuation", None)
+    self._done = self.continuation is None
+    return result["keys"]
+
+  def keys(self):
+    """A generator that goes through the keys that are left, without fetching
+    any document, no matter what keys_only is."""
+    while not self._done:
+      for key in self._fetchKeys():
+        yield key
+
+  def count(self):
+    """Counts every key that matches, with a MapReduce job over the index that
+    only sends back the count. This doesn't depend on the pages.
+
+    Returns:
+      An integer.
+    """
+    bucket = self.cls.bucket_name[0] if self.bucket is None else self.bucket
+    mr_obj = self.cls.client.index(bucket, self.index, self.startkey, self.endkey)
+    result = mr_obj.reduce(COUNT_REDUCE_FUNCTION).run()
+    return result[0] if result else 0
+
+  def pages(self):
+    """A generator that goes through the pages that are left.
+
+    Documents that are no longer found when they're fetched are skipped.
+
+    Returns:
+      A generator of lists of keys, or of Documents.
+    """
+    while not self._done:
+      keys = self._fetchKeys()
+      if self.keys_only:
+        yield keys
+      elif keys:
+        yield self.cls.getMany(keys, bucket=self.bucket, silent=True,
+                               concurrency=self.concurrency)
+
+  def run(self):
+    """A generator that goes through every key or Document that's left."""
+    for page in self.pages():
+      for item in page:
+        yield item
+
+  __iter__ = run
+
+  def all(self):
+    """Goes through every key or Document that's left at once.
+
+    Returns:
+      A list of keys, or of Documents.
+    """
+    return list(self.run())
+
+  def aall(self):
+    """all() in the background. Returns a Future."""
+    return self.cls._submit(self.all)
@@ -13,7 +13,7 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
 
-from riakkit.commons import walkParents, uuid1Key
+from riakkit.commons import mergeParentSchemas, uuid1Key
 from riakkit.commons.properties import BaseProperty, ReferenceBaseProperty
 from riakkit.commons.exceptions import ValidationError
 
@@ -26,18 +26,16 @@ class BaseDocumentMetaclass(type):
     if clsname in ("BaseDocument", "SimpleDocument"):
       return type.__new__(cls, clsname, parents, attrs)
 
-    meta = {}
+    meta = mergeParentSchemas(parents)
     for name in attrs.keys():
       if isinstance(attrs[name], BaseProperty):
         meta[name] = attrs.pop(name)
 
-    all_parents = reversed(walkParents(parents, ("BaseDocument", "SimpleDocument", "object", "type")))
-
-    for p_cls in all_parents:
-      meta.update(copy(p_cls._meta))
     attrs["_meta"] = meta
 
-    return type.__new__(cls, clsname, parents, attrs)
+    new_class = type.__new__(cls, clsname, parents, attrs)
+    compileSchema(new_class)
+    return new_class
 
   def __getattr__(self, name):
     if hasattr(self, "_meta") and name in self._meta:
@@ -47,6 +45,111 @@ class BaseDocumentMetaclass(type):
 DEFAULT_VALIDATOR = lambda x: True
 DEFAULT_CONVERTER = lambda x: x
 
+class PropertyDescriptor(object):
+  """The descriptor that's set on a document class for each of its properties.
+
+  Getting a property from a document is a single call to __get__, rather than
+  a failed lookup followed by __getattr__. Getting it from the class returns
+  the property itself.
+  """
+  def __init__(self, name, prop):
+    self.name = name
+    self.prop = prop
+    self.reference = isinstance(prop, ReferenceBaseProperty)
+
+  def __get__(self, doc, cls):
+    if doc is None:
+      return self.prop
+
+    try:
+      value = doc._data[self.name]
+    except KeyError:
+      doc._attrError(self.name)
+
+    if self.reference:
+      value = doc._data[self.name] = self.prop.attemptLoad(value)
+    return value
+
+  def __set__(self, doc, value):
+    doc.__setattr__(self.name, value)
+
+def compileSchema(cls):
+  """Builds the functions serialize and deserialize use for a class, and sets
+  up its properties for attribute access.
+
+  Everything that's needed from _meta is looked up once here rather than for
+  every field on every call. The results are set as cls._serializer,
+  cls._deserializer, cls._setters and cls._indexed (the indexed properties),
+  and a PropertyDescriptor is set on the class for each property. This needs
+  to be called again whenever _meta is changed.
+
+  If the class overrides validate(), serialize has to call it and
+  cls._serializer is set to None. Properties with the same name as something
+  else on the class (a method, for example) don't get a descriptor and are
+  accessed through __getattr__ like before.
+
+  Args:
+    cls: A BaseDocument subclass.
+  """
+  fields = {}
+  converters = {}
+  defaults = []
+  setters = {}
+  indexed = []
+  for name, prop in cls._meta.iteritems():
+    fields[name] = (unicode(name), prop.required, prop.validate, prop.convertToDb)
+    converters[name] = prop.convertFromDb
+    defaults.append((name, prop.defaultValue))
+    if prop.index:
+      indexed.append((unicode(name), prop.indexName(name), prop.indexValues))
+
+    if name.startswith("_"):
+      continue
+
+    setters[name] = (prop.validate, prop.standardize)
+    for c in cls.__mro__:
+      if name in c.__dict__:
+        if isinstance(c.__dict__[name], PropertyDescriptor):
+          setattr(cls, name, PropertyDescriptor(name, prop))
+        break
+    else:
+      setattr(cls, name, PropertyDescriptor(name, prop))
+
+  cls._setters = setters
+  cls._indexed = indexed
+  cls._indexNames = frozenset(indexName for name, indexName, indexValues in indexed)
+
+  def serializer(doc, data):
+    d = {}
+    for name, value in data.iteritems():
+      field = fields.get(name, None)
+      if field is None:
+        d[unicode(name)] = value
+        continue
+
+      uname, required, validate, converter = field
+      if (required and value is None) or not validate(value):
+        doc._valiError(value, name)
+      d[uname] = converter(value)
+    return d
+
+  def deserializer(data):
+    d = {}
+    for name, value in data.iteritems():
+      converter = converters.get(name, None)
+      d[name] = value if converter is None else converter(value)
+
+    for name, defaultValue in defaults:
+      if name not in d:
+        d[name] = defaultValue()
+    return d
+
+  if cls.validate.im_func is BaseDocument.validate.im_func:
+    cls._serializer = staticmethod(serializer)
+  else:
+    cls._serializer = None
+  cls._deserializer = staticmethod(deserializer)
+
 class BaseDocument(object):
   """The BaseDocument class is the lowest level of abstraction ther is. This
   is essentially what dictshield has, probably even simpler (having never used
@@ -104,9 +207,12 @@ class BaseDocument(object):
     Returns:
       A dictionary or a string. Depending on the value of dictionary.
     """
-    d = {}
-    for name, value in self._data.iteritems():
-      self._processOneValue(d, name, value)
+    if self._serializer is not None:
+      d = self._serializer(self, self._data)
+    else:
+      d = {}
+      for name, value in self._data.iteritems():
+        self._processOneValue(d, name, value)
 
     if dictionary:
       return d
@@ -185,22 +291,8 @@ class BaseDocument(object):
     if isinstance(data, basestring):
       data = json.loads(data)
 
-    self.clear()
-    keys = set(self._meta.keys())
-    for name, value in data.iteritems():
-      prop = self._meta.get(name, None)
-      if prop is not None:
-        converter = prop.convertFromDb
-      else:
-        converter = DEFAULT_CONVERTER
-
-      value = converter(value)
-      self._data[name] = value
-      keys.discard(name)
-
-    for name in keys:
-      self._data[name] = self._meta[name].defaultValue()
-
+    self.clear(False)
+    self._data = self._deserializer(data)
     return self
 
   def mergeData(self, data):
@@ -230,6 +322,7 @@ class BaseDocument(object):
     Returns:
       self for OOP"""
     self._data = {}
+    self._dirty = set()
 
     if setdefault:
       for name, prop in self._meta.iteritems():
@@ -238,21 +331,18 @@ class BaseDocument(object):
     return self
 
   def __setattr__(self, name, value):
-    if name.startswith("_"):
+    setter = self._setters.get(name, None)
+    if setter is not None:
+      validator, standardizer = setter
+      if not validator(value):
+        self._valiError(value, name)
+      value = standardizer(value)
+    elif name.startswith("_"):
       self.__dict__[name] = value
       return
 
-    validator = lambda x: True
-    standardizer = lambda x: x
-    if name in self._meta:
-      validator = self._meta[name].validate
-      standardizer = self._meta[name].standardize
-
-    if not validator(value):
-      self._valiError(value, name)
-
-    value = standardizer(value)
     self._data[name] = value
+    self._dirty.add(name)
 
   def __getattr__(self, name):
     if name in self._data:
@@ -269,6 +359,7 @@ class BaseDocument(object):
         self._data[name] = None
       else:
         del self._data[name]
+      self._dirty.add(name)
     else:
       raise KeyError("'%s'" % name)
 
@@ -465,17 +556,38 @@ class SimpleDocument(BaseDocument):
       A RiakObject with data, indexes, and links set according to this
       SimpleDocument
     """
-    obj = bucket.new(self.key, self.serialize())
-    obj.set_indexes(self.indexes())
+    data = self.serialize()
+    obj = bucket.new(self.key, data)
+    obj.set_indexes(self._indexesToBeSaved(data))
     obj.set_links(self.links(bucket), True)
     return obj
 
-  @staticmethod
-  def _getIndexesFromRiakObj(robj):
+  def _indexesToBeSaved(self, dataToBeSaved):
+    """Gets the indexes added with addIndex, plus the ones of the indexed
+    properties.
+
+    Args:
+      dataToBeSaved: The serialized data of this document.
+
+    Returns:
+      A list of (field, value) pairs friendly for set_indexes.
+    """
+    indexes = self.indexes()
+    for name, indexName, indexValues in self._indexed:
+      for value in indexValues(dataToBeSaved.get(name, None)):
+        indexes.append((indexName, value))
+    return indexes
+
+  @classmethod
+  def _getIndexesFromRiakObj(cls, robj):
+    """Gets the indexes of a RiakObject, except for the ones of the indexed
+    properties. Those come from the data."""
     objIndexes = robj.get_indexes()
     indexes = {}
     for indexEntry in objIndexes:
       field = indexEntry.get_field()
+      if field in cls._indexNames:
+        continue
       value = indexEntry.get_value()
       l = indexes.get(field, set())
       l.add(value)
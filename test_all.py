@@ -13,15 +13,29 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with RiakKit.  If not, see <http://www.gnu.org/licenses/>.
 
+import datetime
+import gc
+import itertools
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 import random
 import time
 
 from riakkit import *
 from riakkit.helpers import emailValidator, checkPassword
-from riakkit.commons import getUniqueListGivenBucketName
+from riakkit.commons import getUniqueListGivenBucketName, walkParents
+from riakkit.commons.cache import LRUCache
+from riakkit.commons.keygen import base62Key, sortableKey, encodeBase62
+from riakkit.simple.basedocument import PropertyDescriptor
+from riakkit.queries import SolrQuery
+from riakkit.journal import Journal, storeOp, deleteOp
 
 import riak
+from riak.metadata import MD_INDEX
+from riak.transports.transport import RiakTransport
 
 def integerkeys(d):
   if d is None:
@@ -153,6 +167,44 @@ class RiakkitBaseTest(unittest.TestCase):
   def test_getattr(self):
     self.assertRaises(AttributeError, lambda: self.testobj.none_exist)
 
+  def test_propertyDescriptors(self):
+    class ShadowingModel(SimpleDocument):
+      index = StringProperty()
+      s = StringProperty()
+
+    self.assertTrue(isinstance(TestModel.__dict__["intprop"], PropertyDescriptor))
+    self.assertTrue(isinstance(TestModel.intprop, IntegerProperty))
+    self.assertFalse("index" in ShadowingModel.__dict__)
+
+    obj = ShadowingModel(index="value", s=1)
+    self.assertEquals(u"1", obj.s)
+    self.assertEquals(u"1", obj["s"])
+    self.assertEquals("value", obj["index"])
+    self.assertTrue(callable(obj.index))
+
+    self.testobj.stringprop = " Descriptor "
+    self.assertEquals("descriptor", self.testobj.stringprop)
+    self.assertRaises(ValidationError, lambda: setattr(self.testobj, "listprop", []))
+    del self.testobj.stringprop
+    self.assertEquals(None, self.testobj.stringprop)
+
+  def test_compiledSchema(self):
+    class CustomValidateModel(BaseDocument):
+      intprop = IntegerProperty()
+
+      def validate(self, name):
+        return name != "intprop" or self._data[name] != 13
+
+    self.assertTrue(TestModel._serializer is not None)
+    self.assertTrue(CustomValidateModel._serializer is None)
+    self.assertRaises(ValidationError, CustomValidateModel(intprop=13).serialize)
+    self.assertEquals({u"intprop" : 12}, CustomValidateModel(intprop=12).serialize())
+
+    obj = TestModel().deserialize({"floatprop" : 1.0, "notinschema" : 1})
+    self.assertEquals(1, obj.notinschema)
+    self.assertTrue(10 <= obj.intprop <= 20)
+    self.assertEquals(None, obj.stringprop)
+
 ###############################################################################
 ###############################################################################
 ###############################################################################
@@ -191,6 +243,22 @@ class RiakkitSimpleTest(unittest.TestCase):
     self.assertRaises(NotImplementedError, obj.save)
     self.assertRaises(NotImplementedError, obj.reload)
 
+  def test_keyGenerators(self):
+    keys = set(base62Key({}) for i in xrange(1000))
+    self.assertEquals(1000, len(keys))
+    for key in keys:
+      self.assertEquals(22, len(key))
+      self.assertTrue(key.isalnum())
+
+    obj = SimpleModel(sortableKey)
+    self.assertEquals(22, len(obj.key))
+    time.sleep(0.002)
+    keys = [sortableKey({}) for i in xrange(3)]
+    self.assertTrue(obj.key < keys[0])
+    self.assertEquals(obj.key[:4], keys[0][:4])
+    self.assertEquals("00000001", encodeBase62(1, 8))
+    self.assertEquals("10", encodeBase62(62, 2))
+
   def test_objIndexes(self):
     obj = SimpleModel()
     self.assertEquals([], obj.indexes())
@@ -356,6 +424,57 @@ class TestMultipleBuckets(BaseDocumentModel):
 
   s = StringProperty()
 
+class TestLRUCache(BaseDocumentModel):
+  bucket_name = "test_lrucache"
+  cache_size = 2
+
+  s = StringProperty()
+
+class TestTTLCache(BaseDocumentModel):
+  bucket_name = "test_ttlcache"
+  cache_size = 10
+  cache_ttl = 0.05
+
+  s = StringProperty()
+
+class TestTTLOnlyCache(BaseDocumentModel):
+  bucket_name = "test_ttlonlycache"
+  cache_ttl = 0.05
+
+  s = StringProperty()
+
+class TestWriteBehind(BaseDocumentModel):
+  bucket_name = "test_writebehind"
+  write_behind = True
+  write_behind_size = 2
+  write_behind_interval = 0.1
+
+  s = StringProperty()
+
+class TestIndexedProperties(BaseDocumentModel):
+  bucket_name = "test_indexedprops"
+
+  s = StringProperty(index=True)
+  i = IntegerProperty(index=True)
+  dt = DateTimeProperty(index="when_int")
+  l = ListProperty(index=True)
+  f = FloatProperty(index=True)
+
+class TestInheritanceBase(BaseDocumentModel):
+  bucket_name = "test_inheritance_base"
+
+  name = StringProperty(unique=True)
+  value = IntegerProperty()
+
+class TestInheritanceChild(TestInheritanceBase):
+  bucket_name = "test_inheritance_child"
+
+  value = StringProperty()
+  other = StringProperty(unique=True)
+
+class TestInheritanceGrandchild(TestInheritanceChild):
+  bucket_name = "test_inheritance_grandchild"
+
 class RiakkitDocumentTests(unittest.TestCase):
   def _getRidOfPreviousUniqueUsername(self, username):
     c = riak.RiakClient()
@@ -425,6 +544,59 @@ class RiakkitDocumentTests(unittest.TestCase):
     del user1
     self.assertFalse(key in User.instances)
 
+  def test_cachePolicies(self):
+    keys = [TestLRUCache(s=str(i)).save().key for i in xrange(3)]
+    self.assertFalse(keys[0] in TestLRUCache.instances)
+    self.assertTrue(keys[1] in TestLRUCache.instances)
+    self.assertTrue(keys[2] in TestLRUCache.instances)
+    self.assertEquals(1, TestLRUCache.instances.stats()["evictions"])
+
+    stats = TestLRUCache.instances.stats()
+    TestLRUCache.get(keys[1])
+    TestLRUCache.get(keys[0])
+    self.assertEquals(stats["hits"] + 1, TestLRUCache.instances.hits)
+    self.assertEquals(stats["misses"] + 1, TestLRUCache.instances.misses)
+    self.assertFalse(keys[2] in TestLRUCache.instances)
+    for key in keys:
+      TestLRUCache.get(key).delete()
+
+    doc = TestTTLCache(s="ttl").save()
+    key = doc.key
+    del doc
+    self.assertTrue(key in TestTTLCache.instances)
+    time.sleep(0.1)
+    self.assertFalse(key in TestTTLCache.instances)
+    TestTTLCache.get(key).delete()
+
+    docs = [TestTTLOnlyCache(s=str(i)).save() for i in xrange(3)]
+    keys = [doc.key for doc in docs]
+    del docs
+    for key in keys:
+      self.assertTrue(key in TestTTLOnlyCache.instances)
+    time.sleep(0.1)
+    for key in keys:
+      self.assertFalse(key in TestTTLOnlyCache.instances)
+      TestTTLOnlyCache.get(key).delete()
+
+    # Without a maximum size, expired documents are still evicted as new ones
+    # are put in, and aren't counted in the size.
+    cache = LRUCache(None, 0.01)
+    for i in xrange(1000):
+      cache[i] = i
+    time.sleep(0.02)
+    for i in xrange(1000, 2000):
+      cache[i] = i
+    self.assertTrue(len(cache._items) <= 1000)
+    self.assertTrue(cache.evictions >= 1000)
+    self.assertTrue(cache.stats()["size"] <= 1000)
+    time.sleep(0.02)
+    self.assertEquals(0, cache.stats()["size"])
+
+    user = User(username="foo_weakcache", password="123")
+    evictions = User.instances.evictions
+    del user
+    self.assertEquals(evictions + 1, User.instances.evictions)
+
   def test_reload(self):
     user1 = User(username="foo_reload", password="123")
     user1.save()
@@ -448,6 +620,45 @@ class RiakkitDocumentTests(unittest.TestCase):
 
     user1.delete()
 
+  def test_reloadUnchanged(self):
+    user = User(username="foo_reloadUnchanged", password="123").save()
+    calls = []
+    def deserialize(data):
+      calls.append(data)
+      return User.deserialize(user, data)
+    user.__dict__["deserialize"] = deserialize
+
+    user.reload()
+    User.load(user.key)
+    self.assertEquals(0, len(calls))
+
+    user.email = "foo@reloadunchanged.com"
+    user.reload()
+    self.assertEquals(1, len(calls))
+    self.assertEquals(None, user.email)
+
+    c = riak.RiakClient()
+    o = c.bucket("test_users").get(user.key)
+    o.get_data()["lol"] = "moo"
+    o.store()
+    user.reload()
+    self.assertEquals(2, len(calls))
+    self.assertEquals("moo", user.lol)
+
+    user.delete()
+
+  def test_reloadAfterSave(self):
+    # A save keeps the data it sent, which JSON changes (int dict keys become
+    # strings), so the next reload must not be skipped even though the vclock
+    # is the same.
+    user = User(username="foo_reloadAfterSave", password="123")
+    user.scores = {42: 3.14}
+    user.save()
+    self.assertEquals({u"42": 3.14}, User.load(user.key, False).scores)
+    user.reload()
+    self.assertEquals({u"42": 3.14}, user.scores)
+    user.delete()
+
   def test_load(self):
     user1 = User(username="foo_load", password="123")
     user1.save()
@@ -476,6 +687,75 @@ class RiakkitDocumentTests(unittest.TestCase):
     self.assertEquals("foo_getOrNew2", someuser.username)
     someuser.delete()
 
+  def test_getMany(self):
+    users = [User(username="foo_getMany%d" % i, password="123").save() for i in xrange(3)]
+    keys = [u.key for u in users]
+    cachedUser = users[0]
+    del users
+
+    docs = User.getMany(keys)
+    self.assertEquals(keys, [d.key for d in docs])
+    self.assertTrue(docs[0] is cachedUser)
+    self.assertEquals("foo_getMany2", docs[2].username)
+
+    docs = User.getMany([keys[1], keys[1], keys[0]])
+    self.assertEquals([keys[1], keys[1], keys[0]], [d.key for d in docs])
+
+    self.assertRaises(NotFoundError, lambda: User.getMany([keys[0], "notakey"]))
+    docs = User.getMany(["notakey", keys[2]], silent=True)
+    self.assertEquals([keys[2]], [d.key for d in docs])
+
+    for d in User.getMany(keys):
+      d.delete()
+
+  def test_saveMany(self):
+    user = User(username="foo_saveMany", password="123")
+    comments = [Comment(author=user, content=str(i)) for i in xrange(3)]
+    Document.saveMany(comments)
+
+    self.assertTrue(User.exists(user.key))
+    user.reload()
+    self.assertEquals(3, len(user.comments))
+    self.assertEquals(set(c.key for c in comments), set(c.key for c in user.comments))
+
+    user2 = User(username="foo_saveMany", password="123")
+    comment = Comment(content="nope")
+    self.assertRaises(IntegrityError, lambda: Document.saveMany([comment, user2]))
+    self.assertFalse(Comment.exists(comment.key))
+
+    twins = [User(username="foo_saveManyTwin", password="123") for i in xrange(2)]
+    with RoundTripCounter() as counter:
+      self.assertRaises(IntegrityError, lambda: Document.saveMany(twins))
+    self.assertEquals(0, counter.counts["store"])
+    self.assertFalse(any(User.exists(twin.key) for twin in twins))
+
+    for c in comments:
+      c.delete()
+    user.delete()
+
+  def test_dirtyFields(self):
+    user = User(username="foo_dirty", password="123").save()
+    self.assertEquals(set(), user._changedFields())
+
+    user.email = "foo@dirty.com"
+    self.assertEquals({"email"}, user._changedFields())
+    user.save()
+    self.assertEquals(set(), user._changedFields())
+
+    user.password.hash = "modified in place"
+    self.assertEquals({"password"}, user._changedFields())
+    user.save()
+
+    user.addIndex("field_bin", "dirty")
+    self.assertTrue(user._unchanged(set()) is False)
+    user.save()
+    user.reload()
+    self.assertEquals({"dirty"}, user.index("field_bin"))
+    self.assertEquals("foo@dirty.com", user.email)
+    self.assertEquals("modified in place", user.password.hash)
+
+    user.delete()
+
   def test_2i(self):
     user1 = User(username="foo_2i", password="123")
     user1.addIndex("field_bin", "lol")
@@ -495,6 +775,198 @@ class RiakkitDocumentTests(unittest.TestCase):
 
     user1.delete()
 
+  def test_2iBodies(self):
+    user1 = User(username="foo_2iBodies", password="123")
+    user1.addIndex("field_bin", "bodies")
+    user1.save()
+
+    q = User.indexLookup("field_bin", "bodies", bodies=True)
+    self.assertTrue(q._results is None) # Nothing ran yet.
+    with RoundTripCounter() as counter:
+      users = q.all()
+    self.assertEquals(0, counter.counts["get"])
+    self.assertEquals(1, len(users))
+    self.assertTrue(users[0] is user1)
+    self.assertEquals("foo_2iBodies", users[0].username)
+    self.assertEquals({"bodies"}, users[0].index("field_bin"))
+
+    user1.delete()
+
+  def test_mapReduceChunks(self):
+    users = [User(username="foo_mrChunks%d" % i, password="123") for i in xrange(5)]
+    for user in users:
+      user.addIndex("field_bin", "chunks")
+    User.saveMany(users)
+
+    q = User.indexLookup("field_bin", "chunks")
+    q.chunk_size = 2
+    chunks = list(q.chunks())
+    self.assertEquals([2, 2, 1], [len(chunk) for chunk in chunks])
+    self.assertEquals(sorted(u.key for u in users),
+                      sorted(u.key for chunk in chunks for u in chunk))
+
+    for user in users:
+      user.delete()
+
+  def test_queryKeysAndCount(self):
+    users = [User(username="foo_keysAndCount%d" % i, password="123") for i in xrange(3)]
+    for user in users:
+      user.addIndex("field_bin", "keysAndCount")
+    User.saveMany(users)
+    keys = sorted(user.key for user in users)
+
+    with RoundTripCounter() as counter:
+      for bodies in (False, True):
+        q = User.indexLookup("field_bin", "keysAndCount", bodies=bodies)
+        self.assertEquals(3, q.count())
+        self.assertTrue(q._results is None)
+        self.assertEquals(keys, sorted(q.keys()))
+
+      q = User.indexQuery("field_bin", "keysAndCount", page_size=2)
+      self.assertEquals(3, q.count())
+      self.assertEquals(keys, sorted(q.keys()))
+    self.assertEquals(0, counter.counts["get"])
+
+    for user in users:
+      user.delete()
+
+  def test_mapReduceOrderLimit(self):
+    models = [SearchableModel(intprop=i) for i in (3, 1, 4, 2)]
+    for m in models:
+      m.addIndex("field_bin", "orderLimit")
+    SearchableModel.saveMany(models)
+
+    for bodies in (False, True):
+      q = SearchableModel.indexLookup("field_bin", "orderLimit", bodies=bodies)
+      self.assertEquals([1, 2, 3, 4], [m.intprop for m in q.orderBy("intprop")])
+      q.orderBy("intprop", descending=True).limit(2)
+      self.assertEquals(2, q.count())
+      self.assertEquals([4, 3], [m.intprop for m in q])
+      self.assertEquals([models[2].key, models[0].key], q.keys())
+
+    q = SearchableModel.indexLookup("field_bin", "orderLimit").limit(3)
+    self.assertEquals(3, len(q.all()))
+
+    for m in models:
+      m.delete()
+
+  def test_lazyBuckets(self):
+    class CountingClient(riak.RiakClient):
+      def __init__(self):
+        riak.RiakClient.__init__(self)
+        self.created = []
+
+      def bucket(self, name):
+        self.created.append(name)
+        return riak.RiakClient.bucket(self, name)
+
+    counting = CountingClient()
+    class TestLazyBuckets(Document):
+      bucket_name = "test_lazybuckets"
+      client = counting
+
+      s = StringProperty(unique=True)
+
+    class TestLazyBucketsChild(TestLazyBuckets):
+      pass
+
+    self.assertEquals([], counting.created)
+    self.assertTrue(TestLazyBuckets.bucket is TestLazyBucketsChild.bucket)
+    self.assertTrue(TestLazyBuckets.bucket is TestLazyBuckets.buckets["test_lazybuckets"])
+    self.assertEquals(["test_lazybuckets"], counting.created)
+
+    d = TestLazyBuckets(s="lazy").save()
+    self.assertEquals(["test_lazybuckets", getUniqueListGivenBucketName("test_lazybuckets", "s")],
+                      counting.created)
+
+    other = CountingClient()
+    TestLazyBuckets.client = other
+    self.assertTrue(TestLazyBuckets.exists(d.key))
+    d.delete()
+    self.assertEquals(["test_lazybuckets", getUniqueListGivenBucketName("test_lazybuckets", "s")],
+                      other.created)
+
+  def test_indexedProperties(self):
+    when = datetime.datetime(2012, 10, 1, 12, 30)
+    d = TestIndexedProperties(s="hello", i=5, dt=when, l=["a", "b"])
+    d.addIndex("field_bin", "manual")
+    d.addIndex("x_int", 5)
+    d.save()
+
+    # riak-python-client stores every index value as a string.
+    robj = TestIndexedProperties.bucket.get(d.key)
+    indexes = sorted((e.get_field(), e.get_value()) for e in robj.get_indexes())
+    self.assertEquals([("field_bin", "manual"), ("i_int", "5"), ("l_bin", "a"),
+                       ("l_bin", "b"), ("s_bin", "hello"),
+                       ("when_int", str(int(time.mktime(when.timetuple())))),
+                       ("x_int", "5")], indexes)
+    self.assertEquals([("field_bin", "manual"), ("x_int", 5)], sorted(d.indexes()))
+    with RoundTripCounter() as counter:
+      d.save()
+    self.assertEquals(0, counter.counts["store"])
+
+    d.reload()
+    self.assertEquals([("field_bin", "manual"), ("x_int", "5")], sorted((f, str(v)) for f, v in d.indexes()))
+    with RoundTripCounter() as counter:
+      d.save()
+    self.assertEquals(0, counter.counts["store"])
+
+    self.assertEquals([d.key], TestIndexedProperties.filterBy("s", "hello").keys())
+    self.assertEquals([d.key], TestIndexedProperties.filterBy("i", (4, 6)).keys())
+    self.assertEquals([d.key], TestIndexedProperties.filterBy("l", "b").keys())
+    self.assertEquals([d.key], TestIndexedProperties.filterBy("dt", (when - datetime.timedelta(1), when)).keys())
+
+    d.i = 7
+    d.save()
+    self.assertEquals([], TestIndexedProperties.filterBy("i", 5).keys())
+    self.assertEquals([d.key], TestIndexedProperties.filterBy("i", 7).keys())
+    self.assertRaises(AttributeError, TestIndexedProperties.filterBy, "nope", 1)
+
+    d.delete()
+
+  def test_floatIndex(self):
+    docs = [TestIndexedProperties(f=f) for f in (-10.5, -2.0, 0.0, 9.5, 10.25, 100.0)]
+    Document.saveMany(docs)
+    keys = lambda *ds: sorted(d.key for d in ds)
+    filterBy = lambda value: sorted(TestIndexedProperties.filterBy("f", value).keys())
+
+    self.assertEquals(keys(docs[3], docs[4]), filterBy((9, 11)))
+    self.assertEquals(keys(docs[4]), filterBy((10, 11)))
+    self.assertEquals(keys(*docs[:3]), filterBy((-20, 0)))
+    self.assertEquals(keys(docs[2]), filterBy(-0.0))
+    self.assertEquals(keys(docs[4]), filterBy(10.25))
+    self.assertEquals(sorted(sortableNumber(f) for f in (-10.5, -2, 0, 9.5, 10.25, 100)),
+                      [sortableNumber(f) for f in (-10.5, -2, 0, 9.5, 10.25, 100)])
+
+    Document.deleteMany(docs)
+
+  def test_indexQuery(self):
+    users = [User(username="foo_indexQuery%d" % i, password="123") for i in xrange(5)]
+    for user in users:
+      user.addIndex("field_bin", "indexQuery")
+    User.saveMany(users)
+    keys = sorted(user.key for user in users)
+
+    q = User.indexQuery("field_bin", "indexQuery", page_size=2, keys_only=True)
+    pages = q.pages()
+    first = pages.next()
+    self.assertEquals(2, len(first))
+    self.assertTrue(q.continuation is not None)
+
+    q2 = User.indexQuery("field_bin", "indexQuery", page_size=2,
+                         continuation=q.continuation, keys_only=True)
+    self.assertEquals([2, 1], [len(page) for page in q2.pages()])
+    self.assertTrue(q2.continuation is None)
+    self.assertEquals(keys, sorted(first + list(pages.next()) + list(pages.next())))
+    self.assertRaises(StopIteration, pages.next)
+
+    q = User.indexQuery("field_bin", "indexQuery", page_size=2)
+    self.assertEquals(sorted(user.username for user in users),
+                      sorted(user.username for user in q))
+
+    for user in users:
+      user.delete()
+
   def test_reloadWith2i(self):
     user1 = User(username="foo_reloadWith2i", password="123")
     user1.addIndex("field_bin", "lol")
@@ -613,6 +1085,53 @@ class RiakkitDocumentTests(unittest.TestCase):
     comment2.delete()
     user.delete()
 
+  def test_lazyReferenceList(self):
+    user = User(username="lazyreflist", password="123")
+    comments = [Comment(author=user, content=str(i)) for i in xrange(5)]
+    Document.saveMany(comments)
+    keys = list(c.key for c in comments)
+    userkey = user.key
+    del user, comments
+    gc.collect() # The user and its comments reference each other.
+
+    user = User.load(userkey)
+    pageSize = User._meta["comments"].page_size
+    User._meta["comments"].page_size = 2
+    self.assertTrue(isinstance(user.comments, MultiReferenceProperty.LazyReferenceList))
+    self.assertEquals(5, len(user.comments))
+    self.assertTrue(all(isinstance(c, basestring) for c in list.__iter__(user.comments)))
+    self.assertTrue(user.comments == keys)
+    self.assertFalse(user.comments != keys)
+    self.assertTrue(user.comments != keys[1:])
+    self.assertTrue(all(isinstance(c, basestring) for c in list.__iter__(user.comments)))
+
+    self.assertEquals(keys[3], user.comments[3].key)
+    loaded = [not isinstance(c, basestring) for c in list.__iter__(user.comments)]
+    self.assertEquals([False, False, True, True, False], loaded)
+
+    self.assertEquals(keys[::-2], [c.key for c in user.comments[::-2]])
+    self.assertEquals(keys[1::-1], [c.key for c in user.comments[1::-1]])
+    self.assertEquals([], user.comments[3:1])
+
+    self.assertEquals(keys[1:3], [c.key for c in user.comments[1:3]])
+    self.assertEquals(keys[-1], user.comments[-1].key)
+    self.assertEquals(keys, [c.key for c in user.comments])
+    self.assertEquals(list(user.comments), user.comments)
+    self.assertEquals(user.comments, [Comment.load(key) for key in keys])
+
+    user.comments.remove(keys[0])
+    self.assertEquals(keys[1:], user.comments.keys())
+    User._meta["comments"].page_size = pageSize
+
+    loaded = [Comment.load(key) for key in keys]
+    lazy = MultiReferenceProperty.LazyReferenceList(User._meta["comments"], keys)
+    self.assertEquals(repr(loaded), repr(lazy))
+
+    for c in list(user.comments):
+      c.delete()
+    Comment.load(keys[0]).delete()
+    user.delete()
+
   def test_nonstrictRef(self):
     a = TestNonStrictReferenceDocument(r="non-existing")
     a.rl.append("nope")
@@ -654,6 +1173,20 @@ class RiakkitDocumentTests(unittest.TestCase):
     user2.delete()
     comment.delete()
 
+  def test_inheritance(self):
+    self.assertEquals(set(["name", "value", "other"]), set(TestInheritanceGrandchild._meta))
+    self.assertEquals(["name", "other"], sorted(TestInheritanceGrandchild._uniques))
+    self.assertTrue(isinstance(TestInheritanceChild._meta["value"], StringProperty))
+    self.assertTrue(isinstance(TestInheritanceGrandchild._meta["value"], StringProperty))
+    self.assertTrue(isinstance(TestInheritanceBase._meta["value"], IntegerProperty))
+    self.assertEquals([TestInheritanceGrandchild, TestInheritanceChild, TestInheritanceBase, BaseDocumentModel],
+                      walkParents([TestInheritanceGrandchild]))
+
+    d = TestInheritanceGrandchild(name="inherited", value="a string")
+    d.save()
+    self.assertTrue(TestInheritanceBase._meta["name"].hasValue("inherited"))
+    d.delete()
+
   def test_uniques(self):
     user1 = User()
     user1.username = "foo"
@@ -677,6 +1210,366 @@ class RiakkitDocumentTests(unittest.TestCase):
     self.assertEquals(1, user2.someprop)
     user2.delete()
 
+  def test_multipleUniques(self):
+    user1 = User(username="foo_multipleUniques", password="123", email="multiple@uniques.com")
+    user1.save()
+
+    user2 = User(username="foo_multipleUniques", password="123", email="multiple@uniques.com")
+    try:
+      user2.save()
+    except IntegrityError, e:
+      self.assertEquals(User._uniques[0], e.field)
+    else:
+      self.fail("IntegrityError not raised")
+    self.assertFalse(User.exists(user2.key))
+
+    user1.username = "foo_multipleUniques2"
+    user1.email = "multiple2@uniques.com"
+    user1.save()
+    for name, value in (("username", "foo_multipleUniques"), ("email", "multiple@uniques.com")):
+      self.assertFalse(User._meta[name].hasValue(value))
+    for name, value in (("username", "foo_multipleUniques2"), ("email", "multiple2@uniques.com")):
+      self.assertTrue(User._meta[name].hasValue(value))
+
+    user1.delete()
+    self.assertFalse(User._meta["username"].hasValue("foo_multipleUniques2"))
+    self.assertFalse(User._meta["email"].hasValue("multiple2@uniques.com"))
+
+  def test_bloomFilters(self):
+    user1 = User(username="foo_bloomFilters", password="123", email="bloom@filters.com").save()
+    stats = User.buildFilters()
+    try:
+      self.assertTrue(stats["keys"][User.bucket_name[0]]["count"] >= 1)
+      self.assertEquals(set(User._uniques), set(stats["uniques"].keys()))
+
+      with RoundTripCounter() as counter:
+        self.assertFalse(User.exists("not_a_user_bloomFilters"))
+        self.assertFalse(User._meta["username"].hasValue("not_a_user_bloomFilters"))
+      self.assertEquals(0, counter.counts["get"])
+      self.assertTrue(User.exists(user1.key))
+      self.assertTrue(User._meta["username"].hasValue("foo_bloomFilters"))
+
+      user2 = User(username="foo_bloomFilters2", password="123").save()
+      self.assertTrue(User.exists(user2.key))
+      self.assertTrue(User._meta["username"].hasValue("foo_bloomFilters2"))
+      self.assertRaises(IntegrityError, User(username="foo_bloomFilters2", password="123").save)
+
+      user1.delete()
+      user2.delete()
+      self.assertFalse(User.exists(user2.key))
+      self.assertFalse(User._meta["username"].hasValue("foo_bloomFilters2"))
+    finally:
+      User._keyFilters = {}
+      for name in User._uniques:
+        User._meta[name].filter = None
+
+  def test_session(self):
+    user = User(username="foo_session", password="123").save()
+    key = user.key
+
+    with RoundTripCounter() as counter:
+      with session() as s:
+        with session() as inner:
+          self.assertTrue(inner is s)
+        u = User.get(key)
+        self.assertFalse(u is user)
+        self.assertTrue(User.get(key) is u)
+
+        c1 = Comment(author=u, content="1").save()
+        c2 = Comment(author=u, content="2").save()
+        c2.save()
+        self.assertEquals(0, counter.counts["store"])
+    # The comments, and the user once.
+    self.assertEquals(3, counter.counts["store"])
+    self.assertTrue(User.get(key) is user)
+    self.assertEquals({c1.key, c2.key}, set(c.key for c in User.get(key, False).comments))
+
+    try:
+      with session():
+        c2.content = "changed"
+        c2.save()
+        raise ValueError
+    except ValueError:
+      pass
+    self.assertEquals("2", Comment.get(c2.key).content)
+
+    with session():
+      c1.delete()
+      user.delete()
+      c2.delete()
+      self.assertTrue(User.exists(key))
+    self.assertFalse(User.exists(key))
+    self.assertFalse(Comment.exists(c1.key))
+    self.assertFalse(Comment.exists(c2.key))
+    self.assertFalse(User._meta["username"].hasValue("foo_session"))
+
+  def test_asyncMethods(self):
+    futures = [SearchableModel(intprop=i).asave() for i in xrange(5)]
+    docs = [f.result(5) for f in futures]
+    keys = [doc.key for doc in docs]
+    self.assertTrue(all(SearchableModel.aexists(key).result(5) for key in keys))
+    self.assertTrue(SearchableModel.aget(keys[0]).result(5) is docs[0])
+    self.assertEquals(range(5), [d.intprop for d in SearchableModel.agetMany(keys).result(5)])
+
+    future = SearchableModel.aget("not_a_key_asyncMethods")
+    self.assertRaises(NotFoundError, future.result, 5)
+    self.assertTrue(isinstance(future.exception(), NotFoundError))
+
+    called = []
+    future = docs[0].areload()
+    future.addDoneCallback(called.append)
+    future.result(5)
+    future.addDoneCallback(called.append)
+    self.assertEquals([future, future], called)
+
+    with session():
+      docs[1].intprop = 42
+      docs[1].asave().result(5)
+      with RoundTripCounter() as counter:
+        docs[1].adelete().result(5)
+      self.assertEquals(0, counter.counts["delete"])
+      self.assertTrue(SearchableModel.aexists(docs[1].key).result(5))
+    self.assertFalse(SearchableModel.exists(docs[1].key))
+
+    def slowSave():
+      time.sleep(0.1)
+      return docs[2].save()
+    with session():
+      docs[2].intprop = 43
+      future = SearchableModel._submit(slowSave)
+    self.assertTrue(future.done())
+    self.assertEquals(43, SearchableModel.bucket.get(docs[2].key).get_data()["intprop"])
+
+    Document.adeleteMany(docs).result(5)
+    self.assertFalse(any(SearchableModel.exists(key) for key in keys))
+
+  def test_concurrentAget(self):
+    key = SearchableModel(intprop=1).save().key
+    gc.collect()
+    self.assertFalse(key in SearchableModel.instances)
+    original = riak.RiakObject.reload
+    def slowReload(robj, *args, **kwargs): # So that every fetch overlaps.
+      time.sleep(0.05)
+      return original(robj, *args, **kwargs)
+
+    riak.RiakObject.reload = slowReload
+    try:
+      futures = [SearchableModel.aget(key) for i in xrange(8)]
+      docs = [future.result(5) for future in futures]
+    finally:
+      riak.RiakObject.reload = original
+    self.assertTrue(all(doc is docs[0] for doc in docs))
+    self.assertEquals(1, docs[0].intprop)
+    docs[0].delete()
+
+  def test_sessionBackgroundSaves(self):
+    docs = [SearchableModel(intprop=i) for i in xrange(200)]
+    with session():
+      for doc in docs:
+        doc.asave()
+    self.assertTrue(all(SearchableModel.exists(doc.key) for doc in docs))
+    Document.deleteMany(docs)
+
+  def test_futureTimeout(self):
+    from riakkit.commons.pool import submit
+    future = submit(time.sleep, 0.2)
+    self.assertRaises(TimeoutError, future.result, 0.01)
+    self.assertFalse(future.done())
+    self.assertEquals(None, future.result(5))
+    self.assertTrue(future.done())
+
+  def test_writeBehind(self):
+    before = TestWriteBehind.writeBehindStats()
+    docs = [TestWriteBehind(s="a") for i in xrange(3)]
+    docs[0].save()
+    docs[0].s = "b"
+    docs[0].save()
+    docs[1].save()
+    docs[2].save() # The queue is full, this waits for the first batch.
+    stats = TestWriteBehind.writeBehindStats()
+    self.assertEquals(4, stats["enqueued"] - before["enqueued"])
+    self.assertEquals(1, stats["coalesced"] - before["coalesced"])
+    self.assertEquals(1, stats["blocked"] - before["blocked"])
+    self.assertEquals(2, stats["max_depth"])
+
+    self.assertTrue(TestWriteBehind.flushWriteBehind(5))
+    stats = TestWriteBehind.writeBehindStats()
+    self.assertEquals(3, stats["stored"] - before["stored"])
+    self.assertEquals(0, stats["depth"])
+    self.assertEquals(0, stats["failed"] - before["failed"])
+    self.assertEquals("b", TestWriteBehind.get(docs[0].key, False).s)
+    self.assertTrue(TestWriteBehind.exists(docs[2].key))
+
+    doc = TestWriteBehind(s="c").save()
+    doc.delete()
+    self.assertTrue(TestWriteBehind.flushWriteBehind(5))
+    self.assertFalse(TestWriteBehind.exists(doc.key))
+
+    for doc in docs:
+      doc.delete()
+
+    def defineUniqueWriteBehind():
+      class TestUniqueWriteBehind(BaseDocumentModel):
+        bucket_name = "test_uniquewritebehind"
+        write_behind = True
+        s = StringProperty(unique=True)
+    self.assertRaises(RiakkitError, defineUniqueWriteBehind)
+    self.assertEquals(None, User.writeBehindStats())
+
+  def test_journal(self):
+    directory = tempfile.mkdtemp()
+    try:
+      journal = Journal(directory, segment_size=200)
+      first = journal.begin([storeOp("test_journal", "a", {"n" : 1})])
+      second = journal.begin([deleteOp("test_journal", "b")])
+      self.assertEquals([], journal.pending()) # Both are being carried out.
+      journal.done(first)
+      journal.release(second)
+      self.assertEquals([(second, [["delete", "test_journal", "b"]])], journal.pending())
+      for i in xrange(10):
+        journal.done(journal.begin([storeOp("test_journal", "c", {"n" : i})]))
+      journal.close()
+      # The first segment has a plan that's not done, so none is deleted.
+      self.assertTrue(journal.stats()["segments"] > 2)
+      self.assertEquals(journal.stats()["segments"], len(os.listdir(directory)))
+      with open(os.path.join(directory, sorted(os.listdir(directory))[-1]), "a") as f:
+        f.write('["plan", "torn')
+
+      journal = Journal(directory)
+      self.assertEquals([second], [planId for planId, ops in journal.pending()])
+      self.assertEquals(1, journal.replay(riak.RiakClient()))
+      self.assertEquals(0, journal.stats()["pending"])
+      self.assertEquals(1, len(os.listdir(directory))) # Only the current one.
+      journal.close()
+      self.assertEquals([], Journal(directory).pending())
+
+      # A plan with a part that failed stays pending, whatever the order.
+      journal = Journal(directory)
+      releasedFirst = journal.begin([storeOp("test_journal", "f", {"n" : 1})], 2)
+      journal.release(releasedFirst)
+      journal.done(releasedFirst)
+      doneFirst = journal.begin([storeOp("test_journal", "g", {"n" : 1})], 2)
+      journal.done(doneFirst)
+      journal.release(doneFirst)
+      journal.done(doneFirst)
+      self.assertEquals([releasedFirst, doneFirst], [planId for planId, ops in journal.pending()])
+      journal.close()
+      journal = Journal(directory)
+      self.assertEquals([releasedFirst, doneFirst], [planId for planId, ops in journal.pending()])
+      self.assertEquals(2, journal.replay(riak.RiakClient()))
+      self.assertEquals([], journal.pending())
+      journal.close()
+
+      # A plan that's done drops what older plans would write to its objects.
+      journal = Journal(directory)
+      older = journal.begin([storeOp("test_journal", "d", {"n" : 1}),
+                             storeOp("test_journal", "e", {"n" : 1})])
+      oldest = journal.begin([storeOp("test_journal", "e", {"n" : 0})])
+      journal.release(older)
+      journal.release(oldest)
+      journal.done(journal.begin([storeOp("test_journal", "e", {"n" : 2})]))
+      expected = [(older, [["store", "test_journal", "d", {"n" : 1}, [], []]])]
+      self.assertEquals(expected, journal.pending())
+      self.assertEquals(1, journal.stats()["superseded"])
+      journal.close()
+      self.assertEquals(expected, Journal(directory).pending())
+    finally:
+      shutil.rmtree(directory)
+
+  def test_journalReplay(self):
+    directory = tempfile.mkdtemp()
+    User.journal = Journal(directory)
+    original = riak.RiakObject.store
+    def failingStore(robj, *args, **kwargs):
+      if robj.get_bucket().get_name().startswith("_"):
+        raise IOError("unique bucket down")
+      return original(robj, *args, **kwargs)
+
+    try:
+      user = User(username="foo_journal", password="123")
+      riak.RiakObject.store = failingStore
+      try:
+        self.assertRaises(IOError, user.save)
+      finally:
+        riak.RiakObject.store = original
+      self.assertTrue(User.exists(user.key))
+      self.assertFalse(User._meta["username"].hasValue("foo_journal"))
+      self.assertEquals(1, len(User.journal.pending()))
+
+      self.assertEquals(1, User.replayJournal())
+      self.assertTrue(User._meta["username"].hasValue("foo_journal"))
+      self.assertEquals(0, User.replayJournal())
+
+      def failingUserStore(robj, *args, **kwargs):
+        if robj.get_bucket().get_name() == "test_users":
+          raise IOError("users bucket down")
+        return original(robj, *args, **kwargs)
+
+      # Failed, then saved again: the failed plan is dropped.
+      user.email = "old@journal.com"
+      riak.RiakObject.store = failingUserStore
+      try:
+        self.assertRaises(IOError, user.save)
+      finally:
+        riak.RiakObject.store = original
+      self.assertEquals(1, len(User.journal.pending()))
+      user.email = "new@journal.com"
+      user.save()
+      self.assertEquals(0, len(User.journal.pending()))
+      self.assertEquals(0, User.replayJournal())
+      self.assertEquals("new@journal.com", User.bucket.get(user.key).get_data()["email"])
+
+      # Failed, then written by someone else: the plan is skipped.
+      user.email = "stale@journal.com"
+      riak.RiakObject.store = failingUserStore
+      try:
+        self.assertRaises(IOError, user.save)
+      finally:
+        riak.RiakObject.store = original
+      robj = User.bucket.get(user.key)
+      robj.get_data()["email"] = "other@journal.com"
+      robj.store()
+      skipped = User.journal.stats()["skipped"]
+      self.assertEquals(0, User.replayJournal())
+      self.assertEquals(skipped + 1, User.journal.stats()["skipped"])
+      self.assertEquals("other@journal.com", User.bucket.get(user.key).get_data()["email"])
+      user.reload()
+
+      TestWriteBehind.journal = User.journal
+      try:
+        doc = TestWriteBehind(s="journaled").save()
+        self.assertEquals(1, User.journal.stats()["pending"])
+        self.assertTrue(TestWriteBehind.flushWriteBehind(5))
+        self.assertEquals(0, User.journal.stats()["pending"])
+        doc.delete()
+      finally:
+        TestWriteBehind.journal = None
+
+      comment = Comment(author=user, content="journaled").save()
+      comment.delete()
+      stats = User.journal.stats()
+      self.assertEquals(0, stats["pending"])
+      self.assertEquals(stats["plans"], stats["done"] + stats["superseded"])
+      user.delete()
+    finally:
+      User.journal.close()
+      User.journal = None
+      shutil.rmtree(directory)
+
+  def test_deserializeThenSave(self):
+    m = SearchableModel(intprop=1).save()
+    m.deserialize({"intprop" : 2})
+    m.save()
+    self.assertEquals(2, m._obj.get_data()["intprop"])
+    self.assertEquals(2, SearchableModel.get(m.key, False).intprop)
+
+    m.clear()
+    m.save()
+    self.assertEquals(None, m._obj.get_data()["intprop"])
+    m.reload()
+    self.assertEquals(None, m.intprop)
+    m.delete()
+
   def test_passwordProperty(self):
     user = User()
     def t():
@@ -723,6 +1616,41 @@ class RiakkitDocumentTests(unittest.TestCase):
     m2.delete()
     m3.delete()
 
+  def test_solrHydrate(self):
+    m1 = SearchableModel(intprop=2)
+    m1.addIndex("field_bin", "hydrate")
+    m1.save()
+    m2 = SearchableModel(intprop=3).save()
+    keys = [m1.key, m2.key]
+    del m1, m2
+    gc.collect()
+
+    # What solr gives back. The second result doesn't have intprop stored.
+    result = {u"num_found" : 2, u"docs" : [{u"id" : keys[0], u"intprop" : u"2"},
+                                           {u"id" : keys[1]}]}
+    q = SolrQuery(SearchableModel, result, hydrate=True)
+    self.assertEquals(2, q.count())
+    self.assertEquals(keys, q.keys())
+    with RoundTripCounter() as counter:
+      m1, m2 = q.all()
+    self.assertEquals(1, counter.counts["get"])
+    self.assertEquals([2, 3], [m1.intprop, m2.intprop])
+    self.assertEquals(keys, [m1.key, m2.key])
+
+    with RoundTripCounter() as counter:
+      self.assertEquals({"hydrate"}, m1.index("field_bin"))
+      m1.intprop = 5
+      m1.save()
+    self.assertEquals(1, counter.counts["get"])
+    self.assertEquals(1, counter.counts["store"])
+
+    m1.reload()
+    self.assertEquals(5, m1.intprop)
+    self.assertEquals({"hydrate"}, m1.index("field_bin"))
+
+    m1.delete()
+    m2.delete()
+
   def test_emdocumentWithReference(self):
     # Since there's no collection_names, no ensuring that saving d will save m.
     # TODO: Fix this?
@@ -738,6 +1666,233 @@ class RiakkitDocumentTests(unittest.TestCase):
     d.delete()
     m.delete()
 
+class RoundTripCounter(object):
+  """Counts the requests made to Riak while it's active.
+
+  Every request made by riak-python-client goes through RiakObject.reload,
+  RiakObject.store or RiakObject.delete (bucket.get calls reload), so those are
+  wrapped for the duration of the with block.
+  """
+  operations = {"reload" : "get", "store" : "store", "delete" : "delete"}
+
+  def __init__(self):
+    self.counts = {"get" : 0, "store" : 0, "delete" : 0}
+    self._originals = {}
+
+  def _counted(self, original, op):
+    def f(*args, **kwargs):
+      self.counts[op] += 1
+      return original(*args, **kwargs)
+    return f
+
+  def __enter__(self):
+    for name, op in self.operations.iteritems():
+      original = riak.RiakObject.__dict__[name]
+      self._originals[name] = original
+      setattr(riak.RiakObject, name, self._counted(original, op))
+    return self
+
+  def __exit__(self, *args):
+    for name, original in self._originals.iteritems():
+      setattr(riak.RiakObject, name, original)
+    return False
+
+class RiakkitRoundTripTests(unittest.TestCase):
+  # The budgets here are the maximum number of requests each public operation
+  # is allowed to make. If one of these fails, something got slower.
+  def assertRoundTrips(self, budget, counter):
+    for op, count in counter.counts.iteritems():
+      self.assertTrue(count <= budget.get(op, 0),
+          "%d %s requests, budget is %d" % (count, op, budget.get(op, 0)))
+
+  def test_loadRoundTrips(self):
+    user = User(username="foo_rtload", password="123").save()
+    key = user.key
+    del user
+
+    with RoundTripCounter() as counter:
+      user = User.load(key)
+    self.assertRoundTrips({"get" : 1}, counter)
+
+    with RoundTripCounter() as counter:
+      User.load(key, True)
+    self.assertRoundTrips({}, counter)
+
+    with RoundTripCounter() as counter:
+      User.load(key)
+    self.assertRoundTrips({"get" : 1}, counter)
+
+    user.delete()
+
+  def test_getRoundTrips(self):
+    user = User(username="foo_rtget", password="123").save()
+    key = user.key
+
+    with RoundTripCounter() as counter:
+      User.get(key)
+    self.assertRoundTrips({}, counter)
+
+    del user
+    with RoundTripCounter() as counter:
+      user = User.get(key)
+    self.assertRoundTrips({"get" : 1}, counter)
+
+    user.delete()
+
+  def test_getOrNewRoundTrips(self):
+    with RoundTripCounter() as counter:
+      user = User.getOrNew("rtgetornew", username="foo_rtgetornew", password="123")
+    self.assertRoundTrips({"get" : 1}, counter)
+
+    user.save()
+    del user
+    with RoundTripCounter() as counter:
+      user = User.getOrNew("rtgetornew")
+    self.assertRoundTrips({"get" : 1}, counter)
+
+    user.delete()
+
+  def test_saveRoundTrips(self):
+    user = User(username="foo_rtsave", password="123")
+    with RoundTripCounter() as counter:
+      user.save()
+    self.assertRoundTrips({"get" : 2, "store" : 2}, counter)
+
+    user.someprop = 1
+    with RoundTripCounter() as counter:
+      user.save()
+    self.assertRoundTrips({"store" : 1}, counter)
+
+    with RoundTripCounter() as counter:
+      user.save()
+    self.assertRoundTrips({}, counter)
+
+    key = user.key
+    del user
+    user = User.load(key)
+    with RoundTripCounter() as counter:
+      user.save()
+    self.assertRoundTrips({}, counter)
+
+    user.delete()
+
+  def test_getManyRoundTrips(self):
+    users = [User(username="foo_rtgetmany%d" % i, password="123").save() for i in xrange(3)]
+    keys = [u.key for u in users]
+
+    with RoundTripCounter() as counter:
+      User.getMany(keys)
+    self.assertRoundTrips({}, counter)
+
+    del users
+    with RoundTripCounter() as counter:
+      users = User.getMany(keys)
+    self.assertRoundTrips({"get" : 3}, counter)
+
+    for user in users:
+      user.delete()
+
+  def test_saveManyRoundTrips(self):
+    user = User(username="foo_rtsavemany", password="123")
+    comments = [Comment(author=user) for i in xrange(3)]
+    with RoundTripCounter() as counter:
+      Document.saveMany(comments)
+    # 3 comments, the user once and its unique username.
+    self.assertRoundTrips({"get" : 2, "store" : 5}, counter)
+
+    for c in comments:
+      c.delete()
+    user.delete()
+
+  def test_saveManyReferencedRoundTrips(self):
+    user = User(username="foo_rtsavemanyref", password="123")
+    comments = [Comment(author=user) for i in xrange(3)]
+    with RoundTripCounter() as counter:
+      Document.saveMany([user] + comments)
+    # The user is stored once, with all of its comments.
+    self.assertRoundTrips({"get" : 2, "store" : 5}, counter)
+    user.reload()
+    self.assertEquals(set(c.key for c in comments), set(user.comments.keys()))
+
+    for c in comments:
+      c.delete()
+    user.delete()
+
+  def test_lazyReferencesRoundTrips(self):
+    user = User(username="foo_rtlazyrefs", password="123")
+    comments = [Comment(author=user) for i in xrange(3)]
+    Document.saveMany(comments)
+    commentKeys = list(c.key for c in comments)
+    key = user.key
+    del user, comments
+    gc.collect() # The user and its comments reference each other.
+
+    user = User.load(key)
+    with RoundTripCounter() as counter:
+      self.assertEquals(3, len(user.comments))
+      self.assertEquals(set(commentKeys), set(user.comments.keys()))
+      self.assertTrue(commentKeys[0] in user.comments)
+    self.assertRoundTrips({}, counter)
+
+    with RoundTripCounter() as counter:
+      comments = list(user.comments)
+    self.assertRoundTrips({"get" : 3}, counter)
+
+    for c in comments:
+      c.delete()
+    user.delete()
+
+  def test_nonstrictRefRoundTrips(self):
+    a = TestNonStrictReferenceDocument()
+    a.rl.extend(["nope_rt1", "nope_rt2"])
+    a.save()
+    a.reload()
+
+    with RoundTripCounter() as counter:
+      refs = list(a.rl)
+    self.assertRoundTrips({"get" : 2}, counter)
+    self.assertEquals(["nope_rt1", "nope_rt2"], [c.key for c in refs])
+    self.assertFalse(any(Comment.exists(c.key) for c in refs))
+
+    a.delete()
+
+  def test_linksRoundTrips(self):
+    user = User(username="foo_rtlinks", password="123")
+    others = [User(username="bar_rtlinks%d" % i, password="123") for i in xrange(3)]
+    for other in others:
+      user.addLink(other, "friend")
+    Document.saveMany(others + [user])
+    otherKeys = set(o.key for o in others)
+    del others
+
+    with RoundTripCounter() as counter:
+      user.reload()
+      self.assertEquals(otherKeys, set(l.get_key() for l in user.links(True)))
+    self.assertRoundTrips({"get" : 1}, counter)
+
+    with RoundTripCounter() as counter:
+      links = user.links()
+    self.assertRoundTrips({"get" : 3}, counter)
+    self.assertEquals(otherKeys, set(d.key for d, t in links))
+
+    for d, t in links:
+      d.delete()
+    user.delete()
+
+  def test_reloadRoundTrips(self):
+    user = User(username="foo_rtreload", password="123").save()
+    with RoundTripCounter() as counter:
+      user.reload()
+    self.assertRoundTrips({"get" : 1}, counter)
+
+    user.delete()
+
+  def test_deleteRoundTrips(self):
+    user = User(username="foo_rtdelete", password="123").save()
+    with RoundTripCounter() as counter:
+      user.delete()
+    self.assertRoundTrips({"get" : 1, "delete" : 2}, counter)
+
 ###############################################################################
 ###############################################################################
 ###############################################################################
@@ -852,6 +2007,125 @@ class RiakkitPropertyTests(unittest.TestCase):
   def test_emdocumentDictProperty(self):
     prop = EmDocumentsDictProperty(emdocument_class=TestEmDocument)
 
+class FakeTransport(RiakTransport):
+  """An in-memory Riak, so the background calls can be tested without one.
+
+  Objects are kept per (bucket, key) as (vclock, metadata, encoded data) and
+  every write gets a new vclock. Each request sleeps for latency seconds
+  first, so that requests made at the same time overlap.
+  """
+  latency = 0
+
+  def __init__(self, host=None, port=None, client_id=None):
+    self._objects = {}
+    self._vclocks = itertools.count()
+    self._lock = threading.Lock()
+    self._client_id = client_id or self.make_random_client_id()
+
+  def _copy(self, metadata):
+    return dict((k, list(v) if isinstance(v, list) else dict(v) if isinstance(v, dict) else v)
+                for k, v in metadata.iteritems())
+
+  def get(self, robj, r=None, vtag=None, **kwargs):
+    time.sleep(self.latency)
+    with self._lock:
+      stored = self._objects.get((robj.get_bucket().get_name(), robj.get_key()))
+    if stored is None:
+      return None
+    vclock, metadata, data = stored
+    return vclock, [(self._copy(metadata), data)]
+
+  def put(self, robj, w=None, dw=None, return_body=True, **kwargs):
+    time.sleep(self.latency)
+    metadata = self._copy(robj.get_metadata())
+    metadata.setdefault(MD_INDEX, [])
+    with self._lock:
+      vclock = "vclock%d" % next(self._vclocks)
+      self._objects[(robj.get_bucket().get_name(), robj.get_key())] = (vclock, metadata, robj.get_encoded_data())
+    if return_body:
+      return vclock, [(self._copy(metadata), robj.get_encoded_data())]
+
+  def put_new(self, robj, w=None, dw=None, return_meta=True, **kwargs):
+    robj._key = base62Key()
+    vclock, contents = self.put(robj, w, dw)
+    return robj.get_key(), vclock, contents[0][0]
+
+  def delete(self, robj, rw=None, **kwargs):
+    time.sleep(self.latency)
+    with self._lock:
+      self._objects.pop((robj.get_bucket().get_name(), robj.get_key()), None)
+
+  def get_keys(self, bucket):
+    with self._lock:
+      return [key for name, key in self._objects if name == bucket.get_name()]
+
+  def set_client_id(self, client_id):
+    self._client_id = client_id
+
+  def get_client_id(self):
+    return self._client_id
+
+class FakeTransportModel(Document):
+  client = riak.RiakClient(transport_class=FakeTransport)
+  bucket_name = "test_fake"
+
+  intprop = IntegerProperty()
+  name = StringProperty(unique=True)
+
+class RiakkitFakeTransportTests(unittest.TestCase):
+  # The background calls against FakeTransport, with some latency so that the
+  # worker threads actually run at the same time.
+  def setUp(self):
+    self.transport = FakeTransportModel.client.get_transport()
+    self.transport.latency = 0.01
+
+  def tearDown(self):
+    self.transport.latency = 0
+
+  def test_asyncMethods(self):
+    futures = [FakeTransportModel(intprop=i).asave() for i in xrange(5)]
+    docs = [f.result(5) for f in futures]
+    keys = [doc.key for doc in docs]
+    self.assertEquals(sorted(keys), sorted(FakeTransportModel.bucket.get_keys()))
+    self.assertTrue(all(FakeTransportModel.aexists(key).result(5) for key in keys))
+    self.assertTrue(FakeTransportModel.aget(keys[0]).result(5) is docs[0])
+    self.assertEquals(range(5), [d.intprop for d in FakeTransportModel.agetMany(keys).result(5)])
+    self.assertRaises(NotFoundError, FakeTransportModel.aget("not_a_key").result, 5)
+
+    docs[1].intprop = 42
+    docs[1].asave().result(5)
+    self.assertEquals(42, FakeTransportModel.aget(keys[1], False).result(5).intprop)
+
+    Document.adeleteMany(docs).result(5)
+    self.assertFalse(any(FakeTransportModel.aexists(key).result(5) for key in keys))
+    self.assertEquals([], FakeTransportModel.bucket.get_keys())
+
+  def test_concurrentAget(self):
+    key = FakeTransportModel(intprop=1).save().key
+    gc.collect()
+    self.assertFalse(key in FakeTransportModel.instances)
+    docs = [future.result(5) for future in [FakeTransportModel.aget(key) for i in xrange(8)]]
+    self.assertTrue(all(doc is docs[0] for doc in docs))
+    self.assertEquals(1, docs[0].intprop)
+    docs[0].delete()
+
+  def test_sessionConcurrency(self):
+    docs = [FakeTransportModel(intprop=i, name="fake%d" % i) for i in xrange(50)]
+    with session():
+      for doc in docs:
+        doc.asave()
+    self.assertEquals(sorted(doc.key for doc in docs), sorted(FakeTransportModel.bucket.get_keys()))
+    self.assertTrue(all(FakeTransportModel._meta["name"].hasValue("fake%d" % i) for i in xrange(50)))
+
+    with session():
+      for doc in docs[:25]:
+        doc.adelete()
+      self.assertTrue(FakeTransportModel.exists(docs[0].key))
+    self.assertEquals(sorted(doc.key for doc in docs[25:]), sorted(FakeTransportModel.bucket.get_keys()))
+    self.assertFalse(FakeTransportModel._meta["name"].hasValue("fake0"))
+    Document.deleteMany(docs[25:])
+    self.assertEquals([], FakeTransportModel.bucket.get_keys())
+
 def deleteAllKeys(client, bucketname):
   bucket = client.bucket(bucketname)
   keys = bucket.get_keys()
@@ -892,10 +2166,16 @@ if __name__ == "__main__":
   document = unittest.TestSuite()
   document.addTest(unittest.makeSuite(RiakkitDocumentTests))
 
+  roundtrips = unittest.TestSuite()
+  roundtrips.addTest(unittest.makeSuite(RiakkitRoundTripTests))
+
   properties = unittest.TestSuite()
   properties.addTest(unittest.makeSuite(RiakkitPropertyTests))
 
-  alltests = unittest.TestSuite([base, simple, document, properties])
+  faketransport = unittest.TestSuite()
+  faketransport.addTest(unittest.makeSuite(RiakkitFakeTransportTests))
+
+  alltests = unittest.TestSuite([base, simple, document, roundtrips, properties, faketransport])
 
   suite = eval(arg)
   unittest.TextTestRunner(verbosity=2).run(suite)